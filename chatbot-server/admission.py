@@ -0,0 +1,229 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+# Lower is served first: grading a quiz in progress, then audio turns, then new questions,
+# and last speculative prefetches that no student is waiting for
+PRIORITY_QUIZ = 0
+PRIORITY_AUDIO = 1
+PRIORITY_NEW = 2
+PRIORITY_PREFETCH = 3
+PRIORITY_NAMES = {PRIORITY_QUIZ: 'quiz', PRIORITY_AUDIO: 'audio', PRIORITY_NEW: 'new', PRIORITY_PREFETCH: 'prefetch'}
+
+# Why a request was shed
+SHED_PREDICTED_WAIT = 'predicted_wait'
+SHED_QUEUE_FULL = 'queue_full'
+SHED_EXPIRED = 'expired'
+
+_WAITING = 'waiting'
+_GRANTED = 'granted'
+_SHED = 'shed'
+_DONE = 'done'
+
+
+class AdmissionTicket:
+    """One request's place in the admission queue; `admitted` is False if it was shed"""
+
+    __slots__ = ('priority', 'deadline', 'seq', 'enqueued_at', 'admitted_at', 'state', 'shed_reason',
+                 '_event', '_loop', '_future')
+
+    def __init__(self, priority: int, deadline: float, seq: int, now: float):
+        self.priority = priority
+        self.deadline = deadline
+        self.seq = seq
+        self.enqueued_at = now
+        self.admitted_at: Optional[float] = None
+        self.state = _WAITING
+        self.shed_reason: Optional[str] = None
+        self._event: Optional[threading.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._future: Optional[asyncio.Future] = None
+
+    def __lt__(self, other: 'AdmissionTicket') -> bool:
+        return (self.priority, self.deadline, self.seq) < (other.priority, other.deadline, other.seq)
+
+    @property
+    def admitted(self) -> bool:
+        return self.state == _GRANTED
+
+    @property
+    def waited_seconds(self) -> float:
+        return (self.admitted_at if self.admitted_at is not None else time.monotonic()) - self.enqueued_at
+
+    def remaining_ms(self) -> float:
+        """Milliseconds left before the deadline (for the model router's budget)"""
+        return max((self.deadline - time.monotonic()) * 1000, 0.0)
+
+    def _wake(self):
+        if self._event is not None:
+            self._event.set()
+        elif self._future is not None:
+            self._loop.call_soon_threadsafe(_resolve, self._future)
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class AdmissionController:
+    """Bounded priority queue in front of generation, with deadline-aware load shedding
+
+    Up to `max_active` requests generate at once; the rest wait, served by
+    priority and then earliest deadline. A request is shed (acquire returns
+    a ticket with admitted False) instead of queued when the predicted wait
+    plus a typical generation would overrun its deadline, when the queue is
+    full and it ranks below everything waiting (otherwise the lowest-ranked
+    waiter is shed to make room), or when its turn comes too close to its
+    deadline to finish.
+    The prediction uses a moving average of admitted requests' run time.
+    """
+
+    def __init__(self, max_active: int, max_queue: int = 256, initial_service_seconds: float = 2.0,
+                 smoothing: float = 0.2):
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.smoothing = smoothing
+        self.service_ewma = initial_service_seconds
+        self.active = 0
+        self._queue: List[AdmissionTicket] = []
+        self._waiting = 0
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self.stats_counts = {'admitted': 0, 'queued': 0, 'max_queue_depth': 0,
+                             SHED_PREDICTED_WAIT: 0, SHED_QUEUE_FULL: 0, SHED_EXPIRED: 0}
+        self.admitted_by_priority = {name: 0 for name in PRIORITY_NAMES.values()}
+
+    def predicted_wait(self, ticket: AdmissionTicket) -> float:
+        """Seconds until a slot frees up for this ticket, given the waiters ranked ahead of it"""
+        ahead = sum(1 for other in self._queue if other.state == _WAITING and other < ticket)
+        return self.service_ewma * (ahead + 1) / self.max_active
+
+    def _grant(self, ticket: AdmissionTicket, now: float):
+        ticket.state = _GRANTED
+        ticket.admitted_at = now
+        self.active += 1
+        self.stats_counts['admitted'] += 1
+        self.admitted_by_priority[PRIORITY_NAMES.get(ticket.priority, str(ticket.priority))] += 1
+
+    def _shed(self, ticket: AdmissionTicket, reason: str):
+        ticket.state = _SHED
+        ticket.shed_reason = reason
+        self.stats_counts[reason] += 1
+
+    def _pop_waiting(self) -> Optional[AdmissionTicket]:
+        while self._queue:
+            ticket = heapq.heappop(self._queue)
+            if ticket.state == _WAITING:
+                self._waiting -= 1
+                return ticket
+        return None
+
+    def _dispatch(self, now: float) -> List[AdmissionTicket]:
+        """Fill free slots from the queue; returns the tickets to wake (granted or shed)"""
+        woken = []
+        while self.active < self.max_active:
+            ticket = self._pop_waiting()
+            if ticket is None:
+                break
+            # Too late to finish a typical generation before the deadline
+            if ticket.deadline - now < self.service_ewma:
+                self._shed(ticket, SHED_EXPIRED)
+            else:
+                self._grant(ticket, now)
+            woken.append(ticket)
+        return woken
+
+    def _enter(self, priority: int, deadline: float) -> AdmissionTicket:
+        """Admit, shed or queue a new ticket; queued tickets are returned still waiting"""
+        now = time.monotonic()
+        ticket = AdmissionTicket(priority, deadline, next(self._seq), now)
+        woken = []
+        with self._lock:
+            if self.active < self.max_active and not self._waiting:
+                self._grant(ticket, now)
+                return ticket
+            if self.predicted_wait(ticket) + self.service_ewma > deadline - now:
+                self._shed(ticket, SHED_PREDICTED_WAIT)
+                return ticket
+            if self._waiting >= self.max_queue:
+                worst = max((other for other in self._queue if other.state == _WAITING), default=None)
+                if worst is None or not ticket < worst:
+                    self._shed(ticket, SHED_QUEUE_FULL)
+                    return ticket
+                self._shed(worst, SHED_QUEUE_FULL)
+                self._waiting -= 1
+                woken.append(worst)
+            heapq.heappush(self._queue, ticket)
+            self._waiting += 1
+            self.stats_counts['queued'] += 1
+            self.stats_counts['max_queue_depth'] = max(self.stats_counts['max_queue_depth'], self._waiting)
+        for other in woken:
+            other._wake()
+        return ticket
+
+    def _expire(self, ticket: AdmissionTicket):
+        """The waiter gave up at its deadline; shed it unless a slot was granted meanwhile"""
+        with self._lock:
+            if ticket.state == _WAITING:
+                self._shed(ticket, SHED_EXPIRED)
+                self._waiting -= 1
+
+    def acquire(self, priority: int, deadline: float) -> AdmissionTicket:
+        """Block until admitted or shed; `deadline` is a time.monotonic() value"""
+        ticket = self._enter(priority, deadline)
+        if ticket.state != _WAITING:
+            return ticket
+        ticket._event = threading.Event()
+        # The slot may have been granted between _enter and setting the event
+        if ticket.state == _WAITING and not ticket._event.wait(max(deadline - time.monotonic(), 0.0)):
+            self._expire(ticket)
+        return ticket
+
+    async def acquire_async(self, priority: int, deadline: float) -> AdmissionTicket:
+        """acquire() that waits on the event loop"""
+        ticket = self._enter(priority, deadline)
+        if ticket.state != _WAITING:
+            return ticket
+        ticket._loop = asyncio.get_running_loop()
+        ticket._future = ticket._loop.create_future()
+        if ticket.state != _WAITING:
+            return ticket
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket._future), max(deadline - time.monotonic(), 0.0))
+        except asyncio.TimeoutError:
+            self._expire(ticket)
+        except asyncio.CancelledError:
+            self._expire(ticket)
+            if ticket.admitted:
+                self.release(ticket)
+            raise
+        return ticket
+
+    def release(self, ticket: AdmissionTicket):
+        """Free an admitted ticket's slot and let the next waiters in"""
+        if not ticket.admitted:
+            return
+        now = time.monotonic()
+        with self._lock:
+            ticket.state = _DONE
+            self.active -= 1
+            self.service_ewma += self.smoothing * ((now - ticket.admitted_at) - self.service_ewma)
+            woken = self._dispatch(now)
+        for other in woken:
+            other._wake()
+
+    def spare_slots(self) -> int:
+        """Slots free with nobody waiting for them"""
+        with self._lock:
+            return 0 if self._waiting else self.max_active - self.active
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            shed = sum(self.stats_counts[reason] for reason in (SHED_PREDICTED_WAIT, SHED_QUEUE_FULL, SHED_EXPIRED))
+            return dict(self.stats_counts, shed=shed, active=self.active, waiting=self._waiting,
+                        max_active=self.max_active, max_queue=self.max_queue,
+                        service_seconds=round(self.service_ewma, 3), admitted_by_priority=dict(self.admitted_by_priority))
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, BinaryIO, Dict, Optional, Union
+
+# Cached segments are raw PCM, named by the hash of what produced them
+SEGMENT_SUFFIX = '.pcm'
+
+BytesLike = Union[bytes, bytearray, memoryview]
+
+
+def normalize_sentence(sentence: str) -> str:
+    """Collapse whitespace; case and punctuation are kept since they change how a sentence is spoken"""
+    return re.sub(r'\s+', ' ', sentence or '').strip()
+
+
+class AudioSegmentCache:
+    """Content-addressed store of synthesized sentences on disk, with size-capped LRU eviction
+
+    Each segment is raw PCM in `directory`/<sha256>.pcm, keyed by the sentence,
+    voice, backend and sample format, so segments can be appended to a WAV
+    without decoding. The LRU order is rebuilt from file modification times on
+    startup and hits refresh them, so it survives restarts; several worker
+    processes may share one directory.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries: 'OrderedDict[str, int]' = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+        os.makedirs(directory, exist_ok=True)
+        segments = []
+        for entry in os.scandir(directory):
+            if entry.name.endswith(SEGMENT_SUFFIX) and entry.is_file():
+                stat = entry.stat()
+                segments.append((stat.st_mtime, entry.name[:-len(SEGMENT_SUFFIX)], stat.st_size))
+        for _, key, size in sorted(segments):
+            self._entries[key] = size
+            self._bytes += size
+        with self._lock:
+            self._evict()
+
+    def make_key(self, sentence: str, voice: str, backend: str, sample_rate: int, sample_width: int) -> str:
+        material = json.dumps([normalize_sentence(sentence), voice, backend, sample_rate, sample_width])
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.directory, key + SEGMENT_SUFFIX)
+
+    def open_segment(self, key: str) -> Optional[BinaryIO]:
+        """Open a cached segment for streaming into a WAV, or None on a miss; the caller closes it
+
+        An open file stays readable even if another worker evicts the segment meanwhile.
+        """
+        path = self.path_for(key)
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            # Never stored, or evicted by another worker sharing the directory
+            with self._lock:
+                if key in self._entries:
+                    self._bytes -= self._entries.pop(key)
+                self.misses += 1
+            return None
+
+        size = os.fstat(f.fileno()).st_size
+        try:
+            # Refresh the on-disk LRU order too
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            else:
+                self._entries[key] = size
+                self._bytes += size
+                self._evict()
+            self.hits += 1
+        return f
+
+    def set(self, key: str, pcm: BytesLike):
+        if len(pcm) > self.max_bytes:
+            return
+        path = self.path_for(key)
+        # Write then rename so readers never see a partial segment
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(pcm)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)
+            self._entries[key] = len(pcm)
+            self._bytes += len(pcm)
+            self.stores += 1
+            self._evict()
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self.path_for(key))
+            except OSError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'segments': len(self._entries),
+                'bytes': self._bytes,
+            }
@@ -0,0 +1,285 @@
+import asyncio
+import json
+import os
+import sys
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterator, Optional, Tuple
+
+
+def normalize_record(record: Dict[str, Any], line_number: int) -> Dict[str, Any]:
+    """Database-format message from a stored row or a requests.jsonl-style record"""
+    if 'text' not in record and 'body' in record:
+        # requests.jsonl style: {"request_id", "title", "body"}
+        return {
+            'message_id': record.get('request_id', f"line-{line_number}"),
+            'chat_id': record.get('chat_id'),
+            'role': 'user',
+            'message_type': 'text',
+            'text': record['body'],
+            'context': record.get('title', ''),
+        }
+
+    message = dict(record)
+    message.setdefault('message_id', f"line-{line_number}")
+    message.setdefault('chat_id', None)
+    message.setdefault('role', 'user')
+    message.setdefault('message_type', 'text')
+    if 'text' not in message:
+        raise ValueError("record has no 'text' (or 'body') field")
+    return message
+
+
+def read_records(path: str, skip: int = 0) -> Iterator[Tuple[int, Optional[Dict[str, Any]], Optional[str]]]:
+    """Yield (line_number, record, parse_error) for non-blank lines, after the first `skip` of them"""
+    with open(path, encoding='utf-8') as f:
+        index = 0
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            index += 1
+            if index <= skip:
+                continue
+            try:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError("record must be a JSON object")
+                yield line_number, record, None
+            except ValueError as e:
+                yield line_number, None, str(e)
+
+
+def needs_rerun(line: Dict[str, Any]) -> bool:
+    """Whether an output line is a failed or degraded (canned fallback) result"""
+    return line.get('status') in ('failed', 'degraded') or 'error' in line
+
+
+def read_kept_results(path: str) -> Dict[str, bytes]:
+    """Output lines of an earlier run that need no re-run, by message_id"""
+    kept = {}
+    with open(path, 'rb') as f:
+        for raw in f:
+            try:
+                line = json.loads(raw)
+            except ValueError:
+                continue
+            if isinstance(line, dict) and line.get('message_id') is not None and not needs_rerun(line):
+                kept[str(line['message_id'])] = raw if raw.endswith(b"\n") else raw + b"\n"
+    return kept
+
+
+def count_records(path: str) -> int:
+    with open(path, encoding='utf-8') as f:
+        return sum(1 for line in f if line.strip())
+
+
+class BatchCheckpoint:
+    """Records how many input records are safely in the output file, and its size at that point"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self, input_path: str) -> Optional[Tuple[int, int]]:
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if state.get('input') != os.path.abspath(input_path):
+            print(f"Checkpoint {self.path} is for {state.get('input')}, starting over", file=sys.stderr)
+            return None
+        return state['records_done'], state['output_bytes']
+
+    def save(self, input_path: str, records_done: int, output_bytes: int):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'input': os.path.abspath(input_path), 'records_done': records_done,
+                       'output_bytes': output_bytes, 'updated_at': time.time()}, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class BatchStats:
+    """Counters and throughput for one batch run"""
+
+    def __init__(self, total: int, already_done: int):
+        self.total = total
+        self.already_done = already_done
+        self.started_at = time.time()
+        self.completed = 0
+        self.succeeded = 0
+        self.degraded = 0
+        self.failed = 0
+        self.skipped = 0
+        self.kept = 0
+        self.tokens = 0
+        self.latencies_ms = []
+
+    def record(self, outcome: str, latency_ms: float = 0.0, tokens: int = 0):
+        self.completed += 1
+        if outcome in ('ok', 'degraded'):
+            if outcome == 'ok':
+                self.succeeded += 1
+            else:
+                self.degraded += 1
+            self.tokens += tokens
+            self.latencies_ms.append(latency_ms)
+        elif outcome == 'skipped':
+            self.skipped += 1
+        elif outcome == 'kept':
+            self.kept += 1
+        else:
+            self.failed += 1
+
+    def summary(self) -> Dict[str, Any]:
+        elapsed = max(time.time() - self.started_at, 1e-9)
+        latencies = sorted(self.latencies_ms)
+
+        def percentile(pct: float) -> float:
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * pct))], 1) if latencies else 0.0
+
+        return {
+            'processed': self.completed,
+            'succeeded': self.succeeded,
+            'degraded': self.degraded,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'kept': self.kept,
+            'resumed_after': self.already_done,
+            'remaining': max(self.total - self.already_done - self.completed, 0),
+            'elapsed_seconds': round(elapsed, 2),
+            'messages_per_second': round(self.completed / elapsed, 2),
+            'tokens_per_second': round(self.tokens / elapsed, 1),
+            'latency_p50_ms': percentile(0.5),
+            'latency_p95_ms': percentile(0.95),
+        }
+
+    def progress_line(self) -> str:
+        summary = self.summary()
+        done = self.already_done + self.completed
+        rate = summary['messages_per_second']
+        eta = f"{summary['remaining'] / rate:.0f}s" if rate else '?'
+        return (f"[batch] {done}/{self.total} records, {rate} msg/s, "
+                f"{self.failed} failed, {self.degraded} degraded, p95 {summary['latency_p95_ms']}ms, eta {eta}")
+
+
+async def run_batch(input_path: str, output_path: str,
+                    process: Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]],
+                    concurrency: int = 8, restart: bool = False, rerun_failed: bool = False,
+                    report_every: float = 5.0, checkpoint_every: float = 1.0) -> Dict[str, Any]:
+    """Run `process` over every record of a JSONL file, writing one JSON result line per record
+
+    Results are written in input order (each carries its message_id). At most
+    `concurrency` records are processed at once; finished records wait in a
+    small reorder window until everything before them is written. Progress is
+    checkpointed next to the output so an interrupted run resumes where it
+    stopped; pass restart=True to ignore the checkpoint.
+
+    Every line has a status: ok, degraded (the canned fallback answer, e.g.
+    when every API key was exhausted), failed or skipped (not a user
+    message). With rerun_failed=True the existing output is moved aside and
+    only its failed and degraded records (and any it does not have yet) are
+    processed again; the rest are copied over unchanged.
+    """
+    checkpoint = BatchCheckpoint(output_path + '.checkpoint')
+    previous_path = output_path + '.previous'
+    state = None if restart else checkpoint.load(input_path)
+    if rerun_failed and not os.path.exists(previous_path) and os.path.exists(output_path):
+        # Keep what the earlier (possibly interrupted) run wrote up to its checkpoint
+        if state:
+            with open(output_path, 'r+b') as f:
+                f.truncate(state[1])
+        os.replace(output_path, previous_path)
+        state = None
+    # An interrupted re-run carries on with the same earlier output
+    resuming_rerun = os.path.exists(previous_path) and (rerun_failed or not restart)
+    kept = read_kept_results(previous_path) if resuming_rerun else {}
+    records_done, output_bytes = state or (0, 0)
+    if state:
+        print(f"[batch] resuming after {records_done} records", file=sys.stderr)
+
+    out = open(output_path, 'r+b' if state and os.path.exists(output_path) else 'wb')
+    # Drop anything written after the last checkpoint (e.g. a half-written line)
+    out.truncate(output_bytes)
+    out.seek(output_bytes)
+
+    stats = BatchStats(count_records(input_path), records_done)
+    in_flight = asyncio.Semaphore(concurrency)
+    # Bounds memory: processing plus finished-but-unwritten records
+    window = asyncio.Semaphore(concurrency * 4)
+    pending: Dict[int, bytes] = {}
+    next_to_write = records_done
+    last_checkpoint = last_report = time.time()
+
+    def flush_ready():
+        nonlocal next_to_write
+        while next_to_write in pending:
+            out.write(pending.pop(next_to_write))
+            next_to_write += 1
+            window.release()
+        if time.time() - last_checkpoint >= checkpoint_every:
+            save_checkpoint()
+
+    def save_checkpoint():
+        nonlocal last_checkpoint
+        out.flush()
+        os.fsync(out.fileno())
+        checkpoint.save(input_path, next_to_write, out.tell())
+        last_checkpoint = time.time()
+
+    async def handle(index: int, line_number: int, record: Optional[Dict[str, Any]], parse_error: Optional[str]):
+        nonlocal last_report
+        started = time.time()
+        encoded = None
+        try:
+            if parse_error:
+                raise ValueError(f"line {line_number}: {parse_error}")
+            message_data = normalize_record(record, line_number)
+            if str(message_data['message_id']) in kept:
+                stats.record('kept')
+                encoded = kept[str(message_data['message_id'])]
+            elif message_data['role'] != 'user':
+                stats.record('skipped')
+                line = {'message_id': message_data['message_id'], 'line': line_number, 'status': 'skipped'}
+            else:
+                async with in_flight:
+                    result = await process(message_data)
+                latency_ms = (time.time() - started) * 1000
+                status = 'degraded' if result.get('fallback_response') or not result.get('generation_success', True) else 'ok'
+                stats.record(status, latency_ms, result.get('total_tokens', 0))
+                line = dict(result, status=status)
+        except Exception as e:
+            stats.record('failed')
+            message_id = record.get('message_id', record.get('request_id')) if record else None
+            line = {'message_id': message_id or f"line-{line_number}", 'line': line_number, 'status': 'failed', 'error': str(e)}
+
+        pending[index] = encoded or (json.dumps(line, ensure_ascii=False, default=str) + "\n").encode('utf-8')
+        flush_ready()
+        if report_every and time.time() - last_report >= report_every:
+            last_report = time.time()
+            print(stats.progress_line(), file=sys.stderr)
+
+    tasks = set()
+    try:
+        for index, (line_number, record, parse_error) in enumerate(read_records(input_path, records_done), records_done):
+            await window.acquire()
+            task = asyncio.create_task(handle(index, line_number, record, parse_error))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Whatever was written in order so far survives an interruption
+        save_checkpoint()
+        out.close()
+
+    checkpoint.clear()
+    if os.path.exists(previous_path):
+        os.remove(previous_path)
+    summary = stats.summary()
+    print(f"[batch] done: {json.dumps(summary)}", file=sys.stderr)
+    return summary
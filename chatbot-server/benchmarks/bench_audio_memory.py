@@ -0,0 +1,71 @@
+"""Peak memory of writing an audio reply, by answer length
+
+Compares the old path (the whole PCM payload built in memory, then written
+with the wave module) with AudioPipeline streaming sentences through
+WavWriter, in append and mmap-preallocated mode. Peak Python allocations
+are measured with tracemalloc; TTS is the local silent backend.
+
+Usage: python benchmarks/bench_audio_memory.py [--sentences 10 100 1000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import wave
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tts import AudioPipeline, SilentTTSBackend, WORDS_PER_SECOND, split_sentences
+
+SENTENCE = "Photosynthesis turns light energy into chemical energy stored in glucose molecules."
+
+
+def legacy_write(text: str, path: str):
+    """The old generate_audio_response: one zero buffer for the whole reply"""
+    samples = int(len(text.split()) / WORDS_PER_SECOND * 24000)
+    pcm = b'\x00' * (samples * 2)
+    with wave.open(path, 'wb') as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(24000)
+        wf.writeframes(pcm)
+
+
+def measure(fn):
+    tracemalloc.start()
+    started = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sentences', type=int, nargs='+', default=[10, 100, 1000])
+    args = parser.parse_args()
+
+    streaming = AudioPipeline(SilentTTSBackend(), max_concurrency=4)
+    preallocated = AudioPipeline(SilentTTSBackend(), max_concurrency=4, preallocate=True)
+    # Start the worker threads outside the measurement
+    with tempfile.TemporaryDirectory() as tmp:
+        streaming.synthesize_to_wav(SENTENCE, 'Kore', os.path.join(tmp, 'warmup.wav'))
+
+    print(f"{'sentences':>9} {'audio':>9} {'old peak':>10} {'stream peak':>12} {'mmap peak':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'reply.wav')
+        for count in args.sentences:
+            text = ' '.join([SENTENCE] * count)
+            assert len(split_sentences(text)) == count
+            legacy_peak, _ = measure(lambda: legacy_write(text, path))
+            stream_peak, _ = measure(lambda: streaming.synthesize_to_wav(text, 'Kore', path))
+            mmap_peak, _ = measure(lambda: preallocated.synthesize_to_wav(text, 'Kore', path))
+            print(f"{count:>9} {os.path.getsize(path) / 1e6:>7.1f}MB {legacy_peak / 1e6:>8.2f}MB "
+                  f"{stream_peak / 1e6:>10.2f}MB {mmap_peak / 1e6:>8.2f}MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Throughput of the compiled message classifier against the old substring scans
+
+Usage: python benchmarks/bench_classifier.py [--messages 200000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from classifier import QUIZ_KEYWORDS, SUBJECT_KEYWORDS, MessageClassifier
+
+MESSAGES = [
+    'What is photosynthesis?', 'Explain how cells divide during mitosis', 'Can you solve this equation for x: 2x + 3 = 7',
+    'Why did the French Revolution start?', 'Q1: B Q2: True Q3: 42', 'my answer is the mitochondria',
+    'What is the meaning of this poem by Robert Frost?', 'Compare a for loop and a while loop in Python',
+    'Tell me about the Roman Empire in the first century', 'I think the answer is 12',
+    'Show me the software timeline', 'hello there', 'What does the verb "to be" do in a sentence?',
+    'Analyze the theme of the novel and its main character', 'How does a data structure like a heap work?',
+]
+
+
+def legacy_classify(user_message: str):
+    """The per-call substring scans the classifier replaced"""
+    question_type = 'conceptual'
+    if any(indicator in user_message.lower() for indicator in ['explain', 'how', 'why', 'what if', 'compare', 'analyze']):
+        question_type = 'analytical'
+    elif any(word in user_message.lower() for word in ['definition', 'what is', 'meaning']):
+        question_type = 'definitional'
+
+    subject_area = 'general'
+    for subject, keywords in dict(SUBJECT_KEYWORDS).items():
+        if any(keyword in user_message.lower() for keyword in keywords):
+            subject_area = subject
+            break
+
+    is_quiz = any(indicator in user_message.lower() for indicator in list(QUIZ_KEYWORDS))
+    return question_type, subject_area, is_quiz
+
+
+def timed(label: str, count: int, fn):
+    started = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - started
+    print(f"{label:<26} {elapsed * 1000:9.1f} ms  {count / elapsed:12,.0f} msg/s")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--batch-size', type=int, default=10000)
+    args = parser.parse_args()
+
+    random.seed(7)
+    messages = [random.choice(MESSAGES) for _ in range(args.messages)]
+    classifier = MessageClassifier()
+
+    print(f"{args.messages} messages")
+    legacy = timed('legacy substring scans', len(messages), lambda: [legacy_classify(m) for m in messages])
+    single = timed('classify()', len(messages), lambda: [classifier.classify(m) for m in messages])
+    batched = timed(f'classify_batch({args.batch_size})', len(messages), lambda: [
+        result
+        for i in range(0, len(messages), args.batch_size)
+        for result in classifier.classify_batch(messages[i:i + args.batch_size])
+    ])
+
+    assert single == batched, "batch and single-message results differ"
+    differing = sorted({
+        message for message, old, new in zip(messages, legacy, single)
+        if old != (new['question_type'], new['subject_area'], new['is_quiz_response'])
+    })
+    print(f"\n{len(differing)} of {len(MESSAGES)} sample messages classify differently (word boundaries):")
+    for message in differing:
+        new = classifier.classify(message)
+        print(f"  {message!r}: {legacy_classify(message)} -> "
+              f"{(new['question_type'], new['subject_area'], new['is_quiz_response'])}")
+
+
+if __name__ == '__main__':
+    main()
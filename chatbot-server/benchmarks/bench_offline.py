@@ -0,0 +1,226 @@
+"""Load test of generate_chat_response against a local fake Gemini (no quota spent)
+
+Drives the real agent (key pool, routing, retries, fallbacks, parsing) at a
+fixed concurrency while benchmarks/fake_gemini.py answers every model call
+with schema-valid JSON after a sampled latency, injecting 429s and
+truncated JSON at the given rates. Reports throughput, latency percentiles,
+retries and fallback rates, and saves them as JSON; --compare prints the
+change against an earlier results file.
+
+Usage: python benchmarks/bench_offline.py [--requests 200] [--concurrency 16] [--mode sync|async]
+           [--latency lognormal:800:0.5] [--rate-429 0.05] [--malformed-rate 0.02]
+           [--context-cache [--cache-min-tokens 0]] [--out results.json] [--compare previous.json]
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import warnings
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from fake_gemini import FakeGeminiConfig, install, install_context_cache
+
+STUDY_MESSAGES = [
+    'What is photosynthesis?', 'Explain how cells divide during mitosis', 'Solve 2x + 3 = 7 for x',
+    'Why did the French Revolution start?', 'What is the meaning of this poem by Robert Frost?',
+    'Compare a for loop and a while loop in Python', 'Tell me about the Roman Empire',
+    'How does a heap data structure work?', 'Define kinetic energy', 'What causes the seasons on Earth?',
+]
+QUIZ_MESSAGES = ['Q1: B Q2: True Q3: 42', 'my answer is the mitochondria', 'I think the answer is 12']
+
+
+def configure_environment(args):
+    """Settings func.py reads at import: fake keys, quota that is not the bottleneck, no caches"""
+    for i in range(1, 8):
+        os.environ.pop(f'GOOGLE_API_KEY_{i}', None)
+    for i in range(1, args.keys + 1):
+        os.environ[f'GOOGLE_API_KEY_{i}'] = f'offline-bench-key-{i}'
+    os.environ['GEMINI_RPM_PER_KEY'] = str(args.rpm_per_key)
+    os.environ['RESPONSE_CACHE_ENABLED'] = 'false'
+    os.environ['SEMANTIC_CACHE_ENABLED'] = 'false'
+    os.environ['TTS_BACKEND'] = 'silent'
+    os.environ['CONTEXT_CACHE_ENABLED'] = 'true' if args.context_cache else 'false'
+    os.environ['COALESCE_REQUESTS_ENABLED'] = 'true' if args.coalesce else 'false'
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))] if ordered else 0.0
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def make_workload(args):
+    rng = random.Random(args.seed)
+    return [
+        rng.choice(QUIZ_MESSAGES) if rng.random() < args.quiz_share else rng.choice(STUDY_MESSAGES)
+        for _ in range(args.requests)
+    ]
+
+
+def run_sync(func, messages, concurrency):
+    def one(message):
+        started = time.perf_counter()
+        result = func.generate_chat_response(message, '', 'text')
+        return time.perf_counter() - started, result
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(one, messages))
+
+
+def run_async(func, messages, concurrency):
+    async def main():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(message):
+            async with semaphore:
+                started = time.perf_counter()
+                result = await func.generate_chat_response_async(message, '', 'text')
+                return time.perf_counter() - started, result
+
+        return await asyncio.gather(*(one(message) for message in messages))
+
+    return asyncio.run(main())
+
+
+def summarize(args, outcomes, elapsed, fake, func):
+    latencies_ms = [seconds * 1000 for seconds, _ in outcomes]
+    results = [result for _, result in outcomes]
+    fallbacks = sum(not result['generation_success'] for result in results)
+    model_counts = {}
+    for result in results:
+        model_used = result.get('model_used')
+        model_counts[model_used] = model_counts.get(model_used, 0) + 1
+    agent = func.get_generator().agent
+    router = agent.model_router.snapshot()
+    calls = fake['calls']
+    single_flight = func.get_generator().single_flight
+    coalesced = single_flight.stats()['coalesced'] if single_flight else 0
+
+    return {
+        'revision': git_revision(),
+        'recorded_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': {
+            'requests': args.requests, 'concurrency': args.concurrency, 'mode': args.mode, 'keys': args.keys,
+            'latency': args.latency, 'rate_429': args.rate_429, 'malformed_rate': args.malformed_rate,
+            'quiz_share': args.quiz_share, 'seed': args.seed, 'context_cache': args.context_cache,
+            'coalesce': args.coalesce,
+        },
+        'throughput_rps': round(len(results) / elapsed, 2),
+        'elapsed_seconds': round(elapsed, 2),
+        'latency_ms': {
+            'p50': round(percentile(latencies_ms, 50), 1),
+            'p95': round(percentile(latencies_ms, 95), 1),
+            'p99': round(percentile(latencies_ms, 99), 1),
+            'max': round(max(latencies_ms), 1),
+        },
+        'model_calls': calls,
+        'calls_per_request': round(calls / len(results), 3),
+        # Calls beyond one per request that made its own: 429 retries, model fallbacks and plain-text fallbacks
+        'retries': calls - (len(results) - coalesced),
+        # Requests that waited for an identical one already in flight instead of calling
+        'coalesced_requests': coalesced,
+        'injected_429': fake['injected_429'],
+        'malformed_json': fake['malformed'],
+        # Requests that ended in build_failed_result, and structured calls that fell back to plain text
+        'fallback_rate': round(fallbacks / len(results), 4),
+        'plain_text_fallback_rate': round(fake['plain_text'] / len(results), 4),
+        'model_fallbacks': sum(counts.get('fallback', 0) for counts in router.values()),
+        'models_used': model_counts,
+        # Prompt text actually sent per call; the context cache moves the constant prefix server-side
+        'prompt_chars_per_call': round(fake['prompt_chars'] / calls, 1) if calls else 0.0,
+        'cached_calls': fake['cached_calls'],
+        'context_cache': agent.context_cache.stats() if agent.context_cache else None,
+        'admission': func.get_generator().admission.stats() if func.get_generator().admission else None,
+    }
+
+
+def print_comparison(current, previous):
+    print(f"\nvs {previous.get('revision')} ({previous.get('recorded_at')}):")
+    rows = [('throughput_rps', current['throughput_rps'], previous['throughput_rps'])]
+    rows += [(f'latency {key}', current['latency_ms'][key], previous['latency_ms'][key]) for key in ('p50', 'p95', 'p99')]
+    rows += [(key, current[key], previous[key]) for key in ('calls_per_request', 'fallback_rate', 'plain_text_fallback_rate')
+             if key in previous]
+    if 'prompt_chars_per_call' in previous:
+        rows.append(('prompt_chars_per_call', current['prompt_chars_per_call'], previous['prompt_chars_per_call']))
+    for label, now, before in rows:
+        change = f"{(now - before) / before * 100:+.1f}%" if before else 'n/a'
+        print(f"  {label:<18} {before:>10} -> {now:<10} {change}")
+    if current['config'] != previous['config']:
+        print("  (configurations differ)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--mode', choices=['sync', 'async'], default='sync')
+    parser.add_argument('--keys', type=int, default=4)
+    parser.add_argument('--rpm-per-key', type=int, default=100000)
+    parser.add_argument('--latency', default='lognormal:800:0.5',
+                        help="fixed:MS, uniform:MIN_MS:MAX_MS or lognormal:MEDIAN_MS:SIGMA")
+    parser.add_argument('--rate-429', type=float, default=0.05)
+    parser.add_argument('--malformed-rate', type=float, default=0.02)
+    parser.add_argument('--retry-after', type=int, default=1, help="retry_delay seconds in injected 429s")
+    parser.add_argument('--quiz-share', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--context-cache', action='store_true', help="serve the constant prompt prefix from (fake) cached content")
+    parser.add_argument('--cache-min-tokens', type=int, default=0, help="fake cache refuses smaller prefixes, like the API")
+    parser.add_argument('--coalesce', action='store_true', help="identical concurrent requests share one call")
+    parser.add_argument('--out', default=os.path.join(BENCH_DIR, 'results', 'offline.json'))
+    parser.add_argument('--compare', help="earlier results JSON to compare against")
+    parser.add_argument('--verbose', action='store_true', help="show the agent's own log lines")
+    args = parser.parse_args()
+
+    configure_environment(args)
+    # The SDK's deprecation notice is not a benchmark result
+    warnings.simplefilter('ignore', FutureWarning)
+    with contextlib.redirect_stdout(io.StringIO()):
+        import func
+        fake = install(func.get_genai(), FakeGeminiConfig(
+            latency=args.latency, rate_429=args.rate_429, malformed_rate=args.malformed_rate,
+            retry_after_seconds=args.retry_after, seed=args.seed,
+            schemas={'quiz_evaluation': func.QUIZ_RESPONSE_SCHEMA, 'phase_1_analysis': func.STUDY_RESPONSE_SCHEMA}
+        ))
+        agent = func.get_generator().agent
+        if agent.context_cache:
+            install_context_cache(agent.context_cache, fake, args.cache_min_tokens)
+
+    messages = make_workload(args)
+    runner = run_async if args.mode == 'async' else run_sync
+    log = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with log:
+        started = time.perf_counter()
+        outcomes = runner(func, messages, args.concurrency)
+        elapsed = time.perf_counter() - started
+
+    summary = summarize(args, outcomes, elapsed, fake.snapshot(), func)
+    print(json.dumps(summary, indent=2))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=2)
+    print(f"\nsaved to {args.out}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            print_comparison(summary, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
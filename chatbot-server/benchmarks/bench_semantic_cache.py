@@ -0,0 +1,65 @@
+"""Lookup cost of the semantic cache as it fills up
+
+Usage: python benchmarks/bench_semantic_cache.py [--entries 100000] [--lookups 2000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from semantic_cache import SemanticCache
+
+TOPICS = ['photosynthesis', 'mitosis', 'algebra', 'the french revolution', 'newton laws', 'sorting algorithms',
+          'shakespeare sonnets', 'plate tectonics', 'chemical bonds', 'derivatives', 'the water cycle', 'gravity']
+TEMPLATES = ['explain {}', 'what is {}', 'can you help me understand {}', 'how does {} work',
+             'why is {} important', 'give me an example of {}', 'summarize {} for a test']
+
+
+def make_question(i: int) -> str:
+    return f"{random.choice(TEMPLATES).format(random.choice(TOPICS))} part {i}"
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=100000)
+    parser.add_argument('--lookups', type=int, default=2000)
+    parser.add_argument('--dim', type=int, default=256)
+    args = parser.parse_args()
+
+    random.seed(7)
+    cache = SemanticCache(capacity=args.entries, dim=args.dim)
+    payload = {'response_text': 'cached answer'}
+    namespaces = [f"gemini-2.0-flash-exp|{subject}|" for subject in ('science', 'math', 'history', 'general')]
+
+    checkpoints = sorted({1000, 10000, args.entries} & set(range(1, args.entries + 1)))
+    filled = 0
+    start = time.perf_counter()
+    for checkpoint in checkpoints:
+        while filled < checkpoint:
+            cache.add(make_question(filled), random.choice(namespaces), payload)
+            filled += 1
+        insert_seconds = time.perf_counter() - start
+
+        timings = []
+        for i in range(args.lookups):
+            question = make_question(random.randrange(filled))
+            t0 = time.perf_counter()
+            cache.lookup(question, random.choice(namespaces))
+            timings.append((time.perf_counter() - t0) * 1000)
+
+        print(f"entries={filled:>7}  insert_total={insert_seconds:6.2f}s  "
+              f"lookup p50={percentile(timings, 50):.3f}ms  p99={percentile(timings, 99):.3f}ms  "
+              f"index={cache.vectors.nbytes / 1e6:.0f}MB")
+        start = time.perf_counter()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Import and CLI startup time of func.py, checked against a budget
+
+Runs `python -X importtime -c "import func"` several times and reports the
+median cumulative import time of func with its slowest imports, plus the
+wall time of the bare usage message next to an empty interpreter. Exits
+non-zero when the median import time is over --budget-ms, so it can guard
+against a heavy import creeping back into module scope.
+
+Usage: python benchmarks/bench_startup.py [--runs 7] [--budget-ms 200]
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORTTIME_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def import_profile():
+    """{module: (self_us, cumulative_us)} for func and everything it imported, from one `import func`"""
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import func'],
+        cwd=SERVER_DIR, capture_output=True, text=True, check=True
+    )
+    profile = {}
+    for line in completed.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, module = match.groups()
+        if len(indent) == 1 and module != 'func':
+            # A finished top-level import before func (site and its imports)
+            profile.clear()
+            continue
+        profile[module] = (int(self_us), int(cumulative_us))
+    return profile
+
+
+def wall_time(args) -> float:
+    started = time.perf_counter()
+    subprocess.run([sys.executable] + args, cwd=SERVER_DIR, capture_output=True)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=7)
+    parser.add_argument('--budget-ms', type=float, default=200.0)
+    args = parser.parse_args()
+
+    # The first run may compile bytecode
+    import_profile()
+    profiles = [import_profile() for _ in range(args.runs)]
+    import_ms = statistics.median(profile['func'][1] for profile in profiles) / 1000
+
+    slowest = sorted(profiles[-1].items(), key=lambda item: item[1][1], reverse=True)
+    print("slowest imports under func (cumulative, last run):")
+    for module, (_, cumulative_us) in [item for item in slowest if item[0] != 'func'][:10]:
+        print(f"  {module:<40} {cumulative_us / 1000:8.1f} ms")
+
+    baseline_ms = statistics.median(wall_time(['-c', 'pass']) for _ in range(args.runs)) * 1000
+    usage_ms = statistics.median(wall_time(['func.py']) for _ in range(args.runs)) * 1000
+    print(f"\nimport func (median of {args.runs}):  {import_ms:8.1f} ms  (budget {args.budget_ms:.0f} ms)")
+    print(f"python -c pass:                {baseline_ms:8.1f} ms")
+    print(f"python func.py (usage):        {usage_ms:8.1f} ms")
+
+    if import_ms > args.budget_ms:
+        print(f"\nOVER BUDGET by {import_ms - args.budget_ms:.1f} ms")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""Local stand-in for genai.GenerativeModel, for load tests that spend no quota
+
+install() swaps the SDK's GenerativeModel for FakeGenerativeModel. Replies
+are generated from the response_schema of each call (STUDY_RESPONSE_SCHEMA
+or QUIZ_RESPONSE_SCHEMA), after a latency drawn from a configurable
+distribution, and a configurable share of calls fail with a 429 or return
+truncated JSON. install_context_cache() points the agent's context cache at
+FakeCachedContentBackend, which keeps cached contents in the config.
+"""
+import asyncio
+import json
+import random
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+WORDS = ('light energy is stored as sugar in the leaf while the plant takes in carbon dioxide and water '
+         'through small pores and releases oxygen as the result of the reaction').split()
+
+
+class LatencyDistribution:
+    """Seconds per call: 'fixed:MS', 'uniform:MIN_MS:MAX_MS' or 'lognormal:MEDIAN_MS:SIGMA'"""
+
+    def __init__(self, spec: str = 'lognormal:800:0.5'):
+        kind, *params = spec.split(':')
+        if kind not in ('fixed', 'uniform', 'lognormal') or len(params) != {'fixed': 1}.get(kind, 2):
+            raise ValueError(f"bad latency spec {spec!r}")
+        self.spec = spec
+        self.kind = kind
+        self.params = [float(param) for param in params]
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == 'fixed':
+            milliseconds = self.params[0]
+        elif self.kind == 'uniform':
+            milliseconds = rng.uniform(*self.params)
+        else:
+            median, sigma = self.params
+            milliseconds = median * rng.lognormvariate(0, sigma)
+        return milliseconds / 1000
+
+
+class FakeGeminiConfig:
+    """Behaviour shared by every FakeGenerativeModel, plus what they did"""
+
+    def __init__(self, latency: str = 'lognormal:800:0.5', rate_429: float = 0.0, malformed_rate: float = 0.0,
+                 retry_after_seconds: int = 1, seed: int = 7,
+                 schemas: Optional[Dict[str, Dict[str, Any]]] = None):
+        self.latency = LatencyDistribution(latency)
+        self.rate_429 = rate_429
+        self.malformed_rate = malformed_rate
+        self.retry_after_seconds = retry_after_seconds
+        # Used for JSON-mode calls that carry no response_schema (streaming), chosen by root property
+        self.schemas = schemas or {}
+        self.rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.counts = {'calls': 0, 'injected_429': 0, 'malformed': 0, 'ok': 0, 'plain_text': 0,
+                       'prompt_chars': 0, 'cached_calls': 0, 'cached_contents_created': 0}
+        self.calls_by_model: Dict[str, int] = {}
+        # cached content name -> (model name, system instruction)
+        self.cached_contents: Dict[str, Any] = {}
+
+    def draw(self, model_name: str):
+        """(latency seconds, outcome, reply rng) for one call; outcome is 'ok', 'injected_429' or 'malformed'"""
+        with self._lock:
+            self.counts['calls'] += 1
+            self.calls_by_model[model_name] = self.calls_by_model.get(model_name, 0) + 1
+            latency = self.latency.sample(self.rng)
+            roll = self.rng.random()
+            if roll < self.rate_429:
+                outcome = 'injected_429'
+            elif roll < self.rate_429 + self.malformed_rate:
+                outcome = 'malformed'
+            else:
+                outcome = 'ok'
+            self.counts[outcome] += 1
+            # A separate generator so sampling replies cannot shift the latency/outcome sequence
+            seed = self.rng.random()
+        return latency, outcome, random.Random(seed)
+
+    def count(self, name: str, value: int = 1):
+        with self._lock:
+            self.counts[name] += value
+
+    def count_plain_text(self):
+        self.count('plain_text')
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self.counts, calls_by_model=dict(self.calls_by_model))
+
+
+def sample_from_schema(schema: Dict[str, Any], rng: random.Random, name: str = '') -> Any:
+    """A value that validates against a (Gemini-style) JSON schema"""
+    if 'enum' in schema:
+        return rng.choice(schema['enum'])
+    kind = schema.get('type', 'string')
+    if kind == 'object':
+        return {key: sample_from_schema(sub, rng, key) for key, sub in schema.get('properties', {}).items()}
+    if kind == 'array':
+        return [sample_from_schema(schema.get('items', {}), rng, name) for _ in range(rng.randint(1, 3))]
+    if kind == 'integer':
+        return rng.randint(int(schema.get('minimum', 0)), int(schema.get('maximum', 100)))
+    if kind == 'number':
+        return round(rng.uniform(schema.get('minimum', 0), schema.get('maximum', 100)), 2)
+    if kind == 'boolean':
+        return rng.random() < 0.5
+    sentences = rng.randint(3, 8) if name == 'response_text' else 1
+    return ' '.join(
+        ' '.join(rng.choice(WORDS) for _ in range(rng.randint(6, 14))).capitalize() + '.'
+        for _ in range(sentences)
+    )
+
+
+class FakeResponse:
+    def __init__(self, text: str):
+        self.text = text
+        self.usage_metadata = SimpleNamespace(total_token_count=len(text) // 4)
+
+
+class FakeCachedContentBackend:
+    """ContextCache backend that registers cached contents in a FakeGeminiConfig
+
+    Prefixes under `min_tokens` (about four characters a token) are refused
+    the way the API refuses content under a model's minimum cache size.
+    """
+
+    def __init__(self, config: FakeGeminiConfig, min_tokens: int = 0):
+        self.config = config
+        self.min_tokens = min_tokens
+
+    def create(self, api_key: str, model_name: str, system_instruction: str, ttl_seconds: float):
+        if len(system_instruction) // 4 < self.min_tokens:
+            raise Exception(f"400 Cached content is too small. min_total_token_count={self.min_tokens}")
+        with self.config._lock:
+            name = f"cachedContents/fake-{len(self.config.cached_contents) + 1}"
+            self.config.cached_contents[name] = (model_name, system_instruction)
+            self.config.counts['cached_contents_created'] += 1
+        return name, time.time() + ttl_seconds
+
+    def extend(self, api_key: str, name: str, ttl_seconds: float) -> float:
+        if name not in self.config.cached_contents:
+            raise Exception(f"404 CachedContent not found: {name}")
+        return time.time() + ttl_seconds
+
+
+class FakeGenerativeModel:
+    """Drop-in for genai.GenerativeModel: generate_content(_async), optionally streamed"""
+
+    config = FakeGeminiConfig()
+    # Set by the agent for calls that reference cached content
+    _cached_content = None
+
+    def __init__(self, model_name: str, **kwargs):
+        self.model_name = model_name
+
+    def _full_prompt(self, prompt: str) -> str:
+        """The prompt as the model sees it: cached system instruction first"""
+        self.config.count('prompt_chars', len(prompt))
+        if self._cached_content is None:
+            return prompt
+        cached = self.config.cached_contents.get(self._cached_content)
+        if cached is None or cached[0] != self.model_name:
+            raise Exception(f"404 CachedContent not found: {self._cached_content}")
+        self.config.count('cached_calls')
+        return cached[1] + prompt
+
+    def _schema_for(self, prompt: str, generation_config) -> Optional[Dict[str, Any]]:
+        if generation_config is None or getattr(generation_config, 'response_mime_type', None) != 'application/json':
+            return None
+        schema = getattr(generation_config, 'response_schema', None)
+        if schema:
+            return schema
+        # The streaming prompt embeds its schema; pick the one whose distinctive root property it names
+        for root_property, candidate in self.config.schemas.items():
+            if f'"{root_property}"' in prompt:
+                return candidate
+        return next(iter(self.config.schemas.values()), None)
+
+    def _reply(self, prompt: str, generation_config, outcome: str, rng: random.Random) -> str:
+        if outcome == 'injected_429':
+            raise Exception("429 Resource has been exhausted (e.g. check quota). "
+                            f"retry_delay {{\n seconds: {self.config.retry_after_seconds}\n}}")
+        schema = self._schema_for(prompt, generation_config)
+        if schema is None:
+            self.config.count_plain_text()
+            return sample_from_schema({'type': 'string'}, rng, 'response_text')
+        text = json.dumps(sample_from_schema(schema, rng))
+        if outcome == 'malformed':
+            text = text[:rng.randint(1, len(text) - 1)]
+        return text
+
+    def _chunks(self, text: str) -> List[FakeResponse]:
+        return [FakeResponse(text[i:i + 24]) for i in range(0, len(text), 24)]
+
+    def generate_content(self, prompt, generation_config=None, stream: bool = False, **kwargs):
+        prompt = self._full_prompt(str(prompt))
+        latency, outcome, rng = self.config.draw(self.model_name)
+        time.sleep(latency)
+        text = self._reply(str(prompt), generation_config, outcome, rng)
+        return self._chunks(text) if stream else FakeResponse(text)
+
+    async def generate_content_async(self, prompt, generation_config=None, stream: bool = False, **kwargs):
+        prompt = self._full_prompt(str(prompt))
+        latency, outcome, rng = self.config.draw(self.model_name)
+        await asyncio.sleep(latency)
+        text = self._reply(str(prompt), generation_config, outcome, rng)
+        if not stream:
+            return FakeResponse(text)
+
+        async def chunks():
+            for chunk in self._chunks(text):
+                await asyncio.sleep(0)
+                yield chunk
+        return chunks()
+
+
+def install(genai_module, config: FakeGeminiConfig) -> FakeGeminiConfig:
+    """Route every GenerativeModel the agent builds to the fake"""
+    FakeGenerativeModel.config = config
+    genai_module.GenerativeModel = FakeGenerativeModel
+    return config
+
+
+def install_context_cache(context_cache, config: FakeGeminiConfig, min_tokens: int = 0) -> FakeCachedContentBackend:
+    """Back an agent's ContextCache with the fake instead of the Gemini cache service"""
+    context_cache.backend = FakeCachedContentBackend(config, min_tokens)
+    return context_cache.backend
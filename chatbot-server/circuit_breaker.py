@@ -0,0 +1,170 @@
+import asyncio
+import datetime
+import re
+from typing import Any, Dict, Optional, Union
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Error kinds (classify_error)
+RATE_LIMITED = 'rate_limited'
+DAILY_QUOTA = 'daily_quota'
+AUTH = 'auth'
+SERVER = 'server'
+NOT_FOUND = 'not_found'
+REQUEST = 'request'
+# Kinds another key may not hit, so the call is retried on the next one
+KEY_ERRORS = (RATE_LIMITED, DAILY_QUOTA, AUTH)
+
+try:
+    from zoneinfo import ZoneInfo
+    # Gemini daily quotas reset at midnight Pacific time
+    QUOTA_TIMEZONE = ZoneInfo('America/Los_Angeles')
+except Exception:
+    # No tz database: Pacific standard time is close enough to schedule a probe
+    QUOTA_TIMEZONE = datetime.timezone(datetime.timedelta(hours=-8))
+
+
+# gRPC status names google.api_core errors and messages use, as HTTP statuses
+STATUS_CODES = {'RESOURCE_EXHAUSTED': 429, 'UNAUTHENTICATED': 401, 'PERMISSION_DENIED': 403, 'NOT_FOUND': 404,
+                'INTERNAL': 500, 'UNAVAILABLE': 503, 'DEADLINE_EXCEEDED': 504}
+# "429 Resource has been exhausted", "status: 503", "HTTP 404"; not any three digits in the text
+STATUS_IN_MESSAGE = re.compile(r'^\s*([1-5]\d\d)\b|\b(?:status(?:[ _]code)?|http|code)\s*[:=]?\s*([1-5]\d\d)\b', re.IGNORECASE)
+STATUS_NAME_IN_MESSAGE = re.compile(r'\b(' + '|'.join(STATUS_CODES) + r')\b')
+
+
+def error_status(error: Union[BaseException, str]) -> Optional[int]:
+    """HTTP status of a failed call: the exception's own code, else one its message states"""
+    if isinstance(error, BaseException):
+        for attr in ('code', 'status_code'):
+            code = getattr(error, attr, None)
+            if isinstance(code, int) and 100 <= code < 600:
+                return code
+            # grpc.StatusCode
+            if getattr(code, 'name', None) in STATUS_CODES:
+                return STATUS_CODES[code.name]
+    message = str(error)
+    match = STATUS_IN_MESSAGE.search(message)
+    if match:
+        return int(match.group(1) or match.group(2))
+    match = STATUS_NAME_IN_MESSAGE.search(message)
+    return STATUS_CODES[match.group(1)] if match else None
+
+
+def classify_error(error: Union[BaseException, str]) -> str:
+    """What a failed call says about the key and model it ran on
+
+    rate_limited / daily_quota: out of quota until a refill or the daily reset;
+    auth: the key itself is bad; not_found: the model does not exist (for
+    this key); server: the model is failing or overloaded; request: the
+    request was at fault, the key and model are fine. Judged by the status
+    code, then by the wording Gemini uses for each.
+    """
+    status = error_status(error)
+    lower = str(error).lower()
+    if status == 429 or any(marker in lower for marker in ('resource has been exhausted', 'quota', 'rate limit')):
+        compact = lower.replace(' ', '').replace('_', '')
+        return DAILY_QUOTA if 'perday' in compact or 'daily' in compact else RATE_LIMITED
+    if status in (401, 403) or any(marker in lower for marker in ('api key not valid', 'api_key_invalid', 'permission_denied',
+                                                                  'permission denied', 'unauthenticated')):
+        return AUTH
+    if status == 404 or re.search(r'\bmodels?/\S+ (?:is )?not found', lower):
+        return NOT_FOUND
+    if (status is not None and status >= 500) or isinstance(error, (TimeoutError, asyncio.TimeoutError)) or any(
+            marker in lower for marker in ('internal error', 'unavailable', 'overloaded', 'deadline exceeded', 'timed out')):
+        return SERVER
+    return REQUEST
+
+
+def seconds_until_quota_reset(now: Optional[datetime.datetime] = None) -> float:
+    """Seconds until the next daily quota reset (midnight Pacific)"""
+    now = now or datetime.datetime.now(QUOTA_TIMEZONE)
+    midnight = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time(), tzinfo=QUOTA_TIMEZONE)
+    return max((midnight - now).total_seconds(), 1.0)
+
+
+class CircuitBreaker:
+    """Health of one key and model: closed, open, then half-open for a single probe call
+
+    Opens on a rate limit or bad key right away (for the retry delay, until
+    the daily quota reset, or for `open_seconds` doubling per consecutive
+    trip up to `max_open_seconds`) and after `failure_threshold` server
+    errors in a row. Once the open period is over, the next call is let
+    through as a probe; its success closes the breaker, its failure opens
+    it again for longer. A probe that never reports back is replaced after
+    `probe_timeout_seconds`.
+    """
+
+    __slots__ = ('failure_threshold', 'open_seconds', 'max_open_seconds', 'probe_timeout_seconds',
+                 'state', 'failures', 'trips', 'open_until', 'probe_started', 'reason', 'last_error')
+
+    def __init__(self, failure_threshold: int = 3, open_seconds: float = 30.0, max_open_seconds: float = 600.0,
+                 probe_timeout_seconds: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.probe_timeout_seconds = probe_timeout_seconds
+        self.state = CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0.0
+        self.probe_started: Optional[float] = None
+        self.reason: Optional[str] = None
+        self.last_error: Optional[str] = None
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until a call may go through (0 when closed or a probe is due)"""
+        if self.state == CLOSED:
+            return 0.0
+        if now < self.open_until:
+            return self.open_until - now
+        if self.probe_started is not None and now - self.probe_started < self.probe_timeout_seconds:
+            return self.probe_started + self.probe_timeout_seconds - now
+        return 0.0
+
+    def on_acquire(self, now: float):
+        """A call was let through; past the open period it is the half-open probe"""
+        if self.state != CLOSED and now >= self.open_until:
+            self.state = HALF_OPEN
+            self.probe_started = now
+
+    def record_success(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.probe_started = None
+        self.reason = None
+
+    def record_failure(self, now: float, kind: str, error: str):
+        """A server error; opens after enough in a row, or at once if it was the probe"""
+        self.failures += 1
+        self.last_error = error
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.trip(now, kind, error)
+
+    def trip(self, now: float, kind: str, error: str, open_for: Optional[float] = None):
+        """Open now, for `open_for` seconds or the backoff for this many consecutive trips"""
+        if open_for is None:
+            open_for = min(self.open_seconds * 2 ** self.trips, self.max_open_seconds)
+        self.trips += 1
+        self.state = OPEN
+        self.open_until = max(self.open_until, now + open_for)
+        self.probe_started = None
+        self.failures = 0
+        self.reason = kind
+        self.last_error = error
+
+    def snapshot(self, now: float) -> Dict[str, Any]:
+        state = self.state
+        if state == OPEN and now >= self.open_until:
+            # Open period over, the next call probes
+            state = HALF_OPEN
+        return {
+            'state': state,
+            'reason': self.reason,
+            'retry_in_seconds': round(max(self.open_until - now, 0.0), 1) if state == OPEN else 0.0,
+            'consecutive_failures': self.failures,
+            'trips': self.trips,
+            'last_error': self.last_error[:200] if self.last_error else None,
+        }
@@ -0,0 +1,150 @@
+import asyncio
+import datetime
+import sys
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from prompt_builder import estimate_tokens
+
+
+class GeminiCachedContentBackend:
+    """Creates and extends cached contents through each key's own CacheServiceClient
+
+    Cached contents belong to the project of the key that created them, so
+    every key registers its own copy.
+    """
+
+    def __init__(self):
+        self._clients: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def _client(self, api_key: str):
+        from google.ai import generativelanguage as glm
+
+        with self._lock:
+            if api_key not in self._clients:
+                self._clients[api_key] = glm.CacheServiceClient(client_options={'api_key': api_key})
+            return self._clients[api_key]
+
+    def create(self, api_key: str, model_name: str, system_instruction: str, ttl_seconds: float) -> Tuple[str, float]:
+        """(cached content name, expiry as a time.time() value)"""
+        from google.ai import generativelanguage as glm
+
+        cached = self._client(api_key).create_cached_content(cached_content=glm.CachedContent(
+            model=f"models/{model_name}",
+            system_instruction=glm.Content(parts=[glm.Part(text=system_instruction)]),
+            ttl=datetime.timedelta(seconds=ttl_seconds)
+        ))
+        return cached.name, time.time() + ttl_seconds
+
+    def extend(self, api_key: str, name: str, ttl_seconds: float) -> float:
+        """Push back the expiry of an existing cached content; returns the new expiry"""
+        from google.ai import generativelanguage as glm
+
+        self._client(api_key).update_cached_content(
+            cached_content=glm.CachedContent(name=name, ttl=datetime.timedelta(seconds=ttl_seconds)),
+            update_mask={'paths': ['ttl']}
+        )
+        return time.time() + ttl_seconds
+
+
+class CachedPrefix:
+    __slots__ = ('name', 'expires_at', 'tokens')
+
+    def __init__(self, name: str, expires_at: float, tokens: int):
+        self.name = name
+        self.expires_at = expires_at
+        self.tokens = tokens
+
+
+class ContextCache:
+    """Server-side cached contents for the constant prompt prefixes, per (key, model, prefix)
+
+    lookup() returns the name of a cached content holding `prefix` for that
+    key and model, registering it on first use and extending it once it is
+    within `refresh_margin_seconds` of expiry, so requests only send the
+    per-turn rest of the prompt. Returns None (send the whole prompt) while
+    another request is registering it, or for `failure_backoff_seconds`
+    after the API refused, e.g. a prefix under the model's minimum size
+    for cached content.
+    """
+
+    def __init__(self, backend, ttl_seconds: float = 3600, refresh_margin_seconds: float = 300,
+                 failure_backoff_seconds: float = 1800):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self.failure_backoff_seconds = failure_backoff_seconds
+        self._entries: Dict[Tuple[int, str, str], CachedPrefix] = {}
+        self._failed_until: Dict[Tuple[str, str], float] = {}
+        self._pending = set()
+        self._lock = threading.Lock()
+        self.stats_counts = {'hits': 0, 'misses': 0, 'created': 0, 'extended': 0, 'failures': 0}
+
+    def _fresh(self, key: Tuple[int, str, str], now: float) -> Optional[CachedPrefix]:
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at - now > self.refresh_margin_seconds:
+            return entry
+        return None
+
+    def lookup(self, client, model_name: str, prefix: str) -> Optional[CachedPrefix]:
+        """The cached content for this key, model and prefix, registering or extending it if needed"""
+        key = (client.index, model_name, prefix)
+        now = time.time()
+        with self._lock:
+            entry = self._fresh(key, now)
+            if entry is not None:
+                self.stats_counts['hits'] += 1
+                return entry
+            entry = self._entries.get(key)
+            usable = entry if entry is not None and entry.expires_at > now + 5 else None
+            if key in self._pending or self._failed_until.get((model_name, prefix), 0) > now:
+                self.stats_counts['hits' if usable else 'misses'] += 1
+                return usable
+            self._pending.add(key)
+
+        try:
+            if usable is not None:
+                try:
+                    usable.expires_at = self.backend.extend(client.api_key, usable.name, self.ttl_seconds)
+                    self.stats_counts['extended'] += 1
+                    return usable
+                except Exception as e:
+                    print(f"Extending cached content {usable.name} failed, registering a new one: {e}", file=sys.stderr)
+            name, expires_at = self.backend.create(client.api_key, model_name, prefix, self.ttl_seconds)
+            entry = CachedPrefix(name, expires_at, estimate_tokens(prefix))
+            with self._lock:
+                self._entries[key] = entry
+                self.stats_counts['created'] += 1
+            return entry
+        except Exception as e:
+            print(f"Context cache for {model_name} on key {client.index} unavailable: {e}", file=sys.stderr)
+            with self._lock:
+                self._failed_until[(model_name, prefix)] = time.time() + self.failure_backoff_seconds
+                self.stats_counts['failures'] += 1
+            return None
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    async def lookup_async(self, client, model_name: str, prefix: str) -> Optional[CachedPrefix]:
+        """lookup() that keeps registration round trips off the event loop"""
+        with self._lock:
+            entry = self._fresh((client.index, model_name, prefix), time.time())
+            if entry is not None:
+                self.stats_counts['hits'] += 1
+                return entry
+        return await asyncio.to_thread(self.lookup, client, model_name, prefix)
+
+    def forget(self, name: str):
+        """Drop an entry the API no longer knows (expired or deleted early)"""
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry.name == name:
+                    del self._entries[key]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self.stats_counts, entries=len(self._entries),
+                        refused_prefixes=sum(until > time.time() for until in self._failed_until.values()))
@@ -0,0 +1,310 @@
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+from prompt_builder import estimate_tokens, fit_context
+
+# Longest stored text of one side of a turn
+MAX_TURN_CHARS = 600
+# Most concepts / quiz results kept per chat
+MAX_CONCEPTS = 12
+MAX_QUIZ_RESULTS = 5
+# Most questions kept of the quiz waiting for answers
+MAX_QUIZ_QUESTIONS = 10
+
+
+def clip(text: str, max_chars: int) -> str:
+    text = re.sub(r'\s+', ' ', text or '').strip()
+    return text if len(text) <= max_chars else text[:max_chars - 3].rstrip() + '...'
+
+
+def format_history(history: Optional[List[Dict[str, Any]]]) -> str:
+    """A chat's stored messages as "role: text" lines, the transcript callers without memory get"""
+    return '\n'.join(f"{message.get('role')}: {message.get('text') or '[Audio message]'}"
+                     for message in history or [] if isinstance(message, dict))
+
+
+def summarize_turn(turn: Dict[str, str]) -> str:
+    """One line for a turn leaving the recent window: what the student asked, not the whole answer"""
+    return clip(turn['user'], 100)
+
+
+class ChatMemory:
+    """Recent turns, rolling summary, key concepts, the open quiz and quiz outcomes of one chat"""
+
+    def __init__(self, state: Optional[Dict[str, Any]] = None):
+        state = state or {}
+        self.turns: List[Dict[str, str]] = state.get('turns', [])
+        self.summary: List[str] = state.get('summary', [])
+        self.summarized_turns: int = state.get('summarized_turns', 0)
+        self.concepts: List[str] = state.get('concepts', [])
+        self.quiz_results: List[Dict[str, Any]] = state.get('quiz_results', [])
+        # Questions (with correct answers) of the last quiz issued and not yet graded
+        self.quiz: List[Dict[str, Any]] = state.get('quiz', [])
+        self.subject: Optional[str] = state.get('subject')
+        self.mastery: Optional[str] = state.get('mastery')
+        self.updated_at: float = state.get('updated_at', 0.0)
+
+    def to_state(self) -> Dict[str, Any]:
+        return {
+            'turns': self.turns, 'summary': self.summary, 'summarized_turns': self.summarized_turns,
+            'concepts': self.concepts, 'quiz_results': self.quiz_results, 'quiz': self.quiz,
+            'subject': self.subject, 'mastery': self.mastery, 'updated_at': self.updated_at,
+        }
+
+
+class SQLiteMemoryBackend:
+    """Durable tier: one JSON row per chat, so memory survives worker restarts and LRU eviction"""
+
+    def __init__(self, db_path: str):
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS chat_memory (chat_id TEXT PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL)'
+        )
+        self._conn.commit()
+
+    def get(self, chat_id: str) -> Optional[Dict[str, Any]]:
+        row = self._conn.execute('SELECT state FROM chat_memory WHERE chat_id = ?', (chat_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, chat_id: str, state: Dict[str, Any]):
+        self._conn.execute(
+            'INSERT OR REPLACE INTO chat_memory (chat_id, state, updated_at) VALUES (?, ?, ?)',
+            (chat_id, json.dumps(state, ensure_ascii=False), state['updated_at'])
+        )
+        self._conn.commit()
+
+    def delete(self, chat_id: str):
+        self._conn.execute('DELETE FROM chat_memory WHERE chat_id = ?', (chat_id,))
+        self._conn.commit()
+
+
+class ConversationMemory:
+    """Per-chat conversation memory that keeps prompt context a bounded size
+
+    After each turn the chat's memory records the exchange, the key concepts
+    taught, mastery and quiz outcomes. Turns beyond `max_recent_turns` are
+    folded into a rolling summary (one line each, via `summarizer`), and
+    build_context() assembles the memory plus the caller's own context within
+    `token_budget`: profile first, then the newest turns, the summary, and
+    finally as much of the caller's context as still fits (its tail).
+
+    Recently used chats stay in memory (LRU, `max_chats`); every update is
+    also written to SQLite when `db_path` is set, so evicted chats and
+    restarts lose nothing. The database is opened on first use, so a
+    process that never sees a chat_id never creates it.
+    """
+
+    def __init__(self, db_path: Optional[str] = None, max_chats: int = 1000, max_recent_turns: int = 6,
+                 token_budget: int = 1500, max_summary_lines: int = 20,
+                 summarizer: Callable[[Dict[str, str]], str] = summarize_turn):
+        self.db_path = db_path
+        self._disk: Optional[SQLiteMemoryBackend] = None
+        self.max_chats = max_chats
+        self.max_recent_turns = max_recent_turns
+        self.token_budget = token_budget
+        self.max_summary_lines = max_summary_lines
+        self.summarizer = summarizer
+        self._chats: 'OrderedDict[str, ChatMemory]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_loads = 0
+        self.evictions = 0
+
+    @property
+    def disk(self) -> Optional[SQLiteMemoryBackend]:
+        if self._disk is None and self.db_path:
+            try:
+                os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+                self._disk = SQLiteMemoryBackend(self.db_path)
+            except (OSError, sqlite3.Error) as e:
+                # Keep remembering chats in-process rather than failing their turns
+                print(f"Conversation memory DB {self.db_path} unavailable, keeping memory in-process: {e}",
+                      file=sys.stderr)
+                self.db_path = None
+        return self._disk
+
+    def _get(self, chat_id: str) -> Optional[ChatMemory]:
+        memory = self._chats.get(chat_id)
+        if memory is not None:
+            self._chats.move_to_end(chat_id)
+            self.hits += 1
+            return memory
+        state = self.disk.get(chat_id) if self.disk else None
+        if state is None:
+            return None
+        self.disk_loads += 1
+        memory = self._chats[chat_id] = ChatMemory(state)
+        self._evict()
+        return memory
+
+    def _evict(self):
+        while len(self._chats) > self.max_chats:
+            # Already on disk (written through), so dropping it only costs a reload
+            self._chats.popitem(last=False)
+            self.evictions += 1
+
+    def _append_turn(self, memory: ChatMemory, user_message: str, response_text: str):
+        memory.turns.append({
+            'user': clip(user_message, MAX_TURN_CHARS),
+            'assistant': clip(response_text, MAX_TURN_CHARS),
+        })
+        while len(memory.turns) > self.max_recent_turns:
+            memory.summary.append(self.summarizer(memory.turns.pop(0)))
+            memory.summarized_turns += 1
+        del memory.summary[:-self.max_summary_lines]
+
+    def seed(self, chat_id: str, history: List[Dict[str, Any]]) -> bool:
+        """Start a chat's memory from its stored messages ({role, text}, oldest first) the first time it is seen
+
+        Returns False (and changes nothing) if the chat already has a memory.
+        """
+        chat_id = str(chat_id)
+        with self._lock:
+            if self._get(chat_id) is not None:
+                return False
+            memory = self._chats[chat_id] = ChatMemory()
+            self._evict()
+            asked = None
+            for message in history:
+                if not isinstance(message, dict):
+                    continue
+                text = message.get('text') or '[Audio message]'
+                if (message.get('role') or '').lower() == 'user':
+                    if asked is not None:
+                        self._append_turn(memory, asked, '')
+                    asked = text
+                elif asked is not None:
+                    self._append_turn(memory, asked, text)
+                    asked = None
+            if asked is not None:
+                self._append_turn(memory, asked, '')
+            memory.updated_at = time.time()
+            if self.disk:
+                self.disk.set(chat_id, memory.to_state())
+            return True
+
+    def record_turn(self, chat_id: str, user_message: str, result: Dict[str, Any]):
+        """Add a finished turn (a generate_response result) to the chat's memory"""
+        chat_id = str(chat_id)
+        data = result.get('structured_data') or {}
+        with self._lock:
+            memory = self._get(chat_id)
+            if memory is None:
+                memory = self._chats[chat_id] = ChatMemory()
+                self._evict()
+
+            self._append_turn(memory, user_message, result.get('response_text', ''))
+
+            for concept in data.get('phase_2_teaching', {}).get('key_concepts', []):
+                if concept in memory.concepts:
+                    memory.concepts.remove(concept)
+                memory.concepts.append(concept)
+            del memory.concepts[:-MAX_CONCEPTS]
+
+            evaluation = data.get('quiz_evaluation')
+            if evaluation:
+                memory.quiz_results.append({
+                    'score': evaluation.get('overall_score'),
+                    'performance': evaluation.get('performance_level'),
+                })
+                del memory.quiz_results[:-MAX_QUIZ_RESULTS]
+                memory.quiz = []
+
+            questions = data.get('phase_3_assessment', {}).get('quiz_questions')
+            if questions:
+                memory.quiz = [{
+                    'question': clip(question.get('question', ''), MAX_TURN_CHARS),
+                    'type': question.get('type'),
+                    'correct_answer': question.get('correct_answer', ''),
+                    'explanation': clip(question.get('explanation', ''), MAX_TURN_CHARS),
+                } for question in questions[:MAX_QUIZ_QUESTIONS] if isinstance(question, dict)]
+
+            memory.mastery = data.get('phase_4_next_steps', {}).get('mastery_level', memory.mastery)
+            memory.subject = (result.get('learning_insights') or {}).get('subject_area', memory.subject)
+            memory.updated_at = time.time()
+            if self.disk:
+                self.disk.set(chat_id, memory.to_state())
+
+    def issued_quiz(self, chat_id: str) -> List[Dict[str, Any]]:
+        """The chat's open quiz: question, type, correct_answer and explanation per question"""
+        with self._lock:
+            memory = self._get(str(chat_id))
+            return list(memory.quiz) if memory is not None else []
+
+    def build_context(self, chat_id: str, caller_context: str = '') -> str:
+        """Context for the next prompt of this chat, within the token budget"""
+        with self._lock:
+            memory = self._get(str(chat_id))
+            if memory is None:
+                return fit_context(caller_context, self.token_budget)[0]
+
+            profile = []
+            if memory.subject:
+                profile.append(f"Subject: {memory.subject}")
+            if memory.mastery:
+                profile.append(f"Mastery: {memory.mastery}")
+            if memory.concepts:
+                profile.append(f"Key concepts covered: {', '.join(memory.concepts)}")
+            if memory.quiz_results:
+                profile.append("Recent quiz results: " + ', '.join(
+                    f"{result['score']} ({result['performance']})" for result in memory.quiz_results
+                ))
+            sections = [' | '.join(profile)] if profile else []
+            remaining = self.token_budget - sum(estimate_tokens(section) + 1 for section in sections)
+
+            # Newest turns first, as many as fit
+            recent = []
+            for turn in reversed(memory.turns):
+                text = f"Student: {turn['user']}\nTutor: {turn['assistant']}"
+                if estimate_tokens(text) + 1 > remaining:
+                    break
+                recent.insert(0, text)
+                remaining -= estimate_tokens(text) + 1
+
+            summary = ''
+            if memory.summary:
+                lines = list(memory.summary)
+                older = memory.summarized_turns - len(lines)
+                while lines:
+                    summary = "Earlier in this chat the student asked about: " + '; '.join(lines)
+                    if older > 0:
+                        summary += f" (and {older} earlier questions)"
+                    if estimate_tokens(summary) + 1 <= remaining:
+                        break
+                    lines.pop(0)
+                    older += 1
+                    summary = ''
+                remaining -= estimate_tokens(summary) + 1 if summary else 0
+
+        if summary:
+            sections.append(summary)
+        if recent:
+            sections.append("Recent conversation:\n" + '\n'.join(recent))
+        caller_context = fit_context(caller_context, remaining)[0]
+        if caller_context:
+            sections.append(caller_context)
+        return '\n'.join(sections)
+
+    def forget(self, chat_id: str):
+        with self._lock:
+            self._chats.pop(str(chat_id), None)
+            if self.disk:
+                self.disk.delete(str(chat_id))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'chats_in_memory': len(self._chats),
+                'hits': self.hits,
+                'disk_loads': self.disk_loads,
+                'evictions': self.evictions,
+                'token_budget': self.token_budget,
+            }
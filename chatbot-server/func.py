@@ -1,44 +1,179 @@
-import google.generativeai as genai
-from google.generativeai import types
-import wave
 import time
+import asyncio
+import atexit
+import concurrent.futures
 import sys
 import random
 import json
 import re
 import os
+import signal
+import threading
 from datetime import datetime
 from typing import Dict, List, Optional, Any
 from dotenv import load_dotenv
+from batch import run_batch
+from circuit_breaker import DAILY_QUOTA, KEY_ERRORS, NOT_FOUND, RATE_LIMITED, SERVER, classify_error
+from classifier import MessageClassifier
+from ipc_frames import encode_framed
+from key_pool import ApiKeyClient, ApiKeyPool, KeyPoolExhausted
+from metrics import Metrics
+from model_router import ModelRouter, RoutePlan
+from prefetch import Prefetcher
+from prompt_builder import PromptBuilder, estimate_tokens
+from quiz_grader import QuizGrading, parse_answers
+from response_cache import ResponseCache
+from semantic_cache import SEMANTIC_CACHE_AVAILABLE, SemanticCache
+from single_flight import SingleFlight, coalesce_key
+from streaming import ResponseTextStreamExtractor
+from admission import PRIORITY_AUDIO, PRIORITY_NEW, PRIORITY_PREFETCH, PRIORITY_QUIZ, AdmissionController, AdmissionTicket
+from audio_cache import AudioSegmentCache
+from context_cache import CachedPrefix, ContextCache, GeminiCachedContentBackend
+from conversation_memory import ConversationMemory, format_history
+from tts import AudioPipeline, create_tts_backend
+from wav_writer import WavWriter, write_silent_wav
 load_dotenv()
 
-# Ensure uploads directory exists
-os.makedirs('uploads', exist_ok=True)
+# google.generativeai takes about a second to import; it is loaded on the first API call
+_genai = None
+
+def get_genai():
+    """The google.generativeai module, imported on first use"""
+    global _genai
+    if _genai is None:
+        import google.generativeai as genai_module
+        _genai = genai_module
+    return _genai
 
-# Configuration - Use environment variables for API keys in production
 # Configuration - Load API keys from environment variables
-GOOGLE_API_KEYS = []
-for i in range(1, 8):  # Assuming you have 7 keys
-    key = os.getenv(f'GOOGLE_API_KEY_{i}')
-    if key:
-        GOOGLE_API_KEYS.append(key)
-
-# Fallback to a single key if individual keys aren't set
-if not GOOGLE_API_KEYS:
-    single_key = os.getenv('GOOGLE_API_KEY')
-    if single_key:
-        GOOGLE_API_KEYS = [single_key]
-    else:
-        raise ValueError("No Google API keys found in environment variables")
+def load_api_keys() -> List[str]:
+    """Read GOOGLE_API_KEY_1..7, falling back to a single GOOGLE_API_KEY"""
+    api_keys = []
+    for i in range(1, 8):  # Assuming you have 7 keys
+        key = os.getenv(f'GOOGLE_API_KEY_{i}')
+        if key:
+            api_keys.append(key)
+    
+    # Fallback to a single key if individual keys aren't set
+    if not api_keys:
+        single_key = os.getenv('GOOGLE_API_KEY')
+        if single_key:
+            api_keys = [single_key]
+        else:
+            raise ValueError("No Google API keys found in environment variables")
+    return api_keys
+
+# Per-key quota budgets (defaults match the Gemini Flash free tier)
+RPM_PER_KEY = int(os.getenv('GEMINI_RPM_PER_KEY', '15'))
+TPM_PER_KEY = int(os.getenv('GEMINI_TPM_PER_KEY', '1000000'))
+# Longest a call waits for any key's budget to refill before giving up
+KEY_POOL_MAX_WAIT_SECONDS = float(os.getenv('KEY_POOL_MAX_WAIT_SECONDS', '30'))
+# Per key and model circuit breaker: server errors in a row before it opens, first open period
+# (doubling per consecutive trip up to the max), and how long a half-open probe may take
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '3'))
+CIRCUIT_OPEN_SECONDS = float(os.getenv('CIRCUIT_OPEN_SECONDS', '30'))
+CIRCUIT_MAX_OPEN_SECONDS = float(os.getenv('CIRCUIT_MAX_OPEN_SECONDS', '600'))
+CIRCUIT_PROBE_TIMEOUT_SECONDS = float(os.getenv('CIRCUIT_PROBE_TIMEOUT_SECONDS', '30'))
+# Output tokens reserved per call until the actual usage is known
+EXPECTED_OUTPUT_TOKENS = 1024
+# Estimated tokens of caller context kept in a prompt; longer contexts keep their newest lines
+PROMPT_CONTEXT_TOKEN_BUDGET = int(os.getenv('PROMPT_CONTEXT_TOKEN_BUDGET', '2000'))
+# Register the constant instructions (and streamed schema) as Gemini cached content, per key and model,
+# so calls send only the per-turn part. The API refuses prefixes under the model's minimum cache size.
+CONTEXT_CACHE_ENABLED = os.getenv('CONTEXT_CACHE_ENABLED', 'false').lower() == 'true'
+CONTEXT_CACHE_TTL_SECONDS = float(os.getenv('CONTEXT_CACHE_TTL_SECONDS', '3600'))
+CONTEXT_CACHE_REFRESH_MARGIN_SECONDS = float(os.getenv('CONTEXT_CACHE_REFRESH_MARGIN_SECONDS', '300'))
+
+# Upper bound on concurrent in-flight Gemini calls for the async path
+MAX_CONCURRENT_REQUESTS = int(os.getenv('MAX_CONCURRENT_REQUESTS', '64'))
+
+# Hedged generation: race a plain-text call against the JSON-schema call
+HEDGED_GENERATION_ENABLED = os.getenv('HEDGED_GENERATION_ENABLED', 'false').lower() == 'true'
+HEDGE_DELAY_SECONDS = float(os.getenv('HEDGE_DELAY_SECONDS', '3'))
+
+# Exact-match response cache (set RESPONSE_CACHE_DB to keep entries across restarts)
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'true').lower() == 'true'
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv('RESPONSE_CACHE_TTL_SECONDS', str(6 * 3600)))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '2048'))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+RESPONSE_CACHE_DB = os.getenv('RESPONSE_CACHE_DB')
+
+# Identical questions in flight at the same time share one Gemini call
+COALESCE_REQUESTS_ENABLED = os.getenv('COALESCE_REQUESTS_ENABLED', 'true').lower() == 'true'
+
+# Grade answers to a chat's last quiz in-process when every question is multiple choice, true/false or
+# a calculation; otherwise the model grades with the answer key in its context
+LOCAL_QUIZ_GRADING_ENABLED = os.getenv('LOCAL_QUIZ_GRADING_ENABLED', 'true').lower() == 'true'
+# model_used of locally graded turns
+LOCAL_GRADER_MODEL = 'local-quiz-grader'
+
+# Worker mode: after a study turn in a chat, answer its first suggested next topics in the background
+# while the keys have this share of their budget free; used if the student asks for one next
+PREFETCH_ENABLED = os.getenv('PREFETCH_ENABLED', 'false').lower() == 'true'
+PREFETCH_MAX_TOPICS = int(os.getenv('PREFETCH_MAX_TOPICS', '2'))
+PREFETCH_MIN_HEADROOM = float(os.getenv('PREFETCH_MIN_HEADROOM', '0.5'))
+PREFETCH_TTL_SECONDS = float(os.getenv('PREFETCH_TTL_SECONDS', '600'))
+
+# Semantic cache for paraphrased study questions (needs numpy)
+SEMANTIC_CACHE_ENABLED = os.getenv('SEMANTIC_CACHE_ENABLED', 'true').lower() == 'true'
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv('SEMANTIC_CACHE_THRESHOLD', '0.95'))
+SEMANTIC_CACHE_CAPACITY = int(os.getenv('SEMANTIC_CACHE_CAPACITY', '10000'))
+SEMANTIC_CACHE_PATH = os.getenv('SEMANTIC_CACHE_PATH')
+# With a path, unsaved entries are also written this often and at shutdown
+SEMANTIC_CACHE_SAVE_INTERVAL_SECONDS = float(os.getenv('SEMANTIC_CACHE_SAVE_INTERVAL_SECONDS', '60'))
 
 # Updated model names
 AVAILABLE_MODELS = {
     'text': 'gemini-2.0-flash-exp',
-    'audio_tts': 'gemini-2.0-flash-exp',  # Updated for TTS generation
+    'audio_tts': 'gemini-2.5-flash-preview-tts',  # Speech generation (google-genai SDK)
     'preview': 'gemini-2.5-flash-exp',    # Latest preview model
     'fallback': 'gemini-1.5-flash'
 }
 
+# Text-to-speech backend for audio turns: 'auto' (Gemini if google-genai is installed), 'gemini' or 'silent'
+TTS_BACKEND = os.getenv('TTS_BACKEND', 'auto').lower()
+# Sentences synthesized in parallel per audio reply
+TTS_MAX_CONCURRENCY = int(os.getenv('TTS_MAX_CONCURRENCY', '4'))
+# Synthesized sentences reused across replies (encouragement lines, fallback texts, follow-up prompts)
+AUDIO_CACHE_ENABLED = os.getenv('AUDIO_CACHE_ENABLED', 'true').lower() == 'true'
+AUDIO_CACHE_DIR = os.getenv('AUDIO_CACHE_DIR', os.path.join('uploads', 'tts_cache'))
+AUDIO_CACHE_MAX_BYTES = int(os.getenv('AUDIO_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+# Size each WAV from the reply text up front and fill it through mmap instead of appending
+AUDIO_WAV_PREALLOCATE = os.getenv('AUDIO_WAV_PREALLOCATE', 'false').lower() == 'true'
+
+# Per-chat memory (recent turns, rolling summary, key concepts, quiz outcomes) used as context when a chat_id is given
+CONVERSATION_MEMORY_ENABLED = os.getenv('CONVERSATION_MEMORY_ENABLED', 'true').lower() == 'true'
+# SQLite file chats are written through to; empty keeps memory in-process only
+CONVERSATION_MEMORY_DB = os.getenv('CONVERSATION_MEMORY_DB', os.path.join('uploads', 'conversation_memory.sqlite3'))
+CONVERSATION_MEMORY_MAX_CHATS = int(os.getenv('CONVERSATION_MEMORY_MAX_CHATS', '1000'))
+CONVERSATION_MEMORY_RECENT_TURNS = int(os.getenv('CONVERSATION_MEMORY_RECENT_TURNS', '6'))
+# Estimated tokens of context (memory plus the caller's context) put into each prompt
+CONVERSATION_CONTEXT_TOKEN_BUDGET = int(os.getenv('CONVERSATION_CONTEXT_TOKEN_BUDGET', '1500'))
+
+# Per-stage latency and per-key/model counters (worker 'metrics' op, GET /metrics in Node)
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+# Optional JSON snapshot written periodically, for processes that are not workers
+METRICS_DUMP_PATH = os.getenv('METRICS_DUMP_PATH')
+METRICS_DUMP_INTERVAL_SECONDS = float(os.getenv('METRICS_DUMP_INTERVAL_SECONDS', '60'))
+
+# Model cascade: route by question type and fall back across models within a latency budget
+MODEL_ROUTING_ENABLED = os.getenv('MODEL_ROUTING_ENABLED', 'true').lower() == 'true'
+MODEL_LATENCY_BUDGET_MS = float(os.getenv('MODEL_LATENCY_BUDGET_MS', '25000'))
+# Admission queue in front of generation: quiz grading, then audio turns, then new questions.
+# Requests whose predicted wait would overrun their deadline (latency_budget_ms, else
+# ADMISSION_DEADLINE_MS) get the fallback response at once instead of timing out.
+ADMISSION_CONTROL_ENABLED = os.getenv('ADMISSION_CONTROL_ENABLED', 'true').lower() == 'true'
+# Turns generating at once; 0 allows 4 per API key (up to MAX_CONCURRENT_REQUESTS), more would only wait on quota
+ADMISSION_MAX_ACTIVE = int(os.getenv('ADMISSION_MAX_ACTIVE', '0'))
+ADMISSION_MAX_QUEUE = int(os.getenv('ADMISSION_MAX_QUEUE', '256'))
+ADMISSION_DEADLINE_MS = float(os.getenv('ADMISSION_DEADLINE_MS', str(MODEL_LATENCY_BUDGET_MS)))
+# AVAILABLE_MODELS tiers tried in order for each question type
+MODEL_ROUTES = {
+    'definitional': ['fallback', 'text'],
+    'conceptual': ['text', 'fallback'],
+    'analytical': ['text', 'preview', 'fallback'],
+} if MODEL_ROUTING_ENABLED else {'conceptual': ['text']}
+
 # Structured Output Schema - Fixed response_text requirement
 STUDY_RESPONSE_SCHEMA = {
     "type": "object",
@@ -155,266 +290,981 @@ QUIZ_RESPONSE_SCHEMA = {
 }
 
 class AgenticStudyBuddy:
-    def __init__(self):
-        self.api_keys = GOOGLE_API_KEYS.copy()
-        self.current_key_index = 0
+    def __init__(self, max_concurrency: int = MAX_CONCURRENT_REQUESTS):
+        self.key_pool = ApiKeyPool(
+            load_api_keys(),
+            rpm_limit=RPM_PER_KEY,
+            tpm_limit=TPM_PER_KEY,
+            max_wait_seconds=KEY_POOL_MAX_WAIT_SECONDS,
+            breaker_settings={
+                'failure_threshold': CIRCUIT_FAILURE_THRESHOLD,
+                'open_seconds': CIRCUIT_OPEN_SECONDS,
+                'max_open_seconds': CIRCUIT_MAX_OPEN_SECONDS,
+                'probe_timeout_seconds': CIRCUIT_PROBE_TIMEOUT_SECONDS
+            }
+        )
         self.memory_patterns = {}
         self.learning_analytics = {}
-        self.configure_client()
-        
-    def configure_client(self):
-        """Configure the client with current API key"""
-        current_key = self.api_keys[self.current_key_index]
-        genai.configure(api_key=current_key)
-        print(f"Using API key index: {self.current_key_index}")
-        
-    def rotate_api_key(self):
-        """Rotate to next API key"""
-        self.current_key_index = (self.current_key_index + 1) % len(self.api_keys)
-        self.configure_client()
-        print(f"Rotated to API key index: {self.current_key_index}")
+        self.classifier = MessageClassifier()
+        self.prompts = PromptBuilder(PROMPT_CONTEXT_TOKEN_BUDGET)
+        self.context_cache = ContextCache(
+            GeminiCachedContentBackend(),
+            ttl_seconds=CONTEXT_CACHE_TTL_SECONDS,
+            refresh_margin_seconds=CONTEXT_CACHE_REFRESH_MARGIN_SECONDS
+        ) if CONTEXT_CACHE_ENABLED else None
+        self.metrics = Metrics(enabled=METRICS_ENABLED)
+        if METRICS_DUMP_PATH:
+            self.metrics.start_periodic_dump(METRICS_DUMP_PATH, METRICS_DUMP_INTERVAL_SECONDS)
+        self.max_concurrency = max_concurrency
+        self._async_semaphore = None
+        self._semaphore_loop = None
+        self.hedge_enabled = HEDGED_GENERATION_ENABLED
+        self.hedge_delay = HEDGE_DELAY_SECONDS
+        # wasted_calls: losing calls already sent when the other path won; their tokens are spent anyway
+        self.hedge_stats = {'requests': 0, 'hedges_launched': 0, 'structured_wins': 0, 'plain_wins': 0, 'fallbacks': 0,
+                            'wasted_calls': 0}
+        self._hedge_lock = threading.Lock()
+        self._hedge_executor = None
+        self.model_router = ModelRouter(AVAILABLE_MODELS, MODEL_LATENCY_BUDGET_MS, MODEL_ROUTES)
+        self.response_cache = ResponseCache(
+            max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+            max_bytes=RESPONSE_CACHE_MAX_BYTES,
+            ttl_seconds=RESPONSE_CACHE_TTL_SECONDS,
+            db_path=RESPONSE_CACHE_DB
+        ) if RESPONSE_CACHE_ENABLED else None
+        self.semantic_cache = None
+        if SEMANTIC_CACHE_ENABLED:
+            if SEMANTIC_CACHE_AVAILABLE:
+                self.semantic_cache = SemanticCache(
+                    threshold=SEMANTIC_CACHE_THRESHOLD,
+                    capacity=SEMANTIC_CACHE_CAPACITY,
+                    ttl_seconds=RESPONSE_CACHE_TTL_SECONDS,
+                    path=SEMANTIC_CACHE_PATH
+                )
+                if SEMANTIC_CACHE_PATH:
+                    self.semantic_cache.start_periodic_save(SEMANTIC_CACHE_SAVE_INTERVAL_SECONDS)
+                    atexit.register(self.semantic_cache.flush)
+            else:
+                print("numpy not installed, semantic cache disabled", file=sys.stderr)
+        # stderr: stdout carries the key: value reply that Node parses
+        print(f"Loaded {len(self.key_pool.clients)} API key(s) into the key pool", file=sys.stderr)
+    
+    def get_model(self, client: ApiKeyClient, model_name: str, async_mode: bool = False, cached: Optional[CachedPrefix] = None):
+        """GenerativeModel bound to one key's own service client (no global genai.configure)"""
+        from google.ai import generativelanguage as glm
         
-    def make_api_call_with_retry(self, model_name: str, prompt: str, generation_config=None, max_retries: int = 3):
-        """Make API call with retry logic and key rotation"""
+        model = get_genai().GenerativeModel(model_name)
+        if cached is not None:
+            # What GenerativeModel.from_cached_content sets, without its extra lookup round trip
+            model._cached_content = cached.name
+        client_options = {'api_key': client.api_key}
+        if async_mode:
+            # gRPC aio channels belong to the loop they were created on
+            loop = asyncio.get_running_loop()
+            if loop not in client.sdk_clients:
+                client.sdk_clients[loop] = glm.GenerativeServiceAsyncClient(client_options=client_options)
+            model._async_client = client.sdk_clients[loop]
+        else:
+            if 'sync' not in client.sdk_clients:
+                client.sdk_clients['sync'] = glm.GenerativeServiceClient(client_options=client_options)
+            model._client = client.sdk_clients['sync']
+        return model
+    
+    def lookup_cached_prefix(self, client: ApiKeyClient, model_name: str, prompt: str):
+        """(cached content or None, prompt to send): without its constant prefix when that is cached"""
+        if self.context_cache is None:
+            return None, prompt
+        prefix, rest = self.prompts.split_static(prompt)
+        cached = self.context_cache.lookup(client, model_name, prefix) if prefix else None
+        return self.use_cached_prefix(model_name, prompt, rest, cached)
+    
+    async def lookup_cached_prefix_async(self, client: ApiKeyClient, model_name: str, prompt: str):
+        if self.context_cache is None:
+            return None, prompt
+        prefix, rest = self.prompts.split_static(prompt)
+        cached = await self.context_cache.lookup_async(client, model_name, prefix) if prefix else None
+        return self.use_cached_prefix(model_name, prompt, rest, cached)
+    
+    def use_cached_prefix(self, model_name: str, prompt: str, rest: str, cached: Optional[CachedPrefix]):
+        if cached is None:
+            return None, prompt
+        self.metrics.count('cached_prompt_tokens', cached.tokens, model=model_name)
+        return cached, rest
+    
+    def is_cached_content_error(self, cached: Optional[CachedPrefix], error_str: str) -> bool:
+        """The cached content a call referenced is gone (expired or deleted); forget it so the retry sends the whole prompt"""
+        if cached is None or 'cache' not in error_str.lower():
+            return False
+        self.context_cache.forget(cached.name)
+        return True
+    
+    def estimate_call_tokens(self, prompt: str) -> int:
+        """Rough input + output token reservation for budgeting"""
+        return estimate_tokens(prompt) + EXPECTED_OUTPUT_TOKENS
+    
+    def get_usage_tokens(self, response) -> Optional[int]:
+        """Actual total tokens reported by the API, if any"""
+        usage = getattr(response, 'usage_metadata', None)
+        return getattr(usage, 'total_token_count', None) if usage else None
+    
+    def parse_retry_after(self, error_str: str) -> Optional[float]:
+        """Server-suggested retry delay from a 429 error, if present"""
+        match = re.search(r'retry_delay\s*\{\s*seconds:\s*(\d+)', error_str)
+        return float(match.group(1)) if match else None
+    
+    def build_request_options(self, timeout: Optional[float]) -> Dict[str, Any]:
+        """Per-call SDK options; a timeout bounds the call to the remaining latency budget"""
+        return {'request_options': {'timeout': timeout}} if timeout else {}
+    
+    def make_api_call_with_retry(self, model_name: str, prompt: str, generation_config=None, max_retries: int = 3,
+                                 timeout: Optional[float] = None):
+        """Make API call on the least-loaded key, moving to another key on rate limits"""
+        estimated_tokens = self.estimate_call_tokens(prompt)
         
         for attempt in range(max_retries):
+            with self.metrics.span('key_wait'):
+                client = self.key_pool.acquire(estimated_tokens, max_wait=timeout, model_name=model_name)
+            cached = None
             try:
-                model = genai.GenerativeModel(model_name)
+                cached, call_prompt = self.lookup_cached_prefix(client, model_name, prompt)
+                model = self.get_model(client, model_name, cached=cached)
                 
-                if generation_config:
-                    response = model.generate_content(prompt, generation_config=generation_config)
-                else:
-                    response = model.generate_content(prompt)
-                    
+                with self.metrics.span('gemini_call', model_name):
+                    if generation_config:
+                        response = model.generate_content(call_prompt, generation_config=generation_config,
+                                                          **self.build_request_options(timeout))
+                    else:
+                        response = model.generate_content(call_prompt, **self.build_request_options(timeout))
+                
+                self.key_pool.release(client, estimated_tokens, self.get_usage_tokens(response), model_name)
+                self.record_call(client, model_name, attempt, self.get_usage_tokens(response))
                 return response
                 
             except Exception as e:
                 error_str = str(e)
-                print(f"API call attempt {attempt + 1} failed: {error_str}")
+                print(f"API call attempt {attempt + 1} on key {client.index} failed: {error_str}", file=sys.stderr)
+                self.record_call(client, model_name, attempt, error=e)
                 
-                # Check if it's a quota/rate limit error
-                if "429" in error_str or "quota" in error_str.lower() or "rate" in error_str.lower():
-                    print("Rate limit detected, rotating API key...")
-                    self.rotate_api_key()
-                    
-                    # Wait before retrying
-                    wait_time = min(2 ** attempt, 10)  # Exponential backoff, max 10 seconds
-                    print(f"Waiting {wait_time} seconds before retry...")
-                    time.sleep(wait_time)
-                    
+                if self.is_cached_content_error(cached, error_str) and attempt < max_retries - 1:
+                    self.key_pool.release(client, estimated_tokens)
+                    continue
+                
+                # Opens this key's breaker for quota and bad-key errors, counts server errors towards it
+                kind = self.key_pool.record_failure(client, estimated_tokens, model_name, e,
+                                                    self.parse_retry_after(error_str))
+                if kind in KEY_ERRORS:
+                    # The key is benched; retry right away on the next least-loaded one
                     if attempt == max_retries - 1:
                         print("All API keys exhausted or rate limited")
                         raise e
                 else:
-                    # Non-rate-limit error, don't retry
+                    # Not the key's fault, another key would fail the same way
                     raise e
                     
         raise Exception("Max retries exceeded")
+    
+    def record_call(self, client: ApiKeyClient, model_name: str, attempt: int, tokens: Optional[int] = None,
+                    error: Optional[Exception] = None):
+        """Per-key and per-model call, retry, rate-limit, error and token counters"""
+        metrics = self.metrics
+        if not metrics.enabled:
+            return
+        metrics.count('gemini_calls', key=client.index, model=model_name)
+        if attempt:
+            metrics.count('retries', key=client.index, model=model_name)
+        if error is not None:
+            outcome = 'rate_limited' if self.is_rate_limit_error(error) else 'errors'
+            metrics.count(outcome, key=client.index, model=model_name)
+        elif tokens:
+            metrics.count('tokens', tokens, key=client.index, model=model_name)
+    
+    def is_rate_limit_error(self, error) -> bool:
+        """Check if an API error is a quota/rate limit error"""
+        return classify_error(error) in (RATE_LIMITED, DAILY_QUOTA)
+    
+    def is_model_fallback_error(self, error: Exception) -> bool:
+        """Errors that another model may not hit: quota, overload, timeouts, unknown model"""
+        if isinstance(error, KeyPoolExhausted):
+            return True
+        return classify_error(error) in (RATE_LIMITED, DAILY_QUOTA, SERVER, NOT_FOUND)
+    
+    def make_routed_call(self, route: RoutePlan, prompt: str, generation_config=None):
+        """Try the route's models in order until one answers within the latency budget"""
+        last_error = None
+        for index, model_name in enumerate(route.candidates):
+            remaining = route.remaining()
+            if remaining <= 0:
+                break
+            # A model whose recent latency would overrun the budget is skipped unless it is the last resort
+            if index < len(route.candidates) - 1 and self.model_router.is_too_slow(model_name, remaining):
+                self.model_router.record(model_name, 'skipped_slow')
+                continue
+            
+            timeout = route.attempt_timeout(index)
+            started = time.monotonic()
+            try:
+                response = self.make_api_call_with_retry(model_name, prompt, generation_config, timeout=timeout)
+            except Exception as e:
+                if not self.is_model_fallback_error(e):
+                    raise
+                print(f"Model {model_name} unavailable, falling back: {str(e) or type(e).__name__}", file=sys.stderr)
+                self.model_router.record(model_name, 'fallback', time.monotonic() - started)
+                last_error = e
+                continue
+            
+            self.model_router.record(model_name, 'ok', time.monotonic() - started)
+            route.model_used = model_name
+            return response
+        
+        raise last_error or TimeoutError(f"Latency budget of {route.budget_ms:.0f}ms exhausted")
+    
+    async def make_routed_call_async(self, route: RoutePlan, prompt: str, generation_config=None):
+        """Async variant of make_routed_call"""
+        last_error = None
+        for index, model_name in enumerate(route.candidates):
+            remaining = route.remaining()
+            if remaining <= 0:
+                break
+            if index < len(route.candidates) - 1 and self.model_router.is_too_slow(model_name, remaining):
+                self.model_router.record(model_name, 'skipped_slow')
+                continue
+            
+            timeout = route.attempt_timeout(index)
+            started = time.monotonic()
+            try:
+                # wait_for also bounds time spent queued on the semaphore and key pool
+                response = await asyncio.wait_for(
+                    self.make_api_call_with_retry_async(model_name, prompt, generation_config, timeout=timeout),
+                    timeout=timeout
+                )
+            except Exception as e:
+                if not self.is_model_fallback_error(e):
+                    raise
+                print(f"Model {model_name} unavailable, falling back: {str(e) or type(e).__name__}", file=sys.stderr)
+                self.model_router.record(model_name, 'fallback', time.monotonic() - started)
+                last_error = e
+                continue
+            
+            self.model_router.record(model_name, 'ok', time.monotonic() - started)
+            route.model_used = model_name
+            return response
+        
+        raise last_error or TimeoutError(f"Latency budget of {route.budget_ms:.0f}ms exhausted")
+    
+    def get_async_semaphore(self) -> asyncio.Semaphore:
+        """Concurrency limiter for the running event loop"""
+        loop = asyncio.get_running_loop()
+        if self._async_semaphore is None or self._semaphore_loop is not loop:
+            self._async_semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphore_loop = loop
+        return self._async_semaphore
+    
+    async def make_api_call_with_retry_async(self, model_name: str, prompt: str, generation_config=None, max_retries: int = 3,
+                                             timeout: Optional[float] = None):
+        """Async variant of make_api_call_with_retry that never blocks the event loop"""
+        estimated_tokens = self.estimate_call_tokens(prompt)
+        
+        for attempt in range(max_retries):
+            async with self.get_async_semaphore():
+                with self.metrics.span('key_wait'):
+                    client = await self.key_pool.acquire_async(estimated_tokens, max_wait=timeout, model_name=model_name)
+                cached = None
+                try:
+                    cached, call_prompt = await self.lookup_cached_prefix_async(client, model_name, prompt)
+                    model = self.get_model(client, model_name, async_mode=True, cached=cached)
+                    
+                    with self.metrics.span('gemini_call', model_name):
+                        if generation_config:
+                            response = await model.generate_content_async(call_prompt, generation_config=generation_config,
+                                                                          **self.build_request_options(timeout))
+                        else:
+                            response = await model.generate_content_async(call_prompt, **self.build_request_options(timeout))
+                    
+                    self.key_pool.release(client, estimated_tokens, self.get_usage_tokens(response), model_name)
+                    self.record_call(client, model_name, attempt, self.get_usage_tokens(response))
+                    return response
+                    
+                except asyncio.CancelledError:
+                    # e.g. the losing side of a hedged request
+                    self.key_pool.release(client, estimated_tokens)
+                    raise
+                except Exception as e:
+                    error_str = str(e)
+                    print(f"Async API call attempt {attempt + 1} on key {client.index} failed: {error_str}", file=sys.stderr)
+                    self.record_call(client, model_name, attempt, error=e)
+                    
+                    if self.is_cached_content_error(cached, error_str) and attempt < max_retries - 1:
+                        self.key_pool.release(client, estimated_tokens)
+                        continue
+                    
+                    kind = self.key_pool.record_failure(client, estimated_tokens, model_name, e,
+                                                        self.parse_retry_after(error_str))
+                    if kind in KEY_ERRORS:
+                        if attempt == max_retries - 1:
+                            print("All API keys exhausted or rate limited")
+                            raise e
+                    else:
+                        raise e
+                    
+        raise Exception("Max retries exceeded")
+        
+    def stream_api_call(self, model_name: str, prompt: str, generation_config=None, usage: Optional[Dict] = None,
+                        max_retries: int = 3, timeout: Optional[float] = None):
+        """Streaming API call yielding text chunks; rate limits move to another key before the first chunk"""
+        estimated_tokens = self.estimate_call_tokens(prompt)
         
-    def extract_learning_insights(self, user_message: str, context: str) -> Dict[str, Any]:
+        for attempt in range(max_retries):
+            with self.metrics.span('key_wait'):
+                client = self.key_pool.acquire(estimated_tokens, max_wait=timeout, model_name=model_name)
+            started = False
+            settled = False
+            call_started = time.perf_counter()
+            cached = None
+            try:
+                cached, call_prompt = self.lookup_cached_prefix(client, model_name, prompt)
+                model = self.get_model(client, model_name, cached=cached)
+                response = model.generate_content(call_prompt, generation_config=generation_config, stream=True,
+                                                  **self.build_request_options(timeout))
+                for chunk in response:
+                    text = self.get_chunk_text(chunk)
+                    if text:
+                        started = True
+                        yield text
+                
+                actual_tokens = self.get_usage_tokens(response)
+                if usage is not None:
+                    usage['total_tokens'] = actual_tokens
+                self.key_pool.release(client, estimated_tokens, actual_tokens, model_name)
+                self.metrics.observe('gemini_stream', time.perf_counter() - call_started, model_name)
+                self.record_call(client, model_name, attempt, actual_tokens)
+                settled = True
+                return
+                
+            except Exception as e:
+                error_str = str(e)
+                print(f"Streaming call attempt {attempt + 1} on key {client.index} failed: {error_str}", file=sys.stderr)
+                self.record_call(client, model_name, attempt, error=e)
+                settled = True
+                if self.is_cached_content_error(cached, error_str) and not started and attempt < max_retries - 1:
+                    self.key_pool.release(client, estimated_tokens)
+                    continue
+                kind = self.key_pool.record_failure(client, estimated_tokens, model_name, e,
+                                                    self.parse_retry_after(error_str))
+                if kind in KEY_ERRORS and not started and attempt < max_retries - 1:
+                    continue
+                raise
+            finally:
+                # The consumer stopped iterating early
+                if not settled:
+                    self.key_pool.release(client, estimated_tokens)
+        
+        raise Exception("Max retries exceeded")
+    
+    async def stream_api_call_async(self, model_name: str, prompt: str, generation_config=None,
+                                    usage: Optional[Dict] = None, max_retries: int = 3,
+                                    timeout: Optional[float] = None):
+        """Async variant of stream_api_call"""
+        estimated_tokens = self.estimate_call_tokens(prompt)
+        
+        for attempt in range(max_retries):
+            async with self.get_async_semaphore():
+                with self.metrics.span('key_wait'):
+                    client = await self.key_pool.acquire_async(estimated_tokens, max_wait=timeout, model_name=model_name)
+                started = False
+                settled = False
+                call_started = time.perf_counter()
+                cached = None
+                try:
+                    cached, call_prompt = await self.lookup_cached_prefix_async(client, model_name, prompt)
+                    model = self.get_model(client, model_name, async_mode=True, cached=cached)
+                    response = await model.generate_content_async(call_prompt, generation_config=generation_config, stream=True,
+                                                                  **self.build_request_options(timeout))
+                    async for chunk in response:
+                        text = self.get_chunk_text(chunk)
+                        if text:
+                            started = True
+                            yield text
+                    
+                    actual_tokens = self.get_usage_tokens(response)
+                    if usage is not None:
+                        usage['total_tokens'] = actual_tokens
+                    self.key_pool.release(client, estimated_tokens, actual_tokens, model_name)
+                    self.metrics.observe('gemini_stream', time.perf_counter() - call_started, model_name)
+                    self.record_call(client, model_name, attempt, actual_tokens)
+                    settled = True
+                    return
+                    
+                except Exception as e:
+                    error_str = str(e)
+                    print(f"Async streaming call attempt {attempt + 1} on key {client.index} failed: {error_str}", file=sys.stderr)
+                    self.record_call(client, model_name, attempt, error=e)
+                    settled = True
+                    if self.is_cached_content_error(cached, error_str) and not started and attempt < max_retries - 1:
+                        self.key_pool.release(client, estimated_tokens)
+                        continue
+                    kind = self.key_pool.record_failure(client, estimated_tokens, model_name, e,
+                                                        self.parse_retry_after(error_str))
+                    if kind in KEY_ERRORS and not started and attempt < max_retries - 1:
+                        continue
+                    raise
+                finally:
+                    if not settled:
+                        self.key_pool.release(client, estimated_tokens)
+        
+        raise Exception("Max retries exceeded")
+    
+    def get_chunk_text(self, chunk) -> str:
+        """Text of one streamed chunk (finish/safety chunks carry none)"""
+        try:
+            return chunk.text
+        except ValueError:
+            return ''
+    
+    def extract_learning_insights(self, user_message: str, context: str,
+                                  classification: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """Extract learning patterns and insights from user interaction"""
-        insights = {
-            'difficulty_level': 'medium',
-            'subject_area': 'general',
+        # Question type, difficulty and subject come from one compiled keyword scan
+        classification = classification or self.classifier.classify(user_message)
+        return {
+            'difficulty_level': classification['difficulty_level'],
+            'subject_area': classification['subject_area'],
             'learning_style': 'mixed',
             'confidence_level': 'moderate',
-            'question_type': 'conceptual',
+            'question_type': classification['question_type'],
             'needs_reinforcement': []
         }
+    
+    def build_system_prompt(self, insights: Dict, context: str, is_quiz_response: bool = False,
+                            schema: Optional[Dict[str, Any]] = None) -> str:
+        """Build comprehensive system prompt based on insights, with context cut to the prompt budget"""
+        return self.prompts.system_prompt(insights, context, is_quiz_response, schema)
+
+    def build_structured_prompt(self, system_prompt: str, user_message: str) -> str:
+        """Prompt for the JSON-schema call with explicit instructions"""
+        return self.prompts.structured_prompt(system_prompt, user_message)
+    
+    def build_plain_prompt(self, system_prompt: str, user_message: str) -> str:
+        """Prompt for the plain-text fallback call"""
+        return self.prompts.plain_prompt(system_prompt, user_message)
+    
+    def measure_prompt(self, prompt: str, model_name: str) -> int:
+        """Estimated input tokens of the prompt a request sends, counted per model"""
+        prompt_tokens = estimate_tokens(prompt)
+        self.metrics.count('prompt_tokens', prompt_tokens, model=model_name)
+        return prompt_tokens
+    
+    def build_structured_config(self, schema: Dict[str, Any]):
+        """Generation config requesting JSON that follows the schema"""
+        return get_genai().GenerationConfig(
+            response_mime_type="application/json",
+            response_schema=schema
+        )
+    
+    def parse_structured_response(self, response, user_message: str, insights: Dict, is_quiz_response: bool,
+                                  cache_keys: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Parse and validate a JSON-schema response, caching it when complete"""
+        with self.metrics.span('json_parse'):
+            structured_data = json.loads(response.text)
         
-        # Analyze question complexity
-        complexity_indicators = ['explain', 'how', 'why', 'what if', 'compare', 'analyze']
-        if any(indicator in user_message.lower() for indicator in complexity_indicators):
-            insights['question_type'] = 'analytical'
-            insights['difficulty_level'] = 'high'
-        elif any(word in user_message.lower() for word in ['definition', 'what is', 'meaning']):
-            insights['question_type'] = 'definitional'
-            insights['difficulty_level'] = 'low'
-            
-        # Subject detection
-        subjects = {
-            'math': ['equation', 'solve', 'calculate', 'formula', 'graph', 'algebra', 'geometry', 'calculus', 'trigonometry'],
-            'science': ['experiment', 'hypothesis', 'molecule', 'cell', 'reaction', 'physics', 'chemistry', 'biology', 'atom', 'energy', 'photosynthesis'],
-            'history': ['war', 'revolution', 'empire', 'ancient', 'timeline', 'civilization', 'century', 'historical'],
-            'literature': ['poem', 'novel', 'author', 'character', 'theme', 'analysis', 'story', 'narrative'],
-            'language': ['grammar', 'vocabulary', 'sentence', 'verb', 'noun', 'adjective', 'syntax'],
-            'computer_science': ['programming', 'algorithm', 'code', 'function', 'variable', 'loop', 'data structure']
-        }
+        # Ensure response_text is populated
+        if not structured_data.get('response_text') or structured_data['response_text'].strip() == '':
+            print("Empty response_text detected, generating fallback...")
+            return self.create_enhanced_fallback_response(user_message, insights, is_quiz_response)
         
-        for subject, keywords in subjects.items():
-            if any(keyword in user_message.lower() for keyword in keywords):
-                insights['subject_area'] = subject
-                break
-                
-        return insights
+        self.store_cached_response(cache_keys, structured_data)
+        return structured_data
     
-    def build_system_prompt(self, insights: Dict, context: str, is_quiz_response: bool = False) -> str:
-        """Build comprehensive system prompt based on insights"""
+    def get_semantic_namespace(self, user_message: str, context: str, insights: Dict, model_name: str) -> str:
+        """Partition for semantic matches: same model, subject and prior conversation"""
+        # Node appends the current message to the context; drop it so paraphrases share a namespace
+        lines = (context or '').rstrip().split('\n')
+        current_line = f"user: {user_message}".strip().lower()
+        while lines and lines[-1].strip().lower() == current_line:
+            lines.pop()
+        prior_context = re.sub(r'\s+', ' ', '\n'.join(lines)).strip()
+        return f"{model_name}|{insights['subject_area']}|{prior_context}"
+    
+    def get_cached_response(self, user_message: str, context: str, insights: Dict, is_quiz_response: bool,
+                            schema: Dict[str, Any], model_name: str):
+        """Look up the exact, then the semantic cache; returns (cache_keys, result or None)"""
+        cache_keys = {}
+        structured_data = None
+        similarity = 1.0
         
-        if is_quiz_response:
-            return f"""
-You are Study Buddy, an adaptive AI tutor analyzing a student's quiz responses.
-
-## Current Session Analysis:
-- Subject Area: {insights['subject_area']}
-- Question Type: {insights['question_type']}
-- Detected Difficulty: {insights['difficulty_level']}
-
-## Your Task:
-Evaluate the student's quiz responses and provide adaptive feedback using the structured output format.
-CRITICAL: Always populate the 'response_text' field with a complete, conversational response.
-
-## Key Behaviors:
-1. **Accurate Assessment**: Fairly evaluate responses and provide constructive feedback
-2. **Adaptive Planning**: Adjust difficulty and suggest next steps based on performance
-3. **Encouraging Tone**: Always be supportive while being honest about areas for improvement
-4. **Proactive Guidance**: Suggest specific actions and next topics
-
-## Context: {context}
-
-CRITICAL: You must follow the structured output schema exactly and provide meaningful content in response_text.
-"""
-        
-        return f"""
-You are Study Buddy, an advanced adaptive AI tutor with sophisticated agentic capabilities.
-
-## Current Learning Context:
-- Subject Area: {insights['subject_area']}
-- Question Type: {insights['question_type']}
-- Detected Difficulty Level: {insights['difficulty_level']}
-- Student Confidence: {insights['confidence_level']}
-
-## Your Agentic Mission:
-Execute a 4-phase adaptive tutoring response that's highly interactive and personalized.
-
-### Phase 1 - Intelligent Analysis 🧠
-- Assess the student's current level based on their question
-- Identify the most effective learning approach for this specific query
-- Detect any misconceptions or knowledge gaps
-
-### Phase 2 - Adaptive Teaching 📚  
-- Deliver explanation using the optimal teaching method (step-by-step, analogies, examples, etc.)
-- Match complexity to student level - never too simple or too advanced
-- Include concrete examples and practical applications
-- Make it engaging and relatable
-
-### Phase 3 - Interactive Assessment 🎯
-- ALWAYS include a follow-up question to check understanding
-- When appropriate, offer a mini-quiz with 2-3 targeted questions
-- Create questions that test both comprehension and application
-- Make assessment feel natural, not intimidating
-
-### Phase 4 - Proactive Next Steps 💡
-- Suggest related concepts to explore next
-- Provide specific study recommendations  
-- Always end with an engaging follow-up question or interaction
-- Be encouraging and build confidence
-
-## Critical Output Requirements:
-- ALWAYS populate 'response_text' with a complete, natural conversational response
-- Combine all phases into flowing, engaging text
-- Make it sound like a helpful tutor having a conversation
-- Include the main explanation, follow-up questions, and encouragement
-
-## Session Context: {context}
-
-Remember: You must respond using the structured output format with meaningful response_text that flows naturally.
-"""
-
-    def generate_structured_response(self, user_message: str, context: str, insights: Dict, is_quiz_response: bool = False) -> Dict[str, Any]:
+        if self.response_cache:
+            cache_keys['exact'] = self.response_cache.make_key(user_message, context, is_quiz_response, schema, model_name)
+            structured_data = self.response_cache.get(cache_keys['exact'])
+        
+        # Quiz grading depends on the exact answers given, so only study turns match semantically
+        if structured_data is None and self.semantic_cache and not is_quiz_response:
+            namespace = self.get_semantic_namespace(user_message, context, insights, model_name)
+            cache_keys['semantic'] = (user_message, namespace)
+            match = self.semantic_cache.lookup(user_message, namespace)
+            if match:
+                structured_data, similarity = match
+                print(f"Semantic cache hit (similarity {similarity:.3f})", file=sys.stderr)
+        
+        if structured_data is None:
+            return cache_keys, None
+        
+        return cache_keys, {
+            'success': True,
+            'data': structured_data,
+            'tokens_used': 0,
+            'prompt_tokens': 0,
+            'cache_hit': True,
+            'cache_similarity': similarity
+        }
+    
+    def store_cached_response(self, cache_keys: Optional[Dict[str, Any]], structured_data: Dict[str, Any]):
+        """Remember a complete structured response in every cache that was consulted"""
+        if not cache_keys:
+            return
+        if 'exact' in cache_keys:
+            self.response_cache.set(cache_keys['exact'], structured_data)
+        if 'semantic' in cache_keys:
+            text, namespace = cache_keys['semantic']
+            self.semantic_cache.add(text, namespace, structured_data)
+    
+    def get_token_count(self, response, user_message: str) -> int:
+        """Safely get token count from a response"""
+        if response is None:
+            return len(user_message.split()) * 4  # Rough estimate
+        
+        token_count = 0
+        try:
+            if hasattr(response, 'usage_metadata') and response.usage_metadata:
+                if hasattr(response.usage_metadata, 'total_token_count'):
+                    token_count = response.usage_metadata.total_token_count
+                elif hasattr(response.usage_metadata, 'get'):
+                    token_count = response.usage_metadata.get('total_token_count', 0)
+        except:
+            token_count = len(user_message.split()) * 4  # Rough estimate
+        return token_count
+    
+    def build_failed_result(self, user_message: str, insights: Dict, is_quiz_response: bool, error: Exception) -> Dict[str, Any]:
+        """Final fallback result when every attempt failed"""
+        print(f"All structured response attempts failed: {error}", file=sys.stderr)
+        fallback = self.create_enhanced_fallback_response(user_message, insights, is_quiz_response)
+        fallback_tokens = len(fallback['response_text'].split()) * 2
+        return {
+            'success': False,
+            'data': fallback,
+            'tokens_used': fallback_tokens,
+            'error': str(error),
+            'fallback': True
+        }
+    
+    def generate_structured_response(self, user_message: str, context: str, insights: Dict, is_quiz_response: bool = False,
+                                     latency_budget_ms: Optional[float] = None) -> Dict[str, Any]:
         """Generate structured response using Gemini's structured output with retry logic"""
         
-        system_prompt = self.build_system_prompt(insights, context, is_quiz_response)
+        with self.metrics.span('prompt_build'):
+            system_prompt = self.build_system_prompt(insights, context, is_quiz_response)
+            prompt = self.build_structured_prompt(system_prompt, user_message)
         schema = QUIZ_RESPONSE_SCHEMA if is_quiz_response else STUDY_RESPONSE_SCHEMA
         
-        # Select appropriate model
-        model_name = AVAILABLE_MODELS['text']
+        # Select appropriate models for this question
+        route = self.model_router.plan(insights, latency_budget_ms)
+        response = None
+        
+        cache_keys, cached_result = self.get_cached_response(user_message, context, insights, is_quiz_response, schema, route.primary)
+        if cached_result:
+            return cached_result
+        prompt_tokens = self.measure_prompt(prompt, route.primary)
         
+        if self.hedge_enabled:
+            return dict(self.generate_hedged_response(user_message, insights, is_quiz_response, system_prompt, schema, route, cache_keys),
+                        prompt_tokens=prompt_tokens)
+        
+        canned = False
         try:
-            # Prepare the full prompt with explicit instructions
-            full_prompt = f"""{system_prompt}
-
-Student Message: {user_message}
-
-IMPORTANT: Provide a complete JSON response following the schema. 
-The 'response_text' field must contain a full conversational response that naturally incorporates:
-- A clear explanation of the topic
-- Engaging examples or analogies
-- A follow-up question to check understanding
-- Encouraging tone throughout
-
-Make it sound like a knowledgeable, friendly tutor having a natural conversation."""
-            
             # Try with structured output first (Gemini 2.0)
             try:
-                response = self.make_api_call_with_retry(
-                    model_name,
-                    full_prompt,
-                    generation_config=genai.GenerationConfig(
-                        response_mime_type="application/json",
-                        response_schema=schema
-                    )
+                response = self.make_routed_call(
+                    route,
+                    prompt,
+                    generation_config=self.build_structured_config(schema)
                 )
-                
-                # Parse and validate JSON
-                structured_data = json.loads(response.text)
-                
-                # Ensure response_text is populated
-                if not structured_data.get('response_text') or structured_data['response_text'].strip() == '':
-                    print("Empty response_text detected, generating fallback...")
-                    structured_data = self.create_enhanced_fallback_response(user_message, insights, is_quiz_response)
+                structured_data = self.parse_structured_response(response, user_message, insights, is_quiz_response, cache_keys)
                 
             except Exception as structured_error:
                 print(f"Structured output failed: {structured_error}")
                 
                 # Fallback to regular text generation with clear instructions
-                fallback_prompt = f"""{system_prompt}
-
-Student Message: {user_message}
-
-Please provide a comprehensive response about this topic. Be engaging, clear, and educational."""
-                
                 try:
-                    response = self.make_api_call_with_retry(model_name, fallback_prompt)
+                    with self.metrics.span('fallback'):
+                        response = self.make_routed_call(route, self.build_plain_prompt(system_prompt, user_message))
                     # Create structured data with the generated text
                     structured_data = self.create_enhanced_fallback_response(user_message, insights, is_quiz_response)
                     structured_data['response_text'] = response.text
                 except:
                     # Final fallback
                     structured_data = self.create_enhanced_fallback_response(user_message, insights, is_quiz_response)
+                    canned = True
                     print("Using enhanced fallback response")
             
-            # Safely get token count
-            token_count = 0
-            try:
-                if hasattr(response, 'usage_metadata') and response.usage_metadata:
-                    if hasattr(response.usage_metadata, 'total_token_count'):
-                        token_count = response.usage_metadata.total_token_count
-                    elif hasattr(response.usage_metadata, 'get'):
-                        token_count = response.usage_metadata.get('total_token_count', 0)
-            except:
-                token_count = len(user_message.split()) * 4  # Rough estimate
-            
             return {
                 'success': True,
                 'data': structured_data,
-                'tokens_used': token_count
+                'tokens_used': self.get_token_count(response, user_message),
+                'model_used': route.model_used or route.primary,
+                'prompt_tokens': prompt_tokens,
+                'fallback': canned
             }
             
         except Exception as e:
-            print(f"All structured response attempts failed: {e}")
-            # Final fallback response
-            fallback = self.create_enhanced_fallback_response(user_message, insights, is_quiz_response)
-            fallback_tokens = len(fallback['response_text'].split()) * 2
+            return dict(self.build_failed_result(user_message, insights, is_quiz_response, e), prompt_tokens=prompt_tokens)
+    
+    async def generate_structured_response_async(self, user_message: str, context: str, insights: Dict, is_quiz_response: bool = False,
+                                                 latency_budget_ms: Optional[float] = None) -> Dict[str, Any]:
+        """Async variant of generate_structured_response"""
+        
+        with self.metrics.span('prompt_build'):
+            system_prompt = self.build_system_prompt(insights, context, is_quiz_response)
+            prompt = self.build_structured_prompt(system_prompt, user_message)
+        schema = QUIZ_RESPONSE_SCHEMA if is_quiz_response else STUDY_RESPONSE_SCHEMA
+        route = self.model_router.plan(insights, latency_budget_ms)
+        response = None
+        
+        cache_keys, cached_result = self.get_cached_response(user_message, context, insights, is_quiz_response, schema, route.primary)
+        if cached_result:
+            return cached_result
+        prompt_tokens = self.measure_prompt(prompt, route.primary)
+        
+        if self.hedge_enabled:
+            return dict(await self.generate_hedged_response_async(user_message, insights, is_quiz_response, system_prompt, schema, route, cache_keys),
+                        prompt_tokens=prompt_tokens)
+        
+        canned = False
+        try:
+            try:
+                response = await self.make_routed_call_async(
+                    route,
+                    prompt,
+                    generation_config=self.build_structured_config(schema)
+                )
+                structured_data = self.parse_structured_response(response, user_message, insights, is_quiz_response, cache_keys)
+                
+            except Exception as structured_error:
+                print(f"Structured output failed: {structured_error}")
+                
+                try:
+                    with self.metrics.span('fallback'):
+                        response = await self.make_routed_call_async(route, self.build_plain_prompt(system_prompt, user_message))
+                    structured_data = self.create_enhanced_fallback_response(user_message, insights, is_quiz_response)
+                    structured_data['response_text'] = response.text
+                except Exception:
+                    structured_data = self.create_enhanced_fallback_response(user_message, insights, is_quiz_response)
+                    canned = True
+                    print("Using enhanced fallback response")
+            
             return {
-                'success': False,
-                'data': fallback,
-                'tokens_used': fallback_tokens,
-                'error': str(e)
+                'success': True,
+                'data': structured_data,
+                'tokens_used': self.get_token_count(response, user_message),
+                'model_used': route.model_used or route.primary,
+                'prompt_tokens': prompt_tokens,
+                'fallback': canned
             }
+            
+        except Exception as e:
+            return dict(self.build_failed_result(user_message, insights, is_quiz_response, e), prompt_tokens=prompt_tokens)
+    
+    def check_structured_response(self, response) -> Dict[str, Any]:
+        """Structured data from a JSON-schema response; raises unless response_text is usable"""
+        with self.metrics.span('json_parse'):
+            structured_data = json.loads(response.text)
+        if not (structured_data.get('response_text') or '').strip():
+            raise ValueError("structured response has an empty response_text")
+        return structured_data
+    
+    def check_plain_response(self, response, user_message: str, insights: Dict, is_quiz_response: bool) -> Dict[str, Any]:
+        """Fallback structure around a plain-text response; raises if the text is empty"""
+        if not (response.text or '').strip():
+            raise ValueError("plain response is empty")
+        structured_data = self.create_enhanced_fallback_response(user_message, insights, is_quiz_response)
+        structured_data['response_text'] = response.text
+        return structured_data
+    
+    def record_hedge_outcome(self, winner: Optional[str], response, user_message: str, insights: Dict,
+                             is_quiz_response: bool, structured_data: Optional[Dict[str, Any]],
+                             cache_keys: Dict[str, Any], model_used: str) -> Dict[str, Any]:
+        """Count which path won and build the structured result"""
+        if winner == 'structured':
+            self.count_hedge('structured_wins')
+            self.store_cached_response(cache_keys, structured_data)
+        elif winner == 'plain':
+            self.count_hedge('plain_wins')
+        else:
+            self.count_hedge('fallbacks')
+            print("Using enhanced fallback response")
+            structured_data = self.create_enhanced_fallback_response(user_message, insights, is_quiz_response)
+        
+        return {
+            'success': True,
+            'data': structured_data,
+            'tokens_used': self.get_token_count(response, user_message),
+            'model_used': model_used,
+            'hedge_winner': winner or 'fallback',
+            'fallback': winner is None
+        }
+    
+    def count_hedge(self, counter: str, amount: int = 1):
+        """Hedged calls finish on pool threads and concurrent requests, so counters go through the lock"""
+        with self._hedge_lock:
+            self.hedge_stats[counter] += amount
+    
+    def get_hedge_stats(self) -> Dict[str, Any]:
+        with self._hedge_lock:
+            return dict(self.hedge_stats, enabled=self.hedge_enabled)
+    
+    def get_hedge_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        with self._hedge_lock:
+            if self._hedge_executor is None:
+                self._hedge_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_concurrency, thread_name_prefix='hedge'
+                )
+            return self._hedge_executor
+    
+    def generate_hedged_response(self, user_message: str, insights: Dict, is_quiz_response: bool, system_prompt: str,
+                                 schema: Dict[str, Any], route: RoutePlan, cache_keys: Dict[str, Any]) -> Dict[str, Any]:
+        """Start the structured call, add a plain call after hedge_delay or on failure, keep the first valid one"""
+        self.count_hedge('requests')
+        executor = self.get_hedge_executor()
+        routes = {}
+        
+        def structured_attempt():
+            attempt_route = routes['structured'] = route.fork()
+            response = self.make_routed_call(
+                attempt_route,
+                self.build_structured_prompt(system_prompt, user_message),
+                generation_config=self.build_structured_config(schema)
+            )
+            return response, self.check_structured_response(response), attempt_route.model_used
+        
+        def plain_attempt():
+            attempt_route = routes['plain'] = route.fork()
+            response = self.make_routed_call(attempt_route, self.build_plain_prompt(system_prompt, user_message))
+            return response, self.check_plain_response(response, user_message, insights, is_quiz_response), attempt_route.model_used
+        
+        paths = {executor.submit(structured_attempt): 'structured'}
+        plain_launched = False
+        deadline = time.time() + self.hedge_delay
+        
+        while paths:
+            timeout = None if plain_launched else max(0.0, deadline - time.time())
+            done, _ = concurrent.futures.wait(paths, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+            
+            for future in done:
+                path = paths.pop(future)
+                try:
+                    response, structured_data, model_used = future.result()
+                except Exception as e:
+                    print(f"Hedged {path} call failed: {e}", file=sys.stderr)
+                    continue
+                # A thread cannot be interrupted: a loser not yet started is cancelled, a running one
+                # is told to try no further model and left to finish in the background, unwaited
+                for other, other_path in paths.items():
+                    if not other.cancel():
+                        if other_path in routes:
+                            routes[other_path].cancel()
+                        self.count_hedge('wasted_calls')
+                return self.record_hedge_outcome(path, response, user_message, insights, is_quiz_response,
+                                                 structured_data, cache_keys, model_used)
+            
+            if not plain_launched and (not done or not paths):
+                plain_launched = True
+                self.count_hedge('hedges_launched')
+                paths[executor.submit(plain_attempt)] = 'plain'
+        
+        return self.record_hedge_outcome(None, None, user_message, insights, is_quiz_response, None, cache_keys, route.primary)
+    
+    async def generate_hedged_response_async(self, user_message: str, insights: Dict, is_quiz_response: bool,
+                                             system_prompt: str, schema: Dict[str, Any], route: RoutePlan,
+                                             cache_keys: Dict[str, Any]) -> Dict[str, Any]:
+        """Async variant of generate_hedged_response; the losing call is cancelled"""
+        self.count_hedge('requests')
+        
+        async def structured_attempt():
+            attempt_route = route.fork()
+            response = await self.make_routed_call_async(
+                attempt_route,
+                self.build_structured_prompt(system_prompt, user_message),
+                generation_config=self.build_structured_config(schema)
+            )
+            return response, self.check_structured_response(response), attempt_route.model_used
+        
+        async def plain_attempt():
+            attempt_route = route.fork()
+            response = await self.make_routed_call_async(attempt_route, self.build_plain_prompt(system_prompt, user_message))
+            return response, self.check_plain_response(response, user_message, insights, is_quiz_response), attempt_route.model_used
+        
+        paths = {asyncio.create_task(structured_attempt()): 'structured'}
+        plain_launched = False
+        deadline = time.time() + self.hedge_delay
+        
+        try:
+            while paths:
+                timeout = None if plain_launched else max(0.0, deadline - time.time())
+                done, _ = await asyncio.wait(paths, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                
+                for task in done:
+                    path = paths.pop(task)
+                    try:
+                        response, structured_data, model_used = task.result()
+                    except Exception as e:
+                        print(f"Hedged {path} call failed: {e}", file=sys.stderr)
+                        continue
+                    return self.record_hedge_outcome(path, response, user_message, insights, is_quiz_response,
+                                                     structured_data, cache_keys, model_used)
+                
+                if not plain_launched and (not done or not paths):
+                    plain_launched = True
+                    self.count_hedge('hedges_launched')
+                    paths[asyncio.create_task(plain_attempt())] = 'plain'
+        finally:
+            for task in paths:
+                if task.cancel():
+                    self.count_hedge('wasted_calls')
+        
+        return self.record_hedge_outcome(None, None, user_message, insights, is_quiz_response, None, cache_keys, route.primary)
+    
+    def build_streaming_prompt(self, system_prompt: str, user_message: str) -> str:
+        """Structured prompt that asks for response_text first so it can be streamed early
+
+        The system prompt must embed the schema (build_system_prompt(..., schema)):
+        JSON mode without response_schema only sees it as text.
+        """
+        return self.prompts.streaming_prompt(system_prompt, user_message)
+    
+    def build_streaming_config(self):
+        """JSON mode without response_schema - the API would otherwise reorder keys alphabetically"""
+        return get_genai().GenerationConfig(response_mime_type="application/json")
+    
+    def finish_streamed_response(self, raw_text: str, extractor: ResponseTextStreamExtractor, usage: Dict,
+                                 user_message: str, insights: Dict, is_quiz_response: bool,
+                                 schema: Dict[str, Any], cache_keys: Dict[str, Any], on_delta,
+                                 model_used: str) -> Dict[str, Any]:
+        """Parse the full streamed document into the usual structured result"""
+        fallback = self.create_enhanced_fallback_response(user_message, insights, is_quiz_response)
+        try:
+            structured_data = json.loads(raw_text)
+            if not isinstance(structured_data, dict):
+                raise ValueError("streamed JSON is not an object")
+        except ValueError as e:
+            print(f"Streamed JSON could not be parsed: {e}", file=sys.stderr)
+            structured_data = {}
+        
+        complete = all(key in structured_data for key in schema['required'])
+        if not (structured_data.get('response_text') or '').strip():
+            complete = False
+            # Whatever already reached the student stays the answer
+            structured_data['response_text'] = extractor.text or fallback['response_text']
+            if not extractor.emitted:
+                on_delta(structured_data['response_text'])
+        
+        if complete:
+            self.store_cached_response(cache_keys, structured_data)
+        else:
+            for key, value in fallback.items():
+                structured_data.setdefault(key, value)
+        
+        return {
+            'success': True,
+            'data': structured_data,
+            'tokens_used': usage.get('total_tokens') or self.get_token_count(None, user_message),
+            'model_used': model_used
+        }
+    
+    def generate_structured_response_stream(self, user_message: str, context: str, insights: Dict,
+                                            is_quiz_response: bool, on_delta,
+                                            latency_budget_ms: Optional[float] = None) -> Dict[str, Any]:
+        """Like generate_structured_response, but calls on_delta with response_text pieces as they arrive"""
+        schema = QUIZ_RESPONSE_SCHEMA if is_quiz_response else STUDY_RESPONSE_SCHEMA
+        with self.metrics.span('prompt_build'):
+            system_prompt = self.build_system_prompt(insights, context, is_quiz_response, schema)
+            prompt = self.build_streaming_prompt(system_prompt, user_message)
+        # Streams go to one model; the routed non-streaming path handles fallback
+        route = self.model_router.plan(insights, latency_budget_ms)
+        stream_model = self.model_router.pick(route)
+        
+        cache_keys, cached_result = self.get_cached_response(user_message, context, insights, is_quiz_response, schema, route.primary)
+        if cached_result:
+            on_delta(cached_result['data']['response_text'])
+            return cached_result
+        prompt_tokens = self.measure_prompt(prompt, stream_model)
+        
+        extractor = ResponseTextStreamExtractor()
+        raw_parts = []
+        usage = {}
+        try:
+            for text in self.stream_api_call(stream_model, prompt,
+                                             generation_config=self.build_streaming_config(), usage=usage,
+                                             timeout=route.remaining()):
+                raw_parts.append(text)
+                delta = extractor.feed(text)
+                if delta:
+                    on_delta(delta)
+        except Exception as e:
+            print(f"Streaming generation failed: {e}", file=sys.stderr)
+            if not extractor.emitted:
+                # Nothing shown yet, so the regular path can still answer
+                result = self.generate_structured_response(
+                    user_message, context, insights, is_quiz_response, max(route.remaining(), 1.0) * 1000
+                )
+                on_delta(result['data']['response_text'])
+                return result
+        
+        return dict(self.finish_streamed_response(''.join(raw_parts), extractor, usage, user_message, insights,
+                                                  is_quiz_response, schema, cache_keys, on_delta, stream_model),
+                    prompt_tokens=prompt_tokens)
+    
+    async def generate_structured_response_stream_async(self, user_message: str, context: str, insights: Dict,
+                                                        is_quiz_response: bool, on_delta,
+                                                        latency_budget_ms: Optional[float] = None) -> Dict[str, Any]:
+        """Async variant of generate_structured_response_stream"""
+        schema = QUIZ_RESPONSE_SCHEMA if is_quiz_response else STUDY_RESPONSE_SCHEMA
+        with self.metrics.span('prompt_build'):
+            system_prompt = self.build_system_prompt(insights, context, is_quiz_response, schema)
+            prompt = self.build_streaming_prompt(system_prompt, user_message)
+        # Streams go to one model; the routed non-streaming path handles fallback
+        route = self.model_router.plan(insights, latency_budget_ms)
+        stream_model = self.model_router.pick(route)
+        
+        cache_keys, cached_result = self.get_cached_response(user_message, context, insights, is_quiz_response, schema, route.primary)
+        if cached_result:
+            on_delta(cached_result['data']['response_text'])
+            return cached_result
+        prompt_tokens = self.measure_prompt(prompt, stream_model)
+        
+        extractor = ResponseTextStreamExtractor()
+        raw_parts = []
+        usage = {}
+        try:
+            async for text in self.stream_api_call_async(stream_model, prompt,
+                                                         generation_config=self.build_streaming_config(), usage=usage,
+                                                         timeout=route.remaining()):
+                raw_parts.append(text)
+                delta = extractor.feed(text)
+                if delta:
+                    on_delta(delta)
+        except Exception as e:
+            print(f"Streaming generation failed: {e}", file=sys.stderr)
+            if not extractor.emitted:
+                result = await self.generate_structured_response_async(
+                    user_message, context, insights, is_quiz_response, max(route.remaining(), 1.0) * 1000
+                )
+                on_delta(result['data']['response_text'])
+                return result
+        
+        return dict(self.finish_streamed_response(''.join(raw_parts), extractor, usage, user_message, insights,
+                                                  is_quiz_response, schema, cache_keys, on_delta, stream_model),
+                    prompt_tokens=prompt_tokens)
     
     def create_enhanced_fallback_response(self, user_message: str, insights: Dict, is_quiz_response: bool) -> Dict[str, Any]:
         """Create enhanced fallback response with proper content"""
+        self.metrics.count('fallback_responses')
         
         subject = insights.get('subject_area', 'general')
         
@@ -497,129 +1347,107 @@ I'm here to help you master this step by step!"""
 class ResponseGenerator:
     def __init__(self):
         self.agent = AgenticStudyBuddy()
+        self.audio_pipeline = AudioPipeline(
+            create_tts_backend(TTS_BACKEND, self.agent.key_pool, AVAILABLE_MODELS['audio_tts']),
+            max_concurrency=TTS_MAX_CONCURRENCY,
+            cache=AudioSegmentCache(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES) if AUDIO_CACHE_ENABLED else None,
+            preallocate=AUDIO_WAV_PREALLOCATE
+        )
+        self.memory = None
+        if CONVERSATION_MEMORY_ENABLED:
+            self.memory = ConversationMemory(
+                db_path=CONVERSATION_MEMORY_DB or None,
+                max_chats=CONVERSATION_MEMORY_MAX_CHATS,
+                max_recent_turns=CONVERSATION_MEMORY_RECENT_TURNS,
+                token_budget=CONVERSATION_CONTEXT_TOKEN_BUDGET
+            )
+        self.single_flight = SingleFlight() if COALESCE_REQUESTS_ENABLED else None
+        self.admission = None
+        if ADMISSION_CONTROL_ENABLED:
+            max_active = ADMISSION_MAX_ACTIVE or min(self.agent.max_concurrency, 4 * len(self.agent.key_pool.clients))
+            self.admission = AdmissionController(max_active, ADMISSION_MAX_QUEUE)
+        self.prefetcher = Prefetcher(PREFETCH_MAX_TOPICS, ttl_seconds=PREFETCH_TTL_SECONDS) if PREFETCH_ENABLED else None
         
     def wave_file(self, filename: str, pcm: bytes, channels: int = 1, rate: int = 24000, sample_width: int = 2):
         """Create WAV file from PCM data"""
-        with wave.open(filename, "wb") as wf:
-            wf.setnchannels(channels)
-            wf.setsampwidth(sample_width)
-            wf.setframerate(rate)
-            wf.writeframes(pcm)
+        with WavWriter(filename, channels=channels, sample_rate=rate, sample_width=sample_width) as writer:
+            writer.write(pcm)
     
     def format_response_text(self, structured_data: Dict[str, Any], is_quiz_response: bool = False) -> str:
         """Format structured data into natural response text - now just returns the response_text field"""
         return structured_data.get('response_text', 'I apologize, but I encountered an issue generating a response. Could you please try asking your question again?')
     
-    def detect_quiz_response(self, user_message: str) -> bool:
+    def detect_quiz_response(self, user_message: str, classification: Optional[Dict[str, Any]] = None) -> bool:
         """Detect if user is responding to a quiz"""
-        quiz_indicators = [
-            'q1:', 'q2:', 'q3:', 'question 1', 'question 2', 'question 3',
-            'answer:', 'my answer', 'i think', 'the answer is',
-            'format:', 'quiz', 'test'
-        ]
-        return any(indicator in user_message.lower() for indicator in quiz_indicators)
-    
-    def generate_audio_response(self, text: str, voice: str, file_name: str) -> Dict[str, Any]:
-        """Generate audio using Gemini 2.5 Preview or 2.0 Flash"""
+        classification = classification or self.agent.classifier.classify(user_message)
+        return classification['is_quiz_response']
+    
+    def generate_audio_response(self, text: str, voice: str, file_name: str, on_chunk=None) -> Dict[str, Any]:
+        """Synthesize the reply sentence by sentence into uploads/<file_name>.wav
+
+        on_chunk, if given, is called after each sentence is appended so a
+        client can start playing the file before it is complete.
+        """
+        file_path = f'uploads/{file_name}.wav'
+        os.makedirs('uploads', exist_ok=True)
         try:
-            # Try Gemini 2.5 Preview first for TTS
-            try:
-                model = genai.GenerativeModel(AVAILABLE_MODELS['preview'])
-                print(f"Attempting TTS with {AVAILABLE_MODELS['preview']} and voice: {voice}")
-                
-                # For now, create placeholder - actual TTS implementation would be here
-                # response = model.generate_content(f"Convert this to speech: {text}")
-                
-            except Exception as preview_error:
-                print(f"Preview model failed: {preview_error}")
-                # Fallback to 2.0 Flash
-                model = genai.GenerativeModel(AVAILABLE_MODELS['audio_tts'])
-                print(f"Falling back to {AVAILABLE_MODELS['audio_tts']}")
-            
-            # Create placeholder audio file (replace with actual TTS when available)
-            file_path = f'uploads/{file_name}.wav'
-            
-            # Create more realistic audio duration based on text length
-            words = len(text.split())
-            duration_seconds = max(1, words // 3)  # ~3 words per second
-            samples = 24000 * duration_seconds
-            dummy_audio = b'\x00' * (samples * 2)  # 16-bit samples
-            
-            self.wave_file(file_path, dummy_audio, rate=24000)
-            
-            return {
-                'audio_file': file_path,
-                'voice_used': voice,
-                'audio_tokens': len(text.split()) * 2,
-                'duration_seconds': duration_seconds
-            }
-            
+            audio = self.audio_pipeline.synthesize_to_wav(text, voice, file_path, on_chunk)
+            duration_seconds = audio['duration_seconds']
+            print(f"Synthesized {audio['sentences']} sentence(s) with {self.audio_pipeline.backend.name} TTS "
+                  f"({audio['cached_sentences']} from cache, {audio['tts_failures']} failed)", file=sys.stderr)
         except Exception as e:
             print(f"Audio generation failed: {e}")
             # Create minimal dummy audio file
-            file_path = f'uploads/{file_name}.wav'
-            dummy_audio = b'\x00' * 48000  # 1 second
-            self.wave_file(file_path, dummy_audio, rate=24000)
-            return {
-                'audio_file': file_path,
-                'voice_used': voice,
-                'audio_tokens': len(text.split()) * 2,
-                'duration_seconds': 1
-            }
-    
-    def generate_response(self, user_message: str, context: str, message_type: str, **kwargs) -> Dict[str, Any]:
-        """Main response generation with structured output"""
-        start_time = time.time()
-        
-        # Extract learning insights
-        insights = self.agent.extract_learning_insights(user_message, context)
-        
-        # Detect if this is a quiz response
-        is_quiz_response = self.detect_quiz_response(user_message)
+            write_silent_wav(file_path, 1, sample_rate=24000)
+            duration_seconds = 1
         
-        # Generate structured response
-        structured_result = self.agent.generate_structured_response(
-            user_message, context, insights, is_quiz_response
-        )
+        return {
+            'audio_file': file_path,
+            'voice_used': voice,
+            'audio_tokens': len(text.split()) * 2,
+            'duration_seconds': duration_seconds
+        }
+    
+    def build_updated_context(self, structured_data: Dict[str, Any], insights: Dict, is_quiz_response: bool) -> str:
+        """Build updated context from structured data"""
+        if is_quiz_response:
+            performance = structured_data.get('quiz_evaluation', {}).get('performance_level', 'moderate')
+            next_action = structured_data.get('next_action', {}).get('recommended_action', 'continue')
+            return f"Quiz completed - Performance: {performance}, Next: {next_action}"
         
+        mastery = structured_data.get('phase_4_next_steps', {}).get('mastery_level', 'progressing')
+        concepts = structured_data.get('phase_2_teaching', {}).get('key_concepts', [])
+        concept_list = ', '.join(concepts[:3]) if concepts else 'general topic'
+        return f"Discussed: {concept_list} | Mastery: {mastery} | Subject: {insights['subject_area']}"
+    
+    def build_result(self, structured_result: Dict[str, Any], insights: Dict, is_quiz_response: bool,
+                     message_type: str, audio_result: Dict[str, Any], start_time: float) -> Dict[str, Any]:
+        """Assemble the final result dict shared by the sync and async paths"""
         structured_data = structured_result['data']
         
         # Get the response text (should already be complete)
         output_text = structured_data.get('response_text', 'I apologize, but I encountered an issue. Please try again.')
         
-        # Build updated context from structured data
-        if is_quiz_response:
-            performance = structured_data.get('quiz_evaluation', {}).get('performance_level', 'moderate')
-            next_action = structured_data.get('next_action', {}).get('recommended_action', 'continue')
-            updated_context = f"Quiz completed - Performance: {performance}, Next: {next_action}"
-        else:
-            mastery = structured_data.get('phase_4_next_steps', {}).get('mastery_level', 'progressing')
-            concepts = structured_data.get('phase_2_teaching', {}).get('key_concepts', [])
-            concept_list = ', '.join(concepts[:3]) if concepts else 'general topic'
-            updated_context = f"Discussed: {concept_list} | Mastery: {mastery} | Subject: {insights['subject_area']}"
-        
-        # Handle audio generation if requested
-        audio_result = {}
-        if message_type.lower() == 'audio':
-            voice = kwargs.get('voice', 'Kore')
-            file_name = kwargs.get('file_name', f"audio_{int(time.time())}")
-            audio_result = self.generate_audio_response(output_text, voice, file_name)
-        
-        # Build result
         elapsed_time = (time.time() - start_time) * 1000
+        self.agent.metrics.observe('request', elapsed_time / 1000)
         text_tokens = structured_result['tokens_used']
         
         result = {
             "message_type": message_type,
             "response_text": output_text,
-            "updated_context": updated_context,
+            "updated_context": self.build_updated_context(structured_data, insights, is_quiz_response),
             "text_tokens": text_tokens,
             "total_tokens": text_tokens + audio_result.get('audio_tokens', 0),
+            # Estimated input tokens of the prompt sent for this turn (0 for cache hits)
+            "prompt_tokens": structured_result.get('prompt_tokens', 0),
             "processing_time_ms": elapsed_time,
             "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
             "learning_insights": insights,
             "structured_data": structured_data,
-            "generation_success": structured_result['success']
+            "generation_success": structured_result['success'],
+            # True when the text is the canned fallback rather than a model answer
+            "fallback_response": structured_result.get('fallback', False) or structured_result.get('shed', False),
+            "cache_hit": structured_result.get('cache_hit', False)
         }
         
         # Add audio-specific fields
@@ -627,72 +1455,401 @@ class ResponseGenerator:
             result.update(audio_result)
             result["model_used"] = AVAILABLE_MODELS['audio_tts']  # Track which model was used for audio
         else:
-            result["model_used"] = AVAILABLE_MODELS['text']
+            result["model_used"] = structured_result.get('model_used', AVAILABLE_MODELS['text'])
             
         return result
+    
+    def get_response_text(self, structured_result: Dict[str, Any]) -> str:
+        """Response text to speak for audio turns"""
+        return structured_result['data'].get('response_text', 'I apologize, but I encountered an issue. Please try again.')
+    
+    def get_audio_args(self, kwargs: Dict[str, Any]):
+        """Voice, file name and progress callback for an audio turn"""
+        voice = kwargs.get('voice', 'Kore')
+        file_name = kwargs.get('file_name', f"audio_{int(time.time())}")
+        return voice, file_name, kwargs.get('on_audio_chunk')
+    
+    def build_chat_context(self, chat_id: Optional[str], context: str,
+                           history: Optional[List[Dict[str, Any]]] = None) -> str:
+        """The chat's remembered context merged with the caller's, within the token budget
 
-# Global instance
-generator = ResponseGenerator()
+        `history` is the chat's stored messages ({role, text}): it seeds the
+        memory of a chat seen for the first time, and without memory it is
+        added to the context as the transcript.
+        """
+        if chat_id is None or self.memory is None:
+            return '\n'.join(part for part in (context, format_history(history)) if part)
+        if history:
+            self.memory.seed(chat_id, history)
+        return self.memory.build_context(chat_id, context)
+    
+    def remember_turn(self, chat_id: Optional[str], user_message: str, result: Dict[str, Any],
+                      structured_result: Optional[Dict[str, Any]] = None):
+        # A shed turn's canned reply says nothing about the conversation
+        if structured_result and structured_result.get('shed'):
+            return
+        if chat_id is not None and self.memory is not None:
+            self.memory.record_turn(chat_id, user_message, result)
+    
+    def admission_request(self, message_type: str, is_quiz_response: bool, kwargs: Dict[str, Any]):
+        """(priority, deadline as a time.monotonic() value) of a turn"""
+        if is_quiz_response:
+            priority = PRIORITY_QUIZ
+        elif message_type.lower() == 'audio':
+            priority = PRIORITY_AUDIO
+        else:
+            priority = PRIORITY_NEW
+        budget_ms = float(kwargs.get('latency_budget_ms') or ADMISSION_DEADLINE_MS)
+        return priority, time.monotonic() + budget_ms / 1000
+    
+    def admitted(self, ticket: AdmissionTicket) -> bool:
+        self.agent.metrics.observe('admission_wait', ticket.waited_seconds)
+        if not ticket.admitted:
+            self.agent.metrics.count('shed_requests')
+        return ticket.admitted
+    
+    def build_shed_result(self, user_message: str, insights: Dict, is_quiz_response: bool,
+                          ticket: AdmissionTicket, on_delta=None) -> Dict[str, Any]:
+        """The fallback response for a turn that could not be served within its deadline"""
+        print(f"Shedding request ({ticket.shed_reason}) after {ticket.waited_seconds * 1000:.0f}ms in the admission queue", file=sys.stderr)
+        fallback = self.agent.create_enhanced_fallback_response(user_message, insights, is_quiz_response)
+        if on_delta:
+            on_delta(fallback['response_text'])
+        return {
+            'success': False,
+            'data': fallback,
+            'tokens_used': 0,
+            'prompt_tokens': 0,
+            'error': f"Overloaded: {ticket.shed_reason}",
+            'shed': True
+        }
+    
+    def grade_quiz(self, chat_id: Optional[str], user_message: str, is_quiz_response: bool) -> Optional[QuizGrading]:
+        """Grade answers to the chat's open quiz against its answer key, if there are both"""
+        if not LOCAL_QUIZ_GRADING_ENABLED or not is_quiz_response or chat_id is None or self.memory is None:
+            return None
+        quiz = self.memory.issued_quiz(chat_id)
+        answers = parse_answers(user_message) if quiz else {}
+        if not answers:
+            return None
+        return QuizGrading(quiz, answers)
+    
+    def build_graded_result(self, grading: QuizGrading, on_delta=None) -> Dict[str, Any]:
+        """A structured result for a quiz graded entirely in-process"""
+        self.agent.metrics.count('quiz_graded_locally')
+        structured_data = grading.structured_response()
+        if on_delta:
+            on_delta(structured_data['response_text'])
+        return {
+            'success': True,
+            'data': structured_data,
+            'tokens_used': 0,
+            'prompt_tokens': 0,
+            'model_used': LOCAL_GRADER_MODEL
+        }
+    
+    def schedule_prefetch(self, chat_id: Optional[str], structured_result: Dict[str, Any], is_quiz_response: bool):
+        """Prefetch the turn's suggested next topics if there is quota and admission room to spare"""
+        if self.prefetcher is None or chat_id is None or is_quiz_response:
+            return
+        if not structured_result.get('success') or structured_result.get('shed'):
+            return
+        topics = structured_result['data'].get('phase_4_next_steps', {}).get('suggested_next_topics') or []
+        if not topics:
+            return
+        if self.admission and self.admission.spare_slots() <= self.admission.max_active // 2:
+            return
+        if self.agent.key_pool.headroom() < PREFETCH_MIN_HEADROOM:
+            return
+        self.prefetcher.schedule(chat_id, topics, lambda topic: self.generate_prefetch(chat_id, topic))
+    
+    async def generate_prefetch(self, chat_id: str, topic: str) -> Dict[str, Any]:
+        """The structured response to `topic` asked as the chat's next turn"""
+        context = self.build_chat_context(chat_id, '')
+        classification = self.agent.classifier.classify(topic)
+        insights = self.agent.extract_learning_insights(topic, context, classification)
+        ticket = None
+        if self.admission:
+            # Lowest priority: queued behind every live turn and the first shed when the queue fills
+            ticket = await self.admission.acquire_async(PRIORITY_PREFETCH, time.monotonic() + ADMISSION_DEADLINE_MS / 1000)
+            if not ticket.admitted:
+                self.agent.metrics.count('prefetch_shed')
+                return {'success': False, 'shed': True}
+        try:
+            self.agent.metrics.count('prefetch_calls')
+            return await self.agent.generate_structured_response_async(topic, context, insights, False)
+        finally:
+            if ticket:
+                self.admission.release(ticket)
+    
+    def after_coalesce(self, structured_result: Dict[str, Any], coalesced: bool, on_delta=None):
+        """Account for a request that shared another's call; a streaming one gets the whole text as one delta"""
+        if not coalesced:
+            return
+        self.agent.metrics.count('coalesced_requests')
+        # This request sent nothing to Gemini
+        structured_result['tokens_used'] = 0
+        structured_result['prompt_tokens'] = 0
+        if on_delta:
+            on_delta(structured_result['data'].get('response_text', ''))
+    
+    def generate_response(self, user_message: str, context: str, message_type: str, **kwargs) -> Dict[str, Any]:
+        """Main response generation with structured output
+
+        With a chat_id, the prompt context comes from that chat's memory (plus
+        whatever `context` the caller passed) and the turn is recorded after;
+        a `history` of the chat's messages seeds a memory that has not seen it.
+        """
+        start_time = time.time()
+        chat_id = kwargs.get('chat_id')
+        context = self.build_chat_context(chat_id, context, kwargs.get('history'))
+        
+        # One keyword scan feeds both the learning insights and quiz detection
+        with self.agent.metrics.span('insights'):
+            classification = self.agent.classifier.classify(user_message)
+            
+            # Extract learning insights
+            insights = self.agent.extract_learning_insights(user_message, context, classification)
+        
+        # Detect if this is a quiz response
+        is_quiz_response = self.detect_quiz_response(user_message, classification)
+        
+        # Answers to the chat's open quiz are graded here when possible, else with the answer key as context
+        grading = self.grade_quiz(chat_id, user_message, is_quiz_response)
+        if grading is not None and not grading.local:
+            context = '\n'.join(part for part in (context, grading.answer_key_context()) if part)
+        
+        # Generate structured response, streaming response_text if a delta callback was given
+        on_delta = kwargs.get('on_delta')
+        
+        def generate():
+            ticket = None
+            latency_budget_ms = kwargs.get('latency_budget_ms')
+            if self.admission:
+                ticket = self.admission.acquire(*self.admission_request(message_type, is_quiz_response, kwargs))
+                if not self.admitted(ticket):
+                    return self.build_shed_result(user_message, insights, is_quiz_response, ticket, on_delta)
+                # Time spent queued comes out of the model budget
+                latency_budget_ms = ticket.remaining_ms()
+            try:
+                if on_delta:
+                    return self.agent.generate_structured_response_stream(
+                        user_message, context, insights, is_quiz_response, on_delta, latency_budget_ms
+                    )
+                return self.agent.generate_structured_response(
+                    user_message, context, insights, is_quiz_response, latency_budget_ms
+                )
+            finally:
+                if ticket:
+                    self.admission.release(ticket)
+        
+        if grading is not None and grading.local:
+            structured_result = self.build_graded_result(grading, on_delta)
+        elif self.single_flight:
+            structured_result, coalesced = self.single_flight.do(
+                coalesce_key(user_message, context, message_type, is_quiz_response), generate
+            )
+            self.after_coalesce(structured_result, coalesced, on_delta)
+        else:
+            structured_result = generate()
+        
+        # Handle audio generation if requested
+        audio_result = {}
+        if message_type.lower() == 'audio':
+            voice, file_name, on_audio_chunk = self.get_audio_args(kwargs)
+            with self.agent.metrics.span('audio'):
+                audio_result = self.generate_audio_response(
+                    self.get_response_text(structured_result), voice, file_name, on_audio_chunk
+                )
+        
+        result = self.build_result(structured_result, insights, is_quiz_response, message_type, audio_result, start_time)
+        self.remember_turn(chat_id, user_message, result, structured_result)
+        return result
+    
+    async def generate_response_async(self, user_message: str, context: str, message_type: str, **kwargs) -> Dict[str, Any]:
+        """Async response generation - many turns can be in flight in one process"""
+        start_time = time.time()
+        chat_id = kwargs.get('chat_id')
+        context = self.build_chat_context(chat_id, context, kwargs.get('history'))
+        
+        with self.agent.metrics.span('insights'):
+            classification = self.agent.classifier.classify(user_message)
+            insights = self.agent.extract_learning_insights(user_message, context, classification)
+        is_quiz_response = self.detect_quiz_response(user_message, classification)
+        
+        grading = self.grade_quiz(chat_id, user_message, is_quiz_response)
+        if grading is not None and not grading.local:
+            context = '\n'.join(part for part in (context, grading.answer_key_context()) if part)
+        
+        on_delta = kwargs.get('on_delta')
+        
+        async def generate():
+            ticket = None
+            latency_budget_ms = kwargs.get('latency_budget_ms')
+            if self.admission:
+                ticket = await self.admission.acquire_async(*self.admission_request(message_type, is_quiz_response, kwargs))
+                if not self.admitted(ticket):
+                    return self.build_shed_result(user_message, insights, is_quiz_response, ticket, on_delta)
+                latency_budget_ms = ticket.remaining_ms()
+            try:
+                if on_delta:
+                    return await self.agent.generate_structured_response_stream_async(
+                        user_message, context, insights, is_quiz_response, on_delta, latency_budget_ms
+                    )
+                return await self.agent.generate_structured_response_async(
+                    user_message, context, insights, is_quiz_response, latency_budget_ms
+                )
+            finally:
+                if ticket:
+                    self.admission.release(ticket)
+        
+        # Every new question in a chat uses up its prefetches: the one asked for, if any, is the answer.
+        # Quiz answers (graded locally or not) leave them for the question that follows.
+        prefetched = None
+        if self.prefetcher and chat_id is not None and not is_quiz_response:
+            prefetched = await self.prefetcher.take(chat_id, user_message)
+        
+        if grading is not None and grading.local:
+            structured_result = self.build_graded_result(grading, on_delta)
+        elif prefetched:
+            structured_result = prefetched
+            self.agent.metrics.count('prefetch_hits')
+            if on_delta:
+                on_delta(structured_result['data'].get('response_text', ''))
+        elif self.single_flight:
+            structured_result, coalesced = await self.single_flight.do_async(
+                coalesce_key(user_message, context, message_type, is_quiz_response), generate
+            )
+            self.after_coalesce(structured_result, coalesced, on_delta)
+        else:
+            structured_result = await generate()
+        
+        # Audio writing is blocking file I/O, keep it off the event loop
+        audio_result = {}
+        if message_type.lower() == 'audio':
+            voice, file_name, on_audio_chunk = self.get_audio_args(kwargs)
+            with self.agent.metrics.span('audio'):
+                audio_result = await asyncio.to_thread(
+                    self.generate_audio_response, self.get_response_text(structured_result), voice, file_name, on_audio_chunk
+                )
+        
+        result = self.build_result(structured_result, insights, is_quiz_response, message_type, audio_result, start_time)
+        self.remember_turn(chat_id, user_message, result, structured_result)
+        self.schedule_prefetch(chat_id, structured_result, is_quiz_response)
+        return result
+
+# Global instance, built on first use so the usage message and imports stay fast
+_generator = None
+_generator_lock = threading.Lock()
+
+def get_generator() -> ResponseGenerator:
+    """The shared ResponseGenerator (key pool, caches, TTS), created on first call"""
+    global _generator
+    if _generator is None:
+        with _generator_lock:
+            if _generator is None:
+                _generator = ResponseGenerator()
+    return _generator
+
+def __getattr__(name: str):
+    """Keep `func.generator` and `func.genai` working for importers"""
+    if name == 'generator':
+        return get_generator()
+    if name == 'genai':
+        return get_genai()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 def generate_chat_response(user_message: str, context: str, message_type: str, **kwargs) -> Dict[str, Any]:
     """Main function - maintains backward compatibility"""
-    return generator.generate_response(user_message, context, message_type, **kwargs)
+    return get_generator().generate_response(user_message, context, message_type, **kwargs)
 
-def print_simple_output(result: Dict[str, Any]):
-    """Print formatted output - maintains exact format for Node.js parsing"""
-    print("message_type:", result["message_type"])
-    print("response_text:", result["response_text"])
-    print("updated_context:", result["updated_context"])
-    print("total_tokens:", result["total_tokens"])
-    print("processing_time_ms:", f"{result['processing_time_ms']:.2f}")
-    print("timestamp:", result["timestamp"])
-    print("generation_success:", result["generation_success"])
-    
-    # Print key structured insights for Node.js parsing
+async def generate_chat_response_async(user_message: str, context: str, message_type: str, **kwargs) -> Dict[str, Any]:
+    """Async counterpart of generate_chat_response"""
+    return await get_generator().generate_response_async(user_message, context, message_type, **kwargs)
+
+def build_simple_output(result: Dict[str, Any]) -> Dict[str, Any]:
+    """Collect the fields Node.js reads from a result, in print order"""
+    output = {
+        "message_type": result["message_type"],
+        "response_text": result["response_text"],
+        "updated_context": result["updated_context"],
+        "total_tokens": result["total_tokens"],
+        "processing_time_ms": result["processing_time_ms"],
+        "timestamp": result["timestamp"],
+        "generation_success": result["generation_success"],
+    }
+    
+    # Key structured insights for Node.js parsing
     structured_data = result.get("structured_data", {})
     if "phase_4_next_steps" in structured_data:
         next_steps = structured_data["phase_4_next_steps"]
-        print("mastery_level:", next_steps.get("mastery_level", "unknown"))
-        print("follow_up_question:", next_steps.get("follow_up_question", ""))
+        output["mastery_level"] = next_steps.get("mastery_level", "unknown")
+        output["follow_up_question"] = next_steps.get("follow_up_question", "")
     else:
         # Fallback values for quiz responses or missing data
+        output["mastery_level"] = "progressing"
         if "quiz_evaluation" in structured_data:
-            print("mastery_level:", "progressing")
-            print("follow_up_question:", structured_data.get("next_action", {}).get("follow_up_question", ""))
+            output["follow_up_question"] = structured_data.get("next_action", {}).get("follow_up_question", "")
         else:
-            print("mastery_level:", "progressing")
-            print("follow_up_question:", "What would you like to explore next?")
+            output["follow_up_question"] = "What would you like to explore next?"
     
     # Interactive elements
     interactive = structured_data.get("interactive_elements", {})
-    print("has_follow_up:", interactive.get("has_follow_up", True))
+    output["has_follow_up"] = interactive.get("has_follow_up", True)
     
     # Message type specific outputs
     if result["message_type"] == "audio":
-        print("audio_file:", result["audio_file"])
-        print("audio_tokens:", result["audio_tokens"])
-        print("text_tokens:", result["text_tokens"])
-        print("voice_used:", result["voice_used"])
+        output["audio_file"] = result["audio_file"]
+        output["audio_tokens"] = result["audio_tokens"]
+        output["text_tokens"] = result["text_tokens"]
+        output["voice_used"] = result["voice_used"]
         if "duration_seconds" in result:
-            print("duration_seconds:", result["duration_seconds"])
+            output["duration_seconds"] = result["duration_seconds"]
     else:
-        print("model_used:", result["model_used"])
-        print("text_tokens:", result["total_tokens"])  # For text-only, text_tokens = total_tokens
+        output["model_used"] = result["model_used"]
+        output["text_tokens"] = result["total_tokens"]  # For text-only, text_tokens = total_tokens
+    
+    return output
+
+def build_full_output(result: Dict[str, Any]) -> Dict[str, Any]:
+    """The whole result (structured_data, learning_insights, ...) plus the fields Node.js reads"""
+    return dict(result, prompt_tokens=result.get("prompt_tokens", 0), **build_simple_output(result))
+
+def print_simple_output(result: Dict[str, Any]):
+    """Print formatted output - maintains exact format for Node.js parsing"""
+    for key, value in build_simple_output(result).items():
+        if key == "processing_time_ms":
+            value = f"{value:.2f}"
+        print(f"{key}:", value)
 
 def save_to_json(result: Dict[str, Any], filename: str):
     """Save result to JSON file"""
     with open(filename, 'w', encoding='utf-8') as f:
         json.dump(result, f, ensure_ascii=False, indent=2)
 
-def process_chat_message(message_data: Dict[str, Any]) -> Dict[str, Any]:
-    """Process chat message from database format"""
+def build_chat_message_kwargs(message_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Validate a database message and build generation kwargs"""
     if message_data['role'] != 'user':
         raise ValueError("Only user messages should be processed for generation")
     
-    kwargs = {}
+    kwargs = {'chat_id': message_data.get('chat_id')}
     if message_data['message_type'] == 'audio':
         kwargs['file_name'] = message_data.get('audio_file_name', f"audio_{message_data['message_id']}")
         kwargs['voice'] = message_data.get('voice', 'Kore')
+    return kwargs
+
+def tag_chat_result(result: Dict[str, Any], message_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Attach database identifiers to a generated result"""
+    result.update({
+        'message_id': message_data['message_id'],
+        'chat_id': message_data['chat_id'],
+        'role': 'assistant'
+    })
+    return result
+
+def process_chat_message(message_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Process chat message from database format"""
+    kwargs = build_chat_message_kwargs(message_data)
     
     result = generate_chat_response(
         user_message=message_data['text'],
@@ -701,15 +1858,219 @@ def process_chat_message(message_data: Dict[str, Any]) -> Dict[str, Any]:
         **kwargs
     )
     
-    result.update({
-        'message_id': message_data['message_id'],
-        'chat_id': message_data['chat_id'],
-        'role': 'assistant'
-    })
+    return tag_chat_result(result, message_data)
+
+async def process_chat_message_async(message_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Async counterpart of process_chat_message"""
+    kwargs = build_chat_message_kwargs(message_data)
     
-    return result
+    result = await generate_chat_response_async(
+        user_message=message_data['text'],
+        context=message_data.get('context', ''),
+        message_type=message_data['message_type'],
+        **kwargs
+    )
+    
+    return tag_chat_result(result, message_data)
+
+def get_worker_stats() -> Dict[str, Any]:
+    """Cache and key pool counters for the worker 'stats' op"""
+    generator = get_generator()
+    agent = generator.agent
+    audio_cache = generator.audio_pipeline.cache
+    return {
+        'response_cache': agent.response_cache.stats() if agent.response_cache else None,
+        'semantic_cache': agent.semantic_cache.stats() if agent.semantic_cache else None,
+        'audio_cache': audio_cache.stats() if audio_cache else None,
+        'conversation_memory': generator.memory.stats() if generator.memory else None,
+        'coalescing': generator.single_flight.stats() if generator.single_flight else None,
+        'admission': generator.admission.stats() if generator.admission else None,
+        'prefetch': generator.prefetcher.stats() if generator.prefetcher else None,
+        'hedging': agent.get_hedge_stats(),
+        'model_router': agent.model_router.snapshot(),
+        'prompts': agent.prompts.stats(),
+        'context_cache': agent.context_cache.stats() if agent.context_cache else None,
+        'metrics': agent.metrics.snapshot(),
+        'key_pool': agent.key_pool.snapshot(),
+        'key_health': agent.key_pool.health()
+    }
+
+# Longest request line the worker accepts (contexts carry whole transcripts)
+WORKER_LINE_LIMIT = 16 * 1024 * 1024
+
+async def handle_worker_request(request: Dict[str, Any], send_frame) -> Dict[str, Any]:
+    """Handle one worker-mode request and build its reply
+
+    With "stream": true, response_text deltas are sent as
+    {"id", "event": "delta", "text"} frames before the reply, and audio turns
+    add {"id", "event": "audio", "audio_file", "seconds_ready", ...} frames
+    as each sentence is appended to the WAV.
+    """
+    request_id = request.get('id')
+    
+    if request.get('op') == 'ping':
+        return {'id': request_id, 'ok': True, 'result': 'pong'}
+    
+    if request.get('op') == 'stats':
+        return {'id': request_id, 'ok': True, 'result': get_worker_stats()}
+    
+    if request.get('op') == 'health':
+        return {'id': request_id, 'ok': True, 'result': get_generator().agent.key_pool.health()}
+    
+    if request.get('op') == 'metrics':
+        return {'id': request_id, 'ok': True, 'result': get_generator().agent.metrics.render_prometheus()}
+    
+    try:
+        message_type = request.get('message_type', 'text')
+        kwargs = {}
+        for key in ('file_name', 'voice', 'latency_budget_ms', 'chat_id', 'history'):
+            if request.get(key):
+                kwargs[key] = request[key]
+        if message_type.lower() == 'audio' and 'file_name' not in kwargs:
+            kwargs['file_name'] = f"audio_{int(time.time())}"
+        if request.get('stream'):
+            kwargs['on_delta'] = lambda text: send_frame({'id': request_id, 'event': 'delta', 'text': text})
+            # Audio is written from a worker thread; frames must be sent from the event loop
+            loop = asyncio.get_running_loop()
+            kwargs['on_audio_chunk'] = lambda progress: loop.call_soon_threadsafe(
+                send_frame, {'id': request_id, 'event': 'audio', **progress}
+            )
+        
+        result = await generate_chat_response_async(
+            request['user_message'],
+            request.get('context', ''),
+            message_type,
+            **kwargs
+        )
+        return {'id': request_id, 'ok': True, 'result': build_full_output(result)}
+    
+    except Exception as e:
+        print(f"Worker request {request_id} failed: {e}")
+        return {'id': request_id, 'ok': False, 'error': str(e)}
+
+def encode_frame(frame: Dict[str, Any]) -> bytes:
+    """One newline-delimited JSON frame"""
+    return (json.dumps(frame, ensure_ascii=False, default=str) + "\n").encode('utf-8')
+
+async def _process_worker_line(line: bytes, write_reply):
+    """Run one request line and write its reply line"""
+    def send_frame(frame: Dict[str, Any]):
+        write_reply(encode_frame(frame))
+    
+    try:
+        request = json.loads(line)
+        if not isinstance(request, dict):
+            raise ValueError("request must be a JSON object")
+        reply = await handle_worker_request(request, send_frame)
+    except ValueError as e:
+        reply = {'id': None, 'ok': False, 'error': f"Invalid request: {e}"}
+    send_frame(reply)
+
+async def _serve_worker_stream(reader: asyncio.StreamReader, write_reply):
+    """Read request lines and run them concurrently; replies are matched by id"""
+    in_flight = set()
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        if not line.strip():
+            continue
+        task = asyncio.create_task(_process_worker_line(line, write_reply))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+    
+    if in_flight:
+        await asyncio.gather(*in_flight)
+
+async def serve_stdio():
+    """Resident worker: newline-delimited JSON requests on stdin, replies on stdout"""
+    # Diagnostic prints from the agent must not corrupt the reply stream
+    protocol_out = sys.stdout.buffer
+    sys.stdout = sys.stderr
+    
+    def write_reply(data: bytes):
+        protocol_out.write(data)
+        protocol_out.flush()
+    
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=WORKER_LINE_LIMIT)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    
+    # Warm up before announcing readiness so the first request does not pay for imports
+    agent = get_generator().agent
+    get_genai()
+    print(f"Study Buddy worker ready on stdin/stdout (max {agent.max_concurrency} concurrent calls)")
+    await _serve_worker_stream(reader, write_reply)
+
+async def serve_unix_socket(socket_path: str):
+    """Resident worker listening on a local Unix socket, one JSON request per line"""
+    async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            await _serve_worker_stream(reader, writer.write)
+            await writer.drain()
+        finally:
+            writer.close()
+    
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    
+    sys.stdout = sys.stderr
+    get_generator()
+    get_genai()
+    server = await asyncio.start_unix_server(handle_connection, path=socket_path, limit=WORKER_LINE_LIMIT)
+    print(f"Study Buddy worker listening on {socket_path}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        os.unlink(socket_path)
+
+def flush_worker_state():
+    """Save what would otherwise be lost when a worker stops (the semantic cache's unsaved entries)"""
+    if _generator is not None and _generator.agent.semantic_cache:
+        _generator.agent.semantic_cache.flush()
 
 if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == '--serve':
+        # Stopped by SIGTERM (or stdin closing when Node exits): exit normally so the state is flushed
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            if len(sys.argv) >= 3 and sys.argv[2].startswith('socket='):
+                asyncio.run(serve_unix_socket(sys.argv[2].split('=', 1)[1]))
+            else:
+                asyncio.run(serve_stdio())
+        finally:
+            flush_worker_state()
+        sys.exit(0)
+    
+    if len(sys.argv) >= 2 and sys.argv[1] == '--batch':
+        import argparse
+        parser = argparse.ArgumentParser(prog='func.py --batch')
+        parser.add_argument('--batch', dest='input', required=True, help='JSONL of stored messages')
+        parser.add_argument('--out', required=True, help='JSONL of results, one line per input record')
+        parser.add_argument('--concurrency', type=int, default=None,
+                            help='requests in flight (default: 4 per API key, up to MAX_CONCURRENT_REQUESTS)')
+        parser.add_argument('--restart', action='store_true', help='ignore an existing checkpoint')
+        parser.add_argument('--rerun-failed', action='store_true',
+                            help='process only the failed and degraded records of an existing --out again')
+        parser.add_argument('--live-state', action='store_true',
+                            help='update conversation memory, response caches and prefetching as live turns do')
+        args = parser.parse_args()
+        if not args.live_state:
+            # A backfill must not rewrite chats' memory or fill the caches live turns read
+            CONVERSATION_MEMORY_ENABLED = PREFETCH_ENABLED = False
+            RESPONSE_CACHE_ENABLED = SEMANTIC_CACHE_ENABLED = False
+        if args.concurrency is None:
+            args.concurrency = min(MAX_CONCURRENT_REQUESTS, 4 * len(get_generator().agent.key_pool.clients))
+        try:
+            asyncio.run(run_batch(args.input, args.out, process_chat_message_async,
+                                  concurrency=args.concurrency, restart=args.restart,
+                                  rerun_failed=args.rerun_failed))
+        except KeyboardInterrupt:
+            print("[batch] interrupted; run the same command again to resume", file=sys.stderr)
+            sys.exit(130)
+        sys.exit(0)
+    
     if len(sys.argv) < 4:
         print("Usage: python func.py <USER_MESSAGE> <CONTEXT> <MESSAGE_TYPE> [additional_args]")
         print("\nMESSAGE_TYPE options:")
@@ -719,8 +2080,15 @@ if __name__ == "__main__":
         print("  Text: python func.py \"Explain photosynthesis\" \"\" text")
         print("  Quiz Response: python func.py \"Q1: The sun, Q2: Carbon dioxide\" \"Previous quiz on photosynthesis\" text")
         print("  Audio: python func.py \"Hello\" \"\" audio file_name=hello_audio")
+        print("  Streaming: python func.py \"Explain photosynthesis\" \"\" text stream=true")
+        print("  One length-prefixed JSON frame: python func.py \"Explain photosynthesis\" \"\" text output=frame")
         print("\nNode.js Integration Test:")
         print("  python func.py \"explain photosynthesis\" \"\" text")
+        print("\nWorker Mode (one warm process, newline-delimited JSON):")
+        print("  python func.py --serve")
+        print("  python func.py --serve socket=/tmp/study_buddy.sock")
+        print("\nBatch Mode (stored messages or requests.jsonl records, resumable):")
+        print("  python func.py --batch in.jsonl --out out.jsonl [--concurrency 8] [--restart]")
         sys.exit(1)
     
     user_message = sys.argv[1]
@@ -737,6 +2105,50 @@ if __name__ == "__main__":
     if message_type.lower() == 'audio' and 'file_name' not in kwargs:
         kwargs['file_name'] = f"audio_{int(time.time())}"
     
+    # The chat's stored messages as a JSON list of {role, text}
+    if 'history' in kwargs:
+        kwargs['history'] = json.loads(kwargs['history'])
+    
+    if kwargs.pop('stream', 'false').lower() == 'true':
+        # Newline-delimited JSON: {"event": "delta"} frames, then one {"event": "final"} frame
+        frame_out = sys.stdout.buffer
+        sys.stdout = sys.stderr
+        
+        def write_frame(frame: Dict[str, Any]):
+            frame_out.write(encode_frame(frame))
+            frame_out.flush()
+        
+        try:
+            kwargs['on_delta'] = lambda text: write_frame({'event': 'delta', 'text': text})
+            result = generate_chat_response(user_message, context, message_type, **kwargs)
+            write_frame({'event': 'final', 'result': build_full_output(result)})
+        except Exception as e:
+            write_frame({'event': 'error', 'error': str(e)})
+            sys.exit(1)
+        sys.exit(0)
+    
+    if kwargs.pop('output', 'lines').lower() in ('frame', 'framed'):
+        # One length-prefixed JSON frame (ipc_frames) with the whole result; logs go to stderr
+        frame_out = sys.stdout.buffer
+        sys.stdout = sys.stderr
+        try:
+            result = generate_chat_response(user_message, context, message_type, **kwargs)
+            frame_out.write(encode_framed({'ok': True, 'result': build_full_output(result)}))
+            frame_out.flush()
+            
+            if "save_json" in kwargs:
+                filename = f"chat_response_{int(time.time())}.json"
+                save_to_json(result, filename)
+                print(f"Result saved to: {filename}")
+                
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            frame_out.write(encode_framed({'ok': False, 'error': str(e)}))
+            frame_out.flush()
+            sys.exit(1)
+        sys.exit(0)
+    
     try:
         result = generate_chat_response(user_message, context, message_type, **kwargs)
         print_simple_output(result)
@@ -749,4 +2161,4 @@ if __name__ == "__main__":
     except Exception as e:
         print("error:", str(e))
         import traceback
-        traceback.print_exc()
\ No newline at end of file
+        traceback.print_exc()
@@ -29,7 +29,9 @@ app.use(express.urlencoded({ extended: true }));
 const upload = multer({ dest: 'uploads/' });
 
 // Function to fetch chat context and update it
-async function fetchChatContext(chatId, messageText, chatResponse) {
+// With includeTranscript false only the chat's stored context is returned; the messages
+// are still in messageHistory, for func.py to use as the chat's history.
+async function fetchChatContext(chatId, messageText, chatResponse, { includeTranscript = true } = {}) {
   try {
     // Fetch chat data
     const { data: chatDataResult, error: chatError } = await supabase
@@ -62,18 +64,18 @@ async function fetchChatContext(chatId, messageText, chatResponse) {
 
     // Build conversation history from messages
     let conversationHistory = '';
-    if (messagesData && messagesData.length > 0) {
+    if (includeTranscript && messagesData && messagesData.length > 0) {
       conversationHistory = messagesData
         .map(msg => `${msg.role}: ${msg.text || '[Audio message]'}`)
         .join('\n');
     }
 
     // Combine existing context with conversation history and new message
-    const fullContext = [
+    const fullContext = includeTranscript ? [
       chatDataResult.context || '',
       conversationHistory,
       `User: ${messageText}`
-    ].filter(part => part.trim()).join('\n');
+    ].filter(part => part.trim()).join('\n') : (chatDataResult.context || '');
     
     // Update the chat context with the new message
     const updatedContext = `${chatDataResult.context || ''}\nUser: ${messageText}\nAssistant: Response generated`;
@@ -102,7 +104,92 @@ async function fetchChatContext(chatId, messageText, chatResponse) {
   }
 }
 
-async function callPythonFunction(question, context, fileName, messageType = 'audio', voice = 'Kore') {
+// Reads the length-prefixed JSON frames func.py writes (ipc_frames.py): a 4-byte
+// big-endian length, then that many bytes of UTF-8 JSON. Chunks can be pushed as
+// they arrive; each frame is parsed once all of its bytes are in.
+class FrameDecoder {
+  constructor(maxFrameBytes = 64 * 1024 * 1024) {
+    this.chunks = [];
+    this.length = 0;
+    this.maxFrameBytes = maxFrameBytes;
+  }
+
+  push(chunk) {
+    this.chunks.push(chunk);
+    this.length += chunk.length;
+    const frames = [];
+    while (this.length >= 4) {
+      if (this.chunks[0].length < 4) {
+        this.chunks = [Buffer.concat(this.chunks, this.length)];
+      }
+      const frameLength = this.chunks[0].readUInt32BE(0);
+      if (frameLength > this.maxFrameBytes) {
+        throw new Error(`frame of ${frameLength} bytes exceeds the ${this.maxFrameBytes} byte limit`);
+      }
+      // Wait for the rest without copying what has arrived so far
+      if (this.length < 4 + frameLength) {
+        break;
+      }
+      const data = this.chunks.length === 1 ? this.chunks[0] : Buffer.concat(this.chunks, this.length);
+      frames.push(JSON.parse(data.toString('utf8', 4, 4 + frameLength)));
+      const rest = data.subarray(4 + frameLength);
+      this.chunks = rest.length ? [rest] : [];
+      this.length = rest.length;
+    }
+    return frames;
+  }
+}
+
+// func.py prints `key: value` lines unless asked for a frame (output=frame);
+// PYTHON_OUTPUT=lines keeps reading the lines
+const pythonOutputFormat = process.env.PYTHON_OUTPUT === 'lines' ? 'lines' : 'framed';
+
+function parseLineOutput(stdout) {
+  const result = {};
+  const lines = stdout.split('\n');
+
+  lines.forEach(line => {
+    if (line.includes('message_type:')) {
+      result.message_type = line.split('message_type:')[1].trim();
+    } else if (line.includes('response_text:')) {
+      result.response_text = line.split('response_text:')[1].trim();
+    } else if (line.includes('audio_file:')) {
+      result.audio_file = line.split('audio_file:')[1].trim();
+    } else if (line.includes('updated_context:')) {
+      result.updated_context = line.split('updated_context:')[1].trim();
+    } else if (line.includes('audio_tokens:')) {
+      result.audio_tokens = parseInt(line.split('audio_tokens:')[1].trim()) || 0;
+    } else if (line.includes('text_tokens:')) {
+      result.text_tokens = parseInt(line.split('text_tokens:')[1].trim()) || 0;
+    } else if (line.includes('total_tokens:')) {
+      result.total_tokens = parseInt(line.split('total_tokens:')[1].trim()) || 0;
+    } else if (line.includes('processing_time_ms:')) {
+      result.processing_time_ms = parseFloat(line.split('processing_time_ms:')[1].trim()) || 0;
+    } else if (line.includes('voice_used:')) {
+      result.voice_used = line.split('voice_used:')[1].trim();
+    } else if (line.includes('model_used:')) {
+      result.model_used = line.split('model_used:')[1].trim();
+    } else if (line.includes('timestamp:')) {
+      result.timestamp = line.split('timestamp:')[1].trim();
+    } else if (line.includes('generation_success:')) {
+      result.generation_success = line.split('generation_success:')[1].trim() === 'True';
+    } else if (line.includes('mastery_level:')) {
+      result.mastery_level = line.split('mastery_level:')[1].trim();
+    } else if (line.includes('has_follow_up:')) {
+      result.has_follow_up = line.split('has_follow_up:')[1].trim() === 'True';
+    } else if (line.includes('follow_up_question:')) {
+      result.follow_up_question = line.split('follow_up_question:')[1].trim();
+    } else if (line.includes('duration_seconds:')) {
+      result.duration_seconds = parseFloat(line.split('duration_seconds:')[1].trim()) || 0;
+    } else if (line.includes('error:') && result.error === undefined) {
+      result.error = line.split('error:')[1].trim();
+    }
+  });
+
+  return result;
+}
+
+function callPythonProcess(question, context, fileName, messageType = 'audio', voice = 'Kore', chatId = null, history = null) {
   return new Promise((resolve, reject) => {
     // Build the command arguments based on the new func.py interface
     const args = ['func.py', question, context, messageType];
@@ -112,14 +199,40 @@ async function callPythonFunction(question, context, fileName, messageType = 'au
       args.push(`file_name=${fileName}`);
       args.push(`voice=${voice}`);
     }
+
+    // Lets func.py use (and update) its per-chat memory for the prompt context
+    if (chatId) {
+      args.push(`chat_id=${chatId}`);
+    }
+    if (history) {
+      args.push(`history=${JSON.stringify(history)}`);
+    }
+
+    if (pythonOutputFormat === 'framed') {
+      args.push('output=frame');
+    }
     
     const pythonProcess = spawn('python3', args);
     
+    const decoder = new FrameDecoder();
+    let frame = null;
+    let decodeError = null;
     let stdout = '';
     let stderr = '';
     
     pythonProcess.stdout.on('data', (data) => {
-      stdout += data.toString();
+      if (pythonOutputFormat === 'lines') {
+        stdout += data.toString();
+        return;
+      }
+      try {
+        const frames = decoder.push(data);
+        if (frames.length) {
+          frame = frames[frames.length - 1];
+        }
+      } catch (error) {
+        decodeError = error;
+      }
     });
     
     pythonProcess.stderr.on('data', (data) => {
@@ -127,52 +240,32 @@ async function callPythonFunction(question, context, fileName, messageType = 'au
     });
     
     pythonProcess.on('close', (code) => {
+      if (pythonOutputFormat === 'framed') {
+        if (decodeError || !frame) {
+          const reason = decodeError ? decodeError.message : 'no result frame';
+          console.error(`Python script failed with code ${code} for file ${fileName} (${reason}):`, stderr);
+          reject(new Error(`Python script failed with code ${code}: ${reason}: ${stderr}`));
+          return;
+        }
+        if (!frame.ok) {
+          reject(new Error(frame.error));
+          return;
+        }
+        console.log(`Python script completed successfully for file: ${fileName}`);
+        const result = frame.result;
+        result.generated_text = result.response_text;
+        resolve(result);
+        return;
+      }
+
       if (code === 0) {
         console.log(`Python script completed successfully for file: ${fileName}`);
         
-        // Parse the output to extract the printed values
-        const result = {};
-        const lines = stdout.split('\n');
-        
-        lines.forEach(line => {
-          if (line.includes('message_type:')) {
-            result.message_type = line.split('message_type:')[1].trim();
-          } else if (line.includes('response_text:')) {
-            result.response_text = line.split('response_text:')[1].trim();
-          } else if (line.includes('audio_file:')) {
-            result.audio_file = line.split('audio_file:')[1].trim();
-          } else if (line.includes('updated_context:')) {
-            result.updated_context = line.split('updated_context:')[1].trim();
-          } else if (line.includes('audio_tokens:')) {
-            result.audio_tokens = parseInt(line.split('audio_tokens:')[1].trim()) || 0;
-          } else if (line.includes('text_tokens:')) {
-            result.text_tokens = parseInt(line.split('text_tokens:')[1].trim()) || 0;
-          } else if (line.includes('total_tokens:')) {
-            result.total_tokens = parseInt(line.split('total_tokens:')[1].trim()) || 0;
-          } else if (line.includes('processing_time_ms:')) {
-            result.processing_time_ms = parseFloat(line.split('processing_time_ms:')[1].trim()) || 0;
-          } else if (line.includes('voice_used:')) {
-            result.voice_used = line.split('voice_used:')[1].trim();
-          } else if (line.includes('model_used:')) {
-            result.model_used = line.split('model_used:')[1].trim();
-          } else if (line.includes('timestamp:')) {
-            result.timestamp = line.split('timestamp:')[1].trim();
-          } else if (line.includes('generation_success:')) {
-            result.generation_success = line.split('generation_success:')[1].trim() === 'True';
-          } else if (line.includes('mastery_level:')) {
-            result.mastery_level = line.split('mastery_level:')[1].trim();
-          } else if (line.includes('has_follow_up:')) {
-            result.has_follow_up = line.split('has_follow_up:')[1].trim() === 'True';
-          } else if (line.includes('follow_up_question:')) {
-            result.follow_up_question = line.split('follow_up_question:')[1].trim();
-          } else if (line.includes('duration_seconds:')) {
-            result.duration_seconds = parseFloat(line.split('duration_seconds:')[1].trim()) || 0;
-          } else if (line.includes('error:')) {
-            const error = line.split('error:')[1].trim();
-            reject(new Error(error));
-            return;
-          }
-        });
+        const result = parseLineOutput(stdout);
+        if (result.error !== undefined) {
+          reject(new Error(result.error));
+          return;
+        }
         
         // For backward compatibility, set generated_text to response_text
         result.generated_text = result.response_text;
@@ -191,6 +284,166 @@ async function callPythonFunction(question, context, fileName, messageType = 'au
   });
 }
 
+// Resident Python worker - keeps one warm func.py process instead of spawning per message
+// A worker that dies before answering anything is restarted after a delay that doubles per
+// failed start (up to the cap), so a broken install does not respawn in a tight loop
+const WORKER_RESTART_BASE_MS = 500;
+const WORKER_RESTART_MAX_MS = 30000;
+
+class PythonWorker {
+  constructor() {
+    this.process = null;
+    this.pending = new Map();
+    this.nextId = 1;
+    this.buffer = '';
+    this.restartDelayMs = 0;
+    this.restartAt = 0;
+  }
+
+  start() {
+    const child = spawn('python3', ['func.py', '--serve']);
+    this.process = child;
+    this.buffer = '';
+
+    child.stdout.on('data', (data) => {
+      this.buffer += data.toString();
+      let newlineIndex;
+      while ((newlineIndex = this.buffer.indexOf('\n')) !== -1) {
+        const line = this.buffer.slice(0, newlineIndex);
+        this.buffer = this.buffer.slice(newlineIndex + 1);
+        this.handleLine(line);
+      }
+    });
+
+    child.stderr.on('data', (data) => {
+      process.stderr.write(`[python-worker] ${data}`);
+    });
+
+    // Writes to a worker that failed to start or just died; 'error'/'exit' below handle it
+    child.stdin.on('error', (error) => {
+      console.error('Python worker stdin error:', error.message);
+    });
+
+    child.on('exit', (code) => {
+      console.error(`Python worker exited with code ${code}`);
+      this.handleFailure(child, new Error(`Python worker exited with code ${code}`));
+    });
+
+    child.on('error', (error) => {
+      console.error('Python worker error:', error);
+      this.handleFailure(child, error);
+    });
+  }
+
+  // Reject everything in flight on the failed process and schedule the next start
+  handleFailure(child, error) {
+    if (this.process !== child) {
+      // 'error' and 'exit' can both fire for one process
+      return;
+    }
+    this.process = null;
+    this.pending.forEach(({ reject }) => reject(error));
+    this.pending.clear();
+    this.restartDelayMs = Math.min(Math.max(this.restartDelayMs * 2, WORKER_RESTART_BASE_MS), WORKER_RESTART_MAX_MS);
+    this.restartAt = Date.now() + this.restartDelayMs;
+    console.error(`Restarting Python worker in ${this.restartDelayMs}ms`);
+  }
+
+  handleLine(line) {
+    let reply;
+    try {
+      reply = JSON.parse(line);
+    } catch (error) {
+      // Startup logs printed before the worker loop begins are not replies
+      console.log(`[python-worker] ${line}`);
+      return;
+    }
+
+    // The worker is answering, so the next failure restarts it without a long delay
+    this.restartDelayMs = 0;
+
+    const request = this.pending.get(reply.id);
+    if (!request) {
+      return;
+    }
+
+    // Streaming requests get response_text deltas (and audio progress) before the final reply
+    if (reply.event) {
+      if (reply.event === 'delta' && request.onDelta) {
+        request.onDelta(reply.text);
+      }
+      return;
+    }
+    this.pending.delete(reply.id);
+
+    if (reply.ok) {
+      request.resolve(reply.result);
+    } else {
+      request.reject(new Error(reply.error));
+    }
+  }
+
+  async call(payload, onDelta = null) {
+    const wait = this.restartAt - Date.now();
+    if (!this.process && wait > 0) {
+      await new Promise(resolve => setTimeout(resolve, wait));
+    }
+    if (!this.process) {
+      this.start();
+    }
+
+    const id = this.nextId++;
+    return new Promise((resolve, reject) => {
+      this.pending.set(id, { resolve, reject, onDelta });
+      this.process.stdin.write(JSON.stringify({ id, ...payload, stream: Boolean(onDelta) }) + '\n');
+    });
+  }
+}
+
+const usePythonWorker = process.env.PYTHON_WORKER !== 'false';
+const pythonWorker = new PythonWorker();
+
+async function callPythonFunction(question, context, fileName, messageType = 'audio', voice = 'Kore', onDelta = null, chatId = null, history = null) {
+  if (!usePythonWorker) {
+    return callPythonProcess(question, context, fileName, messageType, voice, chatId, history);
+  }
+
+  const payload = {
+    user_message: question,
+    context,
+    message_type: messageType
+  };
+
+  if (messageType === 'audio') {
+    payload.file_name = fileName;
+    payload.voice = voice;
+  }
+
+  if (chatId) {
+    payload.chat_id = chatId;
+  }
+  if (history) {
+    payload.history = history;
+  }
+
+  const result = await pythonWorker.call(payload, onDelta);
+
+  // For backward compatibility, set generated_text to response_text
+  result.generated_text = result.response_text;
+
+  return result;
+}
+
+// The chat's earlier messages as {role, text}, without the message being answered
+function chatHistoryForPython(messages, messageText) {
+  const history = (messages || []).map(msg => ({ role: msg.role, text: msg.text }));
+  const last = history[history.length - 1];
+  if (last && last.role === 'user' && last.text === messageText) {
+    history.pop();
+  }
+  return history;
+}
+
 // Helper function to safely build chat message data with only existing columns
 function buildChatMessageData(chatId, pythonResult, messageType, audioUrl = null) {
   const baseData = {
@@ -360,13 +613,16 @@ app.post('/webhook/chat-message', async (req, res) => {
       });
     }
     
-    // Fetch enhanced chat context with all messages
-    const chatData = await fetchChatContext(chatId, messageText, null);
+    // The chat's stored context, with its messages passed separately: func.py's memory for
+    // this chat_id supplies the recent turns (seeded from the messages the first time it sees
+    // the chat), or without memory the messages are added to the prompt as the transcript
+    const chatData = await fetchChatContext(chatId, messageText, null, { includeTranscript: false });
+    const history = chatHistoryForPython(chatData.messageHistory, messageText);
     
     const responseFileName = `response_${uuidv4()}`;
     
-    // Call Python function with the enhanced context that includes all messages
-    const pythonResult = await callPythonFunction(messageText, chatData.context || '', responseFileName, messageType, voice);
+    // Call Python function with the chat's context, chat_id and messages
+    const pythonResult = await callPythonFunction(messageText, chatData.context || '', responseFileName, messageType, voice, null, chatId, history);
     
     await new Promise(resolve => setTimeout(resolve, 100));
     
@@ -504,13 +760,41 @@ app.post('/webhook/chat-message', async (req, res) => {
   }
 });
 
-// Health check endpoint
-app.get('/health', (req, res) => {
-  res.status(200).json({
+// Health check endpoint; with the resident worker it also reports which API keys are usable per model
+app.get('/health', async (req, res) => {
+  const health = {
     status: 'healthy',
     timestamp: new Date().toISOString(),
     service: 'agentic-study-buddy'
-  });
+  };
+
+  if (usePythonWorker) {
+    try {
+      health.keys = await pythonWorker.call({ op: 'health' });
+      if (!health.keys.healthy) {
+        health.status = 'degraded';
+      }
+    } catch (error) {
+      health.status = 'degraded';
+      health.keys_error = error.message;
+    }
+  }
+
+  res.status(200).json(health);
+});
+
+// Prometheus-style stage latencies and per-key/model counters from the resident worker
+app.get('/metrics', async (req, res) => {
+  if (!usePythonWorker) {
+    return res.status(404).type('text/plain').send('metrics need the resident Python worker (PYTHON_WORKER)\n');
+  }
+
+  try {
+    const text = await pythonWorker.call({ op: 'metrics' });
+    res.status(200).type('text/plain; version=0.0.4').send(text);
+  } catch (error) {
+    res.status(500).type('text/plain').send(`metrics unavailable: ${error.message}\n`);
+  }
 });
 
 // Debug endpoint to test Python integration
@@ -537,6 +821,28 @@ app.post('/debug/test-python', async (req, res) => {
   }
 });
 
+// Debug endpoint that streams response_text deltas as Server-Sent Events
+app.post('/debug/stream-python', async (req, res) => {
+  const { message = "Hello, test message", context = "" } = req.body;
+
+  res.setHeader('Content-Type', 'text/event-stream');
+  res.setHeader('Cache-Control', 'no-cache');
+  res.setHeader('Connection', 'keep-alive');
+  res.flushHeaders();
+
+  const sendEvent = (event, data) => {
+    res.write(`event: ${event}\ndata: ${JSON.stringify(data)}\n\n`);
+  };
+
+  try {
+    const result = await callPythonFunction(message, context, null, 'text', 'Kore', (text) => sendEvent('delta', { text }));
+    sendEvent('final', result);
+  } catch (error) {
+    sendEvent('error', { error: error.message });
+  }
+  res.end();
+});
+
 // New endpoint to test database schema
 app.get('/debug/test-db-schema', async (req, res) => {
   try {
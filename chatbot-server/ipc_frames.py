@@ -0,0 +1,46 @@
+import json
+import struct
+from typing import Any, Dict, List
+
+# Every frame is a 4-byte big-endian payload length followed by that many bytes of UTF-8 JSON
+FRAME_HEADER = struct.Struct('>I')
+# Refuse lengths no reply could have (a corrupt or misaligned stream)
+MAX_FRAME_BYTES = 64 * 1024 * 1024
+
+
+def encode_framed(payload: Dict[str, Any]) -> bytes:
+    """One length-prefixed JSON frame"""
+    body = json.dumps(payload, ensure_ascii=False, default=str, separators=(',', ':')).encode('utf-8')
+    return FRAME_HEADER.pack(len(body)) + body
+
+
+class FrameDecoder:
+    """Incremental reader for encode_framed output: feed() bytes as they arrive, get whole frames back
+
+    Mirrors the FrameDecoder in index.js; a frame is parsed only once all
+    of its bytes are in, so no output needs to be rescanned.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data: bytes) -> List[Dict[str, Any]]:
+        self._buffer += data
+        frames = []
+        offset = 0
+        while len(self._buffer) - offset >= FRAME_HEADER.size:
+            (length,) = FRAME_HEADER.unpack_from(self._buffer, offset)
+            if length > MAX_FRAME_BYTES:
+                raise ValueError(f"frame of {length} bytes exceeds the {MAX_FRAME_BYTES} byte limit")
+            end = offset + FRAME_HEADER.size + length
+            if end > len(self._buffer):
+                break
+            frames.append(json.loads(self._buffer[offset + FRAME_HEADER.size:end].decode('utf-8')))
+            offset = end
+        del self._buffer[:offset]
+        return frames
+
+    @property
+    def pending_bytes(self) -> int:
+        """Bytes of an incomplete frame still waiting for the rest"""
+        return len(self._buffer)
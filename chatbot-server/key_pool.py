@@ -0,0 +1,270 @@
+import asyncio
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from circuit_breaker import (AUTH, DAILY_QUOTA, NOT_FOUND, RATE_LIMITED, SERVER, CircuitBreaker, classify_error,
+                             seconds_until_quota_reset)
+
+# Breaker that guards every model on a key (bad key, key-wide rate limit)
+ALL_MODELS = '*'
+
+
+class KeyPoolExhausted(Exception):
+    """No API key had budget within the allowed wait"""
+
+
+class TokenBucket:
+    """Continuously refilling budget (requests or tokens per minute)"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.refill_per_second = self.capacity / 60.0
+        self.level = self.capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self, now: float):
+        elapsed = now - self.updated_at
+        if elapsed > 0:
+            self.level = min(self.capacity, self.level + elapsed * self.refill_per_second)
+            self.updated_at = now
+
+    def time_until(self, amount: float, now: float) -> float:
+        """Seconds until `amount` can be consumed (0 if available now)"""
+        self.refill(now)
+        # A single request larger than the whole bucket waits for a full bucket
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.refill_per_second
+
+    def consume(self, amount: float):
+        # May go negative when actual usage exceeds the estimate; that debt refills like any other usage
+        self.level -= amount
+
+    def utilization(self) -> float:
+        return 1.0 - max(self.level, 0.0) / self.capacity
+
+
+class ApiKeyClient:
+    """One API key with its own request/token budgets and SDK clients"""
+
+    def __init__(self, index: int, api_key: str, rpm_limit: int, tpm_limit: int,
+                 breaker_settings: Optional[Dict[str, float]] = None):
+        self.index = index
+        self.api_key = api_key
+        self.requests = TokenBucket(rpm_limit)
+        self.tokens = TokenBucket(tpm_limit)
+        self.in_flight = 0
+        # Gemini quotas are per model, so a 429 on one model leaves the others usable;
+        # ALL_MODELS guards the key as a whole
+        self.breaker_settings = breaker_settings or {}
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.stats = {'calls': 0, 'rate_limited': 0, 'tokens': 0, 'failures': 0}
+        # SDK clients are created on first use by the owner of the pool
+        self.sdk_clients: Dict[Any, Any] = {}
+
+    def breaker(self, model_name: Optional[str]) -> CircuitBreaker:
+        name = model_name or ALL_MODELS
+        if name not in self.breakers:
+            self.breakers[name] = CircuitBreaker(**self.breaker_settings)
+        return self.breakers[name]
+
+    def breaker_wait(self, model_name: Optional[str], now: float) -> float:
+        key_breaker = self.breakers.get(ALL_MODELS)
+        model_breaker = self.breakers.get(model_name) if model_name else None
+        return max(
+            key_breaker.wait_time(now) if key_breaker else 0.0,
+            model_breaker.wait_time(now) if model_breaker else 0.0,
+        )
+
+    def wait_time(self, estimated_tokens: int, now: float, model_name: Optional[str] = None) -> float:
+        """Seconds until this key could accept a request of this size"""
+        return max(
+            self.breaker_wait(model_name, now),
+            self.requests.time_until(1, now),
+            self.tokens.time_until(estimated_tokens, now),
+        )
+
+    def load(self) -> float:
+        """Utilization score used to pick the least-loaded key"""
+        return max(self.requests.utilization(), self.tokens.utilization()) + self.in_flight / self.requests.capacity
+
+
+class ApiKeyPool:
+    """Schedules calls onto the least-loaded API key that has budget left"""
+
+    def __init__(self, api_keys: List[str], rpm_limit: int, tpm_limit: int,
+                 max_wait_seconds: float = 30.0, rate_limit_cooldown: float = 60.0,
+                 breaker_settings: Optional[Dict[str, float]] = None):
+        if not api_keys:
+            raise ValueError("ApiKeyPool needs at least one API key")
+        self.clients = [ApiKeyClient(i, key, rpm_limit, tpm_limit, breaker_settings) for i, key in enumerate(api_keys)]
+        self.max_wait_seconds = max_wait_seconds
+        self.rate_limit_cooldown = rate_limit_cooldown
+        self._lock = threading.Lock()
+
+    def try_acquire(self, estimated_tokens: int, model_name: Optional[str] = None) -> Tuple[Optional[ApiKeyClient], float]:
+        """Reserve budget on the best key, or report how long until one frees up"""
+        with self._lock:
+            now = time.monotonic()
+            best = None
+            shortest_wait = float('inf')
+            for client in self.clients:
+                wait = client.wait_time(estimated_tokens, now, model_name)
+                if wait <= 0:
+                    if best is None or client.load() < best.load():
+                        best = client
+                else:
+                    shortest_wait = min(shortest_wait, wait)
+
+            if best is None:
+                return None, shortest_wait
+
+            for name in (ALL_MODELS, model_name):
+                if name in best.breakers:
+                    best.breakers[name].on_acquire(now)
+            best.requests.consume(1)
+            best.tokens.consume(estimated_tokens)
+            best.in_flight += 1
+            best.stats['calls'] += 1
+            return best, 0.0
+
+    def acquire(self, estimated_tokens: int, max_wait: Optional[float] = None,
+                model_name: Optional[str] = None) -> ApiKeyClient:
+        """Blocking acquire; sleeps only as long as the budget needs to refill"""
+        max_wait = self.max_wait_seconds if max_wait is None else min(max_wait, self.max_wait_seconds)
+        deadline = time.monotonic() + max_wait
+        while True:
+            client, wait = self.try_acquire(estimated_tokens, model_name)
+            if client:
+                return client
+            if time.monotonic() + wait > deadline:
+                raise KeyPoolExhausted(f"No API key has budget within {max_wait:.1f}s")
+            time.sleep(wait)
+
+    async def acquire_async(self, estimated_tokens: int, max_wait: Optional[float] = None,
+                            model_name: Optional[str] = None) -> ApiKeyClient:
+        """Async acquire; yields to the event loop while budgets refill"""
+        max_wait = self.max_wait_seconds if max_wait is None else min(max_wait, self.max_wait_seconds)
+        deadline = time.monotonic() + max_wait
+        while True:
+            client, wait = self.try_acquire(estimated_tokens, model_name)
+            if client:
+                return client
+            if time.monotonic() + wait > deadline:
+                raise KeyPoolExhausted(f"No API key has budget within {max_wait:.1f}s")
+            await asyncio.sleep(wait)
+
+    def release(self, client: ApiKeyClient, estimated_tokens: int, actual_tokens: Optional[int] = None,
+                model_name: Optional[str] = None):
+        """Finish a call and reconcile the token estimate with actual usage
+
+        With `model_name`, the call succeeded on that model: its breakers close.
+        """
+        with self._lock:
+            client.in_flight = max(0, client.in_flight - 1)
+            if actual_tokens:
+                client.tokens.consume(actual_tokens - estimated_tokens)
+                client.stats['tokens'] += actual_tokens
+            if model_name:
+                for name in (ALL_MODELS, model_name):
+                    if name in client.breakers:
+                        client.breakers[name].record_success()
+
+    def record_failure(self, client: ApiKeyClient, estimated_tokens: int, model_name: Optional[str],
+                       error: Union[BaseException, str], retry_after: Optional[float] = None) -> str:
+        """Finish a failed call and update the key's health; returns classify_error's kind
+
+        Rate limits open the model's breaker until the retry delay or the
+        daily quota reset, a bad key opens the key's own breaker, an unknown
+        model opens the model's breaker for as long as breakers stay open,
+        and server errors count towards opening the model's. Request errors
+        leave health alone.
+        """
+        kind = classify_error(error)
+        error_str = str(error)
+        if kind in (RATE_LIMITED, DAILY_QUOTA):
+            open_for = seconds_until_quota_reset() if kind == DAILY_QUOTA else retry_after
+            self.mark_rate_limited(client, open_for, model_name, error_str, kind)
+            return kind
+
+        with self._lock:
+            client.in_flight = max(0, client.in_flight - 1)
+            now = time.monotonic()
+            if kind == AUTH:
+                client.stats['failures'] += 1
+                breaker = client.breaker(None)
+                breaker.trip(now, kind, error_str, breaker.max_open_seconds)
+            elif kind == NOT_FOUND and model_name:
+                client.stats['failures'] += 1
+                breaker = client.breaker(model_name)
+                breaker.trip(now, kind, error_str, breaker.max_open_seconds)
+            elif kind == SERVER:
+                client.stats['failures'] += 1
+                client.breaker(model_name).record_failure(now, kind, error_str)
+        return kind
+
+    def mark_rate_limited(self, client: ApiKeyClient, retry_after: Optional[float] = None,
+                          model_name: Optional[str] = None, error_str: str = '429', kind: str = RATE_LIMITED):
+        """A 429 slipped through: take the key (or just this model on it) out of rotation until its quota refills"""
+        with self._lock:
+            client.in_flight = max(0, client.in_flight - 1)
+            client.stats['rate_limited'] += 1
+            if not model_name:
+                client.requests.level = min(client.requests.level, 0.0)
+            client.breaker(model_name).trip(time.monotonic(), kind, error_str, retry_after or self.rate_limit_cooldown)
+
+    def headroom(self, model_name: Optional[str] = None) -> float:
+        """Share of the pool's request and token budget free right now (0 to 1), counting only usable keys"""
+        with self._lock:
+            now = time.monotonic()
+            free = 0.0
+            for client in self.clients:
+                if client.breaker_wait(model_name, now) > 0:
+                    continue
+                client.requests.refill(now)
+                client.tokens.refill(now)
+                free += max(1.0 - client.load(), 0.0)
+            return free / len(self.clients)
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """Per-key budget and usage view for logging"""
+        with self._lock:
+            now = time.monotonic()
+            snapshot = []
+            for client in self.clients:
+                client.requests.refill(now)
+                client.tokens.refill(now)
+                snapshot.append({
+                    'index': client.index,
+                    'requests_available': round(client.requests.level, 2),
+                    'tokens_available': int(client.tokens.level),
+                    'in_flight': client.in_flight,
+                    'cooling_down': client.breaker_wait(None, now) > 0,
+                    'models_cooling_down': sorted(
+                        name for name, breaker in client.breakers.items() if name != ALL_MODELS and breaker.wait_time(now) > 0
+                    ),
+                    **client.stats,
+                })
+            return snapshot
+
+    def health(self) -> Dict[str, Any]:
+        """Breaker state per key and model, and which models have a usable key right now"""
+        with self._lock:
+            now = time.monotonic()
+            keys = []
+            models = set()
+            for client in self.clients:
+                breakers = {name: breaker.snapshot(now) for name, breaker in sorted(client.breakers.items())}
+                keys.append({'index': client.index, 'breakers': breakers})
+                models.update(name for name in breakers if name != ALL_MODELS)
+            usable_keys = sum(client.breaker_wait(None, now) == 0 for client in self.clients)
+            # Models that have had a failure -> keys whose breakers would let a call through now
+            usable = {name: sum(client.breaker_wait(name, now) == 0 for client in self.clients) for name in sorted(models)}
+            return {
+                'keys': keys,
+                'usable_keys': usable_keys,
+                'usable_keys_per_model': usable,
+                'healthy': usable_keys > 0 and all(usable.values()),
+            }
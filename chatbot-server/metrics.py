@@ -0,0 +1,151 @@
+import bisect
+import json
+import os
+import sys
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+# Upper bounds (seconds) of the stage latency histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class _NullSpan:
+    """What span() returns when metrics are off: entering and leaving it does nothing"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ('metrics', 'stage', 'model', 'started')
+
+    def __init__(self, metrics: 'Metrics', stage: str, model: str):
+        self.metrics = metrics
+        self.stage = stage
+        self.model = model
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.stage, time.perf_counter() - self.started, self.model)
+        return False
+
+
+class Metrics:
+    """Stage latency histograms and per-key / per-model counters
+
+    `with metrics.span('gemini_call', model_name):` times a stage;
+    `metrics.count('rate_limited', key=..., model=...)` bumps a counter.
+    When disabled both are no-ops (a shared null span, an early return).
+    Exported as Prometheus text or as a JSON snapshot.
+    """
+
+    def __init__(self, enabled: bool = True, prefix: str = 'study_buddy', buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.enabled = enabled
+        self.prefix = prefix
+        self.buckets = buckets
+        # (stage, model) -> [per-bucket counts..., +Inf count, sum of seconds]
+        self._stages: Dict[Tuple[str, str], list] = {}
+        # (name, key, model) -> value
+        self._counters: Dict[Tuple[str, str, str], float] = {}
+        self._lock = threading.Lock()
+        self._dump_thread = None
+
+    def span(self, stage: str, model: str = ''):
+        if not self.enabled:
+            return NULL_SPAN
+        return _Span(self, stage, model)
+
+    def observe(self, stage: str, seconds: float, model: str = ''):
+        if not self.enabled:
+            return
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._stages.get((stage, model))
+            if series is None:
+                series = self._stages[(stage, model)] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += seconds
+
+    def count(self, name: str, value: float = 1, key: Any = '', model: str = ''):
+        if not self.enabled:
+            return
+        labels = (name, str(key), model)
+        with self._lock:
+            self._counters[labels] = self._counters.get(labels, 0) + value
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            stages = {}
+            for (stage, model), series in sorted(self._stages.items()):
+                count = sum(series[:-1])
+                stages[f"{stage}|{model}" if model else stage] = {
+                    'count': count,
+                    'total_ms': round(series[-1] * 1000, 1),
+                    'mean_ms': round(series[-1] * 1000 / count, 2) if count else 0.0,
+                }
+            counters = {}
+            for (name, key, model), value in sorted(self._counters.items()):
+                labels = ','.join(part for part in (f"key={key}" if key else '', f"model={model}" if model else '') if part)
+                counters[f"{name}{{{labels}}}" if labels else name] = value
+            return {'enabled': self.enabled, 'stages': stages, 'counters': counters}
+
+    def render_prometheus(self) -> str:
+        """Prometheus text exposition format"""
+        prefix = self.prefix
+        lines = [f"# TYPE {prefix}_stage_seconds histogram"]
+        with self._lock:
+            for (stage, model), series in sorted(self._stages.items()):
+                labels = f'stage="{stage}"' + (f',model="{model}"' if model else '')
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, series):
+                    cumulative += bucket_count
+                    lines.append(f'{prefix}_stage_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                cumulative += series[len(self.buckets)]
+                lines.append(f'{prefix}_stage_seconds_bucket{{{labels},le="+Inf"}} {cumulative}')
+                lines.append(f'{prefix}_stage_seconds_sum{{{labels}}} {series[-1]:.6f}')
+                lines.append(f'{prefix}_stage_seconds_count{{{labels}}} {cumulative}')
+
+            names = sorted({name for name, _, _ in self._counters})
+            for name in names:
+                lines.append(f"# TYPE {prefix}_{name}_total counter")
+                for (counter, key, model), value in sorted(self._counters.items()):
+                    if counter != name:
+                        continue
+                    labels = ','.join(part for part in (f'key="{key}"' if key else '', f'model="{model}"' if model else '') if part)
+                    lines.append(f"{prefix}_{name}_total{{{labels}}} {value:g}" if labels else f"{prefix}_{name}_total {value:g}")
+        return '\n'.join(lines) + '\n'
+
+    def dump_json(self, path: str):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(dict(self.snapshot(), dumped_at=time.time()), f)
+        os.replace(tmp_path, path)
+
+    def start_periodic_dump(self, path: str, interval_seconds: float) -> Optional[threading.Thread]:
+        """Write the JSON snapshot to `path` every `interval_seconds` from a daemon thread"""
+        if not self.enabled or self._dump_thread is not None:
+            return self._dump_thread
+
+        def run():
+            while True:
+                time.sleep(interval_seconds)
+                try:
+                    self.dump_json(path)
+                except OSError as e:
+                    print(f"Metrics dump to {path} failed: {e}", file=sys.stderr)
+
+        self._dump_thread = threading.Thread(target=run, name='metrics-dump', daemon=True)
+        self._dump_thread.start()
+        return self._dump_thread
@@ -0,0 +1,99 @@
+import threading
+import time
+from typing import Dict, List, Optional
+
+
+class RoutePlan:
+    """Ordered model candidates for one request, sharing one latency budget"""
+
+    def __init__(self, candidates: List[str], budget_ms: float, deadline: Optional[float] = None,
+                 attempt_share: float = 0.6):
+        self.candidates = candidates
+        self.budget_ms = budget_ms
+        self.attempt_share = attempt_share
+        self.deadline = deadline if deadline is not None else time.monotonic() + budget_ms / 1000
+        self.model_used = None
+
+    @property
+    def primary(self) -> str:
+        return self.candidates[0]
+
+    def remaining(self) -> float:
+        """Seconds left in the budget"""
+        return self.deadline - time.monotonic()
+
+    def attempt_timeout(self, index: int) -> float:
+        """Seconds the candidate at `index` may take; earlier ones leave room for a fallback"""
+        remaining = self.remaining()
+        return remaining if index == len(self.candidates) - 1 else remaining * self.attempt_share
+
+    def fork(self) -> 'RoutePlan':
+        """Same candidates and deadline, separate model_used (for racing calls)"""
+        return RoutePlan(self.candidates, self.budget_ms, self.deadline, self.attempt_share)
+
+    def cancel(self):
+        """End the budget now, so no further candidate is tried (for the losing racing call)"""
+        self.deadline = time.monotonic()
+
+
+class ModelRouter:
+    """Picks models by question type and skips ones too slow for the remaining budget
+
+    `routes` maps a question type to model tiers (keys of `models`) in the
+    order they are tried; unknown types use the 'conceptual' route.
+    """
+
+    def __init__(self, models: Dict[str, str], default_budget_ms: float, routes: Dict[str, List[str]],
+                 smoothing: float = 0.2, attempt_share: float = 0.6):
+        self.models = models
+        self.default_budget_ms = default_budget_ms
+        self.routes = routes
+        self.smoothing = smoothing
+        self.attempt_share = attempt_share
+        self.latency_ewma: Dict[str, float] = {}
+        self.stats: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def plan(self, insights: Dict, latency_budget_ms: Optional[float] = None) -> RoutePlan:
+        tiers = self.routes.get(insights.get('question_type'), self.routes['conceptual'])
+        candidates = []
+        for tier in tiers:
+            model_name = self.models[tier]
+            if model_name not in candidates:
+                candidates.append(model_name)
+        budget_ms = float(latency_budget_ms) if latency_budget_ms else self.default_budget_ms
+        return RoutePlan(candidates, budget_ms, attempt_share=self.attempt_share)
+
+    def record(self, model_name: str, outcome: str, seconds: Optional[float] = None):
+        """Track per-model outcomes ('ok', 'fallback', 'skipped_slow') and latency"""
+        with self._lock:
+            counts = self.stats.setdefault(model_name, {})
+            counts[outcome] = counts.get(outcome, 0) + 1
+            if outcome == 'skipped_slow' and model_name in self.latency_ewma:
+                # Decay so a skipped model is probed again once it may have recovered
+                self.latency_ewma[model_name] *= 1 - self.smoothing
+            if seconds is not None:
+                previous = self.latency_ewma.get(model_name)
+                self.latency_ewma[model_name] = seconds if previous is None else \
+                    previous + self.smoothing * (seconds - previous)
+
+    def is_too_slow(self, model_name: str, remaining_seconds: float) -> bool:
+        """True if this model's recent latency would overrun the remaining budget"""
+        expected = self.latency_ewma.get(model_name)
+        return expected is not None and expected > remaining_seconds
+
+    def pick(self, route: RoutePlan) -> str:
+        """First candidate expected to finish within the budget (the last one otherwise)"""
+        remaining = route.remaining()
+        for model_name in route.candidates[:-1]:
+            if not self.is_too_slow(model_name, remaining):
+                return model_name
+            self.record(model_name, 'skipped_slow')
+        return route.candidates[-1]
+
+    def snapshot(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {
+                model_name: dict(counts, latency_ewma_ms=round(self.latency_ewma.get(model_name, 0) * 1000, 1))
+                for model_name, counts in self.stats.items()
+            }
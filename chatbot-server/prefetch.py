@@ -0,0 +1,123 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from response_cache import normalize_text
+
+# Words a student may add around a suggested topic ("tell me about ...", "explain ... please")
+MAX_EXTRA_WORDS = 4
+
+
+def topic_matches(user_message: str, topic: str) -> bool:
+    """True if the message asks for the suggested topic: the topic itself, or the topic with a few words around it"""
+    message, topic = normalize_text(user_message), normalize_text(topic)
+    if not topic:
+        return False
+    if message == topic:
+        return True
+    return f" {topic} " in f" {message} " and len(message.split()) - len(topic.split()) <= MAX_EXTRA_WORDS
+
+
+class PrefetchEntry:
+    __slots__ = ('topic', 'task')
+
+    def __init__(self, topic: str, task: asyncio.Task):
+        self.topic = topic
+        self.task = task
+
+
+class Prefetcher:
+    """Background answers to a chat's suggested next topics, used if the student asks for one next
+
+    schedule() starts one task per topic (the previous turn's prefetches
+    for the chat are cancelled); take() hands over the matching answer,
+    waiting for it if it is still being generated, and cancels the rest.
+    A next turn that asks for none of them (the student diverged) cancels
+    them all. Prefetches older than `ttl_seconds` are dropped. Must be used
+    from one event loop.
+    """
+
+    def __init__(self, max_topics: int = 2, max_chats: int = 500, ttl_seconds: float = 600):
+        self.max_topics = max_topics
+        self.max_chats = max_chats
+        self.ttl_seconds = ttl_seconds
+        # chat_id -> (scheduled at, entries), oldest chat first
+        self._chats: 'OrderedDict[str, tuple]' = OrderedDict()
+        self.stats_counts = {'scheduled': 0, 'completed': 0, 'failed': 0, 'cancelled': 0,
+                             'turns': 0, 'hits': 0, 'hits_in_flight': 0, 'diverged': 0, 'expired': 0}
+
+    def _on_done(self, task: asyncio.Task):
+        if task.cancelled():
+            self.stats_counts['cancelled'] += 1
+        elif task.exception() is not None:
+            self.stats_counts['failed'] += 1
+        else:
+            self.stats_counts['completed'] += 1
+
+    def _cancel(self, entries: List[PrefetchEntry]):
+        for entry in entries:
+            entry.task.cancel()
+
+    def schedule(self, chat_id: str, topics: List[str], generate: Callable[[str], Awaitable[Dict[str, Any]]]) -> int:
+        """Start prefetching up to max_topics of `topics` for this chat; returns how many were started"""
+        self.forget(chat_id)
+        entries = []
+        seen = set()
+        for topic in topics:
+            key = normalize_text(topic)
+            if not key or key in seen:
+                continue
+            seen.add(key)
+            task = asyncio.ensure_future(generate(topic))
+            task.add_done_callback(self._on_done)
+            entries.append(PrefetchEntry(topic, task))
+            if len(entries) >= self.max_topics:
+                break
+        if entries:
+            self._chats[chat_id] = (time.monotonic(), entries)
+            self.stats_counts['scheduled'] += len(entries)
+            while len(self._chats) > self.max_chats:
+                _, (_, evicted) = self._chats.popitem(last=False)
+                self._cancel(evicted)
+        return len(entries)
+
+    async def take(self, chat_id: str, user_message: str) -> Optional[Dict[str, Any]]:
+        """The prefetched result this message asks for, or None; either way the chat's prefetches are used up"""
+        scheduled = self._chats.pop(chat_id, None)
+        if scheduled is None:
+            return None
+        scheduled_at, entries = scheduled
+        self.stats_counts['turns'] += 1
+        if time.monotonic() - scheduled_at > self.ttl_seconds:
+            self.stats_counts['expired'] += 1
+            self._cancel(entries)
+            return None
+
+        match = next((entry for entry in entries if topic_matches(user_message, entry.topic)), None)
+        self._cancel([entry for entry in entries if entry is not match])
+        if match is None:
+            self.stats_counts['diverged'] += 1
+            return None
+
+        in_flight = not match.task.done()
+        try:
+            result = await match.task
+        except Exception:
+            return None
+        if not result or not result.get('success'):
+            return None
+        self.stats_counts['hits'] += 1
+        if in_flight:
+            self.stats_counts['hits_in_flight'] += 1
+        return result
+
+    def forget(self, chat_id: str):
+        scheduled = self._chats.pop(chat_id, None)
+        if scheduled is not None:
+            self._cancel(scheduled[1])
+
+    def stats(self) -> Dict[str, Any]:
+        turns = self.stats_counts['turns']
+        return dict(self.stats_counts, chats=len(self._chats),
+                    hit_rate=round(self.stats_counts['hits'] / turns, 4) if turns else 0.0)
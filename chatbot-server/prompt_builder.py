@@ -0,0 +1,240 @@
+import json
+import re
+import string
+from typing import Any, Dict, List, Optional, Tuple
+
+WORD = re.compile(r'\w+')
+SYMBOL = re.compile(r'[^\w\s]')
+
+QUIZ_INSTRUCTIONS = """
+You are Study Buddy, an adaptive AI tutor analyzing a student's quiz responses.
+
+## Your Task:
+Evaluate the student's quiz responses and provide adaptive feedback using the structured output format.
+CRITICAL: Always populate the 'response_text' field with a complete, conversational response.
+
+## Key Behaviors:
+1. **Accurate Assessment**: Fairly evaluate responses and provide constructive feedback
+2. **Adaptive Planning**: Adjust difficulty and suggest next steps based on performance
+3. **Encouraging Tone**: Always be supportive while being honest about areas for improvement
+4. **Proactive Guidance**: Suggest specific actions and next topics
+"""
+
+QUIZ_TURN = """
+## Current Session Analysis:
+- Subject Area: {subject_area}
+- Question Type: {question_type}
+- Detected Difficulty: {difficulty_level}
+
+## Context: {context}
+
+CRITICAL: You must follow the structured output schema exactly and provide meaningful content in response_text.
+"""
+
+STUDY_INSTRUCTIONS = """
+You are Study Buddy, an advanced adaptive AI tutor with sophisticated agentic capabilities.
+
+## Your Agentic Mission:
+Execute a 4-phase adaptive tutoring response that's highly interactive and personalized.
+
+### Phase 1 - Intelligent Analysis 🧠
+- Assess the student's current level based on their question
+- Identify the most effective learning approach for this specific query
+- Detect any misconceptions or knowledge gaps
+
+### Phase 2 - Adaptive Teaching 📚
+- Deliver explanation using the optimal teaching method (step-by-step, analogies, examples, etc.)
+- Match complexity to student level - never too simple or too advanced
+- Include concrete examples and practical applications
+- Make it engaging and relatable
+
+### Phase 3 - Interactive Assessment 🎯
+- ALWAYS include a follow-up question to check understanding
+- When appropriate, offer a mini-quiz with 2-3 targeted questions
+- Create questions that test both comprehension and application
+- Make assessment feel natural, not intimidating
+
+### Phase 4 - Proactive Next Steps 💡
+- Suggest related concepts to explore next
+- Provide specific study recommendations
+- Always end with an engaging follow-up question or interaction
+- Be encouraging and build confidence
+
+## Critical Output Requirements:
+- ALWAYS populate 'response_text' with a complete, natural conversational response
+- Combine all phases into flowing, engaging text
+- Make it sound like a helpful tutor having a conversation
+- Include the main explanation, follow-up questions, and encouragement
+"""
+
+STUDY_TURN = """
+## Current Learning Context:
+- Subject Area: {subject_area}
+- Question Type: {question_type}
+- Detected Difficulty Level: {difficulty_level}
+- Student Confidence: {confidence_level}
+
+## Session Context: {context}
+
+Remember: You must respond using the structured output format with meaningful response_text that flows naturally.
+"""
+
+STRUCTURED_SUFFIX = """
+
+IMPORTANT: Provide a complete JSON response following the schema.
+The 'response_text' field must contain a full conversational response that naturally incorporates:
+- A clear explanation of the topic
+- Engaging examples or analogies
+- A follow-up question to check understanding
+- Encouraging tone throughout
+
+Make it sound like a knowledgeable, friendly tutor having a natural conversation."""
+
+PLAIN_SUFFIX = """
+
+Please provide a comprehensive response about this topic. Be engaging, clear, and educational."""
+
+SCHEMA_INTRO = """
+Respond with a single JSON object that follows this JSON schema:
+"""
+
+SCHEMA_OUTRO = """
+The "response_text" key MUST be the first key in the object.
+"""
+
+STREAMING_SUFFIX = """
+
+Respond with one JSON object that follows the schema above; "response_text" MUST be its first key."""
+
+
+def estimate_tokens(text: str) -> int:
+    """Local token estimate: a token per word or symbol, plus one per 8 characters of long words
+
+    Close enough to Gemini's tokenizer on English tutoring text to budget
+    prompts and reserve quota without a round trip to count_tokens.
+    """
+    if not text:
+        return 0
+    words = WORD.findall(text)
+    return len(words) + len(SYMBOL.findall(text)) + sum(len(word) // 8 for word in words)
+
+
+def fit_context(context: str, token_budget: int) -> Tuple[str, bool]:
+    """(context, truncated): the context as is, or its newest lines that fit the budget
+
+    Dropped lines are replaced by a one-line note; a newest line that alone
+    is over the budget keeps only its end.
+    """
+    context = (context or '').strip()
+    if estimate_tokens(context) <= token_budget:
+        return context, False
+
+    # Room for the omission note
+    used = 8
+    if token_budget <= used:
+        return '', True
+    lines = context.split('\n')
+    kept: List[str] = []
+    for line in reversed(lines):
+        cost = estimate_tokens(line) + 1
+        if used + cost > token_budget:
+            break
+        kept.append(line)
+        used += cost
+
+    if not kept:
+        # About four characters per token; shrink until the estimate agrees
+        newest = lines[-1]
+        tail = newest[max(len(newest) - (token_budget - used) * 4, 0):]
+        while tail and estimate_tokens(tail) > token_budget - used:
+            tail = tail[len(tail) // 8 + 1:]
+        kept.append('...' + tail if tail else '')
+    omitted = len(lines) - len(kept)
+    note = f"[{omitted} earlier lines omitted]" if omitted else "[earlier text omitted]"
+    return '\n'.join([note] + [line for line in reversed(kept) if line]), True
+
+
+class PromptTemplate:
+    """A system prompt split into constant instructions and a per-turn part, parsed once
+
+    The instructions always come first, so every prompt built from the
+    template starts with the same text (see PromptBuilder.split_static).
+    """
+
+    def __init__(self, instructions: str, turn: str):
+        self.instructions = instructions
+        self.instruction_tokens = estimate_tokens(instructions)
+        self._turn = [(literal, field) for literal, field, _, _ in string.Formatter().parse(turn)]
+
+    def render_turn(self, fields: Dict[str, Any]) -> str:
+        parts = []
+        for literal, field in self._turn:
+            parts.append(literal)
+            if field is not None:
+                parts.append(str(fields[field]))
+        return ''.join(parts)
+
+
+QUIZ_TEMPLATE = PromptTemplate(QUIZ_INSTRUCTIONS, QUIZ_TURN)
+STUDY_TEMPLATE = PromptTemplate(STUDY_INSTRUCTIONS, STUDY_TURN)
+
+
+class PromptBuilder:
+    """Assembles study and quiz prompts from precompiled templates within a context budget
+
+    The caller's context is cut to `context_token_budget` estimated tokens
+    (fit_context); everything else is constant text or a few insight fields.
+    """
+
+    def __init__(self, context_token_budget: int = 2000):
+        self.context_token_budget = context_token_budget
+        # (is_quiz_response, id(schema)) -> (schema, constant prefix); the schemas are module constants
+        self._prefixes: Dict[Tuple[bool, Optional[int]], Tuple[Optional[Dict[str, Any]], str]] = {}
+        self.truncated_contexts = 0
+
+    def template(self, is_quiz_response: bool) -> PromptTemplate:
+        return QUIZ_TEMPLATE if is_quiz_response else STUDY_TEMPLATE
+
+    def prefix(self, is_quiz_response: bool, schema: Optional[Dict[str, Any]] = None) -> str:
+        """The constant start of a system prompt: the instructions, then the schema as text if given"""
+        key = (is_quiz_response, id(schema) if schema is not None else None)
+        cached = self._prefixes.get(key)
+        if cached is None or cached[0] is not schema:
+            text = self.template(is_quiz_response).instructions
+            if schema is not None:
+                text = ''.join((text, SCHEMA_INTRO, json.dumps(schema, separators=(',', ':')), SCHEMA_OUTRO))
+            cached = self._prefixes[key] = (schema, text)
+        return cached[1]
+
+    def split_static(self, prompt: str) -> Tuple[str, str]:
+        """(constant prefix, per-turn rest) of a prompt built here; ('', prompt) if it has none"""
+        for text in sorted((text for _, text in self._prefixes.values()), key=len, reverse=True):
+            if prompt.startswith(text):
+                return text, prompt[len(text):]
+        return '', prompt
+
+    def system_prompt(self, insights: Dict, context: str, is_quiz_response: bool = False,
+                      schema: Optional[Dict[str, Any]] = None) -> str:
+        """Instructions (with `schema` embedded for calls that cannot pass it as config) and this turn's details"""
+        context, truncated = fit_context(context, self.context_token_budget)
+        if truncated:
+            self.truncated_contexts += 1
+        turn = self.template(is_quiz_response).render_turn(dict(insights, context=context))
+        return self.prefix(is_quiz_response, schema) + turn
+
+    def structured_prompt(self, system_prompt: str, user_message: str) -> str:
+        return ''.join((system_prompt, "\n\nStudent Message: ", user_message, STRUCTURED_SUFFIX))
+
+    def plain_prompt(self, system_prompt: str, user_message: str) -> str:
+        return ''.join((system_prompt, "\n\nStudent Message: ", user_message, PLAIN_SUFFIX))
+
+    def streaming_prompt(self, system_prompt: str, user_message: str) -> str:
+        """For a system prompt built with its schema embedded"""
+        return ''.join((self.structured_prompt(system_prompt, user_message), STREAMING_SUFFIX))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'context_token_budget': self.context_token_budget,
+            'truncated_contexts': self.truncated_contexts,
+            'instruction_tokens': {'study': STUDY_TEMPLATE.instruction_tokens, 'quiz': QUIZ_TEMPLATE.instruction_tokens},
+        }
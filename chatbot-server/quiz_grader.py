@@ -0,0 +1,212 @@
+import re
+from fractions import Fraction
+from typing import Any, Dict, List, Optional
+
+# "Q1: ...", "q2) ...", "Question 3 - ..."; an answer runs until the next marker
+ANSWER_MARKER = re.compile(r'\b(?:q|question\s*)(\d+)\s*[:.)\-]\s*', re.IGNORECASE)
+# "B", "(b)", "B) Mitochondria", "b. mitochondria"; not the article in "a mitochondrion"
+CHOICE_LETTER = re.compile(r'^(?:\(([a-f])\)|([a-f])(?:[.):]|$))\s*', re.IGNORECASE)
+# "3.5 x 10^4", "3.5 × 10^-4", "3.5*10^4", read as 3.5e4
+SCIENTIFIC = re.compile(r'(-?\d+(?:\.\d+)?)\s*(?:x|×|\*)\s*10\s*\^\s*(-?\d+)', re.IGNORECASE)
+NUMBER = re.compile(r'-?\d[\d,]*(?:\.\d+)?(?:e-?\d+)?(?:\s*/\s*\d+)?|-?\.\d+', re.IGNORECASE)
+
+TRUE_WORDS = frozenset(['true', 't', 'yes', 'y', 'correct', 'right'])
+FALSE_WORDS = frozenset(['false', 'f', 'no', 'n', 'incorrect', 'wrong'])
+
+# Relative tolerance for calculation answers (rounding in the student's working)
+NUMERIC_TOLERANCE = 0.01
+
+
+def normalize_answer(text: str) -> str:
+    """Lowercase words only, for comparing free wording of the same answer"""
+    return ' '.join(re.findall(r'[a-z0-9]+', (text or '').lower()))
+
+
+def parse_answers(message: str) -> Dict[int, str]:
+    """Question number -> answer text from a "Q1: ... Q2: ..." message"""
+    markers = list(ANSWER_MARKER.finditer(message or ''))
+    answers = {}
+    for marker, following in zip(markers, markers[1:] + [None]):
+        end = following.start() if following else len(message)
+        answer = message[marker.end():end].strip().rstrip(',;').strip()
+        if answer:
+            answers[int(marker.group(1))] = answer
+    return answers
+
+
+def parse_number(text: str) -> Optional[float]:
+    """The one number in the text, or None if there is none or more than one (the model must read it)"""
+    text = SCIENTIFIC.sub(lambda m: f"{m.group(1)}e{m.group(2)}", text or '')
+    matches = NUMBER.findall(text)
+    if len(matches) != 1:
+        return None
+    value = matches[0].replace(',', '').replace(' ', '')
+    try:
+        return float(Fraction(value)) if '/' in value else float(value)
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+def parse_truth(text: str) -> Optional[bool]:
+    """True/False from a plain yes/no style answer, or None if it is worded any other way ("not true")"""
+    words = normalize_answer(text).split()
+    if not words:
+        return None
+    if words[0] in TRUE_WORDS:
+        return True
+    if words[0] in FALSE_WORDS:
+        return False
+    return None
+
+
+def split_choice(text: str):
+    """(letter or None, the option text without its letter)"""
+    text = (text or '').strip()
+    match = CHOICE_LETTER.match(text)
+    if match:
+        return (match.group(1) or match.group(2)).lower(), normalize_answer(text[match.end():])
+    return None, normalize_answer(text)
+
+
+def grade_answer(question: Dict[str, Any], answer: str) -> Optional[bool]:
+    """Whether the answer is right, or None if this question needs the model to judge
+
+    Only answers that parse cleanly on both sides are graded here; anything
+    else (a negated truth value, several numbers, a letter against a key
+    with no letter, any wording of an option other than its exact text)
+    goes to the model.
+    """
+    kind = question.get('type')
+    correct = question.get('correct_answer') or ''
+    if kind == 'true_false':
+        expected, given = parse_truth(correct), parse_truth(answer)
+        if expected is None or given is None:
+            return None
+        return given == expected
+    if kind == 'calculation':
+        expected, given = parse_number(correct), parse_number(answer)
+        if expected is None or given is None:
+            return None
+        return abs(given - expected) <= max(abs(expected) * NUMERIC_TOLERANCE, 1e-9)
+    if kind == 'multiple_choice':
+        expected_letter, expected_text = split_choice(correct)
+        given_letter, given_text = split_choice(answer)
+        letters_differ = bool(expected_letter and given_letter and expected_letter != given_letter)
+        if expected_text and given_text == expected_text:
+            # "C) Mitochondria" against "B) Mitochondria" could be either slip
+            return None if letters_differ else True
+        if expected_letter and given_letter and (not given_text or letters_differ):
+            return not letters_differ
+        return None
+    return None
+
+
+def performance_level(score: float) -> str:
+    if score >= 90:
+        return 'excellent'
+    if score >= 70:
+        return 'good'
+    if score >= 50:
+        return 'needs_improvement'
+    return 'requires_review'
+
+
+def clip_question(text: str, max_chars: int = 80) -> str:
+    text = re.sub(r'\s+', ' ', text or '').strip()
+    return text if len(text) <= max_chars else text[:max_chars - 3].rstrip() + '...'
+
+
+class QuizGrading:
+    """Per-question outcomes of one quiz turn; `needs_model` lists answers only the model can judge"""
+
+    def __init__(self, quiz: List[Dict[str, Any]], answers: Dict[int, str]):
+        self.quiz = quiz
+        self.answers = answers
+        self.results: List[Dict[str, Any]] = []
+        self.needs_model: List[int] = []
+        for number, question in enumerate(quiz, start=1):
+            answer = answers.get(number)
+            # A skipped question is left to the model too, which sees it as "(no answer)"
+            correct = grade_answer(question, answer) if answer is not None else None
+            if correct is None:
+                self.needs_model.append(number)
+            self.results.append({
+                'question_number': number,
+                'type': question.get('type'),
+                'student_answer': answer,
+                'correct_answer': question.get('correct_answer'),
+                'correct': correct,
+            })
+
+    @property
+    def local(self) -> bool:
+        """True if every question was graded here"""
+        return not self.needs_model
+
+    def answer_key_context(self) -> str:
+        """What was graded here, for the model to build on when it must judge the rest"""
+        lines = ["Answer key for the quiz the student is answering:"]
+        for result, question in zip(self.results, self.quiz):
+            line = (f"Q{result['question_number']} ({result['type']}): {clip_question(question.get('question', ''))} "
+                    f"Correct answer: {result['correct_answer']}. Student answered: {result['student_answer'] or '(no answer)'}")
+            if result['correct'] is not None:
+                line += f" - graded {'correct' if result['correct'] else 'incorrect'}."
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def structured_response(self) -> Dict[str, Any]:
+        """quiz_evaluation / adaptive_response / next_action and response_text in QUIZ_RESPONSE_SCHEMA's shape"""
+        total = len(self.results)
+        right = sum(1 for result in self.results if result['correct'])
+        score = round(100 * right / total) if total else 0
+        level = performance_level(score)
+        missed = [(result, question) for result, question in zip(self.results, self.quiz) if not result['correct']]
+
+        feedback = []
+        for result, question in zip(self.results, self.quiz):
+            number = result['question_number']
+            if result['correct']:
+                feedback.append(f"✅ Q{number}: correct!")
+                continue
+            given = result['student_answer']
+            line = f"❌ Q{number}: " + (f"you answered \"{given}\", " if given else "no answer given; ")
+            line += f"the correct answer is {result['correct_answer']}."
+            if question.get('explanation'):
+                line += f" {question['explanation']}"
+            feedback.append(line)
+
+        if score >= 90:
+            opener, follow_up, action, difficulty = (
+                "Excellent work!", "Ready for some harder questions on this topic?", 'advance_topic', 'harder')
+        elif score >= 60:
+            opener, follow_up, action, difficulty = (
+                "Good effort!", "Would you like to go over the ones you missed?", 'continue_topic', 'same')
+        else:
+            opener, follow_up, action, difficulty = (
+                "Thanks for trying these!", "Shall we review the basics together before another quiz?", 'review_basics', 'easier')
+
+        detailed_feedback = '\n'.join(feedback)
+        response_text = (f"{opener} You got {right} out of {total} right ({score}%).\n\n{detailed_feedback}\n\n{follow_up}")
+        return {
+            'quiz_evaluation': {
+                'overall_score': score,
+                'performance_level': level,
+                'strengths_identified': [clip_question(question.get('question', ''))
+                                         for result, question in zip(self.results, self.quiz) if result['correct']],
+                'areas_for_improvement': [clip_question(question.get('question', '')) for _, question in missed],
+                'detailed_feedback': detailed_feedback,
+                'question_results': self.results,
+            },
+            'adaptive_response': {
+                'next_difficulty_level': difficulty,
+                'reinforcement_needed': score < 70,
+                'topics_to_review': [clip_question(question.get('question', '')) for _, question in missed],
+                'ready_for_advancement': score >= 80,
+            },
+            'response_text': response_text,
+            'next_action': {
+                'recommended_action': action,
+                'follow_up_question': follow_up,
+                'new_quiz_available': True,
+            },
+        }
@@ -0,0 +1,159 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+
+def normalize_text(text: str) -> str:
+    """Lowercase, collapse whitespace and drop trailing punctuation"""
+    return re.sub(r'\s+', ' ', text or '').strip().lower().rstrip('?!.')
+
+
+class SQLiteCacheBackend:
+    """On-disk tier that survives worker restarts"""
+
+    def __init__(self, db_path: str, max_entries: int):
+        self.max_entries = max_entries
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS response_cache ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS response_cache_accessed ON response_cache (accessed_at)')
+        self._conn.commit()
+        self._writes = 0
+
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        row = self._conn.execute('SELECT value, created_at FROM response_cache WHERE key = ?', (key,)).fetchone()
+        if row:
+            self._conn.execute('UPDATE response_cache SET accessed_at = ? WHERE key = ?', (time.time(), key))
+            self._conn.commit()
+        return row
+
+    def set(self, key: str, value: str, created_at: float):
+        self._conn.execute(
+            'INSERT OR REPLACE INTO response_cache (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)',
+            (key, value, created_at, created_at)
+        )
+        self._writes += 1
+        # Trim occasionally rather than on every write
+        if self._writes % 100 == 0:
+            self._conn.execute(
+                'DELETE FROM response_cache WHERE key IN ('
+                'SELECT key FROM response_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,)
+            )
+        self._conn.commit()
+
+    def delete(self, key: str):
+        self._conn.execute('DELETE FROM response_cache WHERE key = ?', (key,))
+        self._conn.commit()
+
+
+class ResponseCache:
+    """Exact-match cache of structured responses with LRU + TTL eviction
+
+    Entries are stored as serialized JSON, so every hit hands out a fresh
+    copy and the memory footprint is measured in bytes, not entries.
+    """
+
+    def __init__(self, max_entries: int = 2048, max_bytes: int = 64 * 1024 * 1024,
+                 ttl_seconds: float = 6 * 3600, db_path: Optional[str] = None,
+                 max_disk_entries: int = 100000):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.disk = SQLiteCacheBackend(db_path, max_disk_entries) if db_path else None
+        self._entries: 'OrderedDict[str, Tuple[str, float]]' = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._schema_fingerprints: Dict[int, str] = {}
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+
+    def make_key(self, user_message: str, context: str, is_quiz_response: bool,
+                 schema: Dict[str, Any], model_name: str) -> str:
+        schema_id = id(schema)
+        if schema_id not in self._schema_fingerprints:
+            schema_json = json.dumps(schema, sort_keys=True)
+            self._schema_fingerprints[schema_id] = hashlib.sha256(schema_json.encode('utf-8')).hexdigest()
+
+        material = json.dumps([
+            normalize_text(user_message),
+            re.sub(r'\s+', ' ', context or '').strip(),
+            bool(is_quiz_response),
+            self._schema_fingerprints[schema_id],
+            model_name,
+        ])
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and now - entry[1] > self.ttl_seconds:
+                self._remove(key)
+                entry = None
+
+            if entry:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return json.loads(entry[0])
+
+            if self.disk:
+                row = self.disk.get(key)
+                if row and now - row[1] <= self.ttl_seconds:
+                    self._insert(key, row[0], row[1])
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return json.loads(row[0])
+                if row:
+                    self.disk.delete(key)
+
+            self.misses += 1
+            return None
+
+    def set(self, key: str, value: Dict[str, Any]):
+        serialized = json.dumps(value, ensure_ascii=False)
+        created_at = time.time()
+        with self._lock:
+            self._insert(key, serialized, created_at)
+            if self.disk:
+                self.disk.set(key, serialized, created_at)
+
+    def _insert(self, key: str, serialized: str, created_at: float):
+        if key in self._entries:
+            self._remove(key)
+        size = len(serialized)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (serialized, created_at)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        serialized, _ = self._entries.pop(key)
+        self._bytes -= len(serialized)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'disk_hits': self.disk_hits,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
@@ -0,0 +1,253 @@
+import importlib.util
+import json
+import os
+import re
+import sys
+import threading
+import time
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+
+# The semantic cache is optional; callers check SEMANTIC_CACHE_AVAILABLE. numpy is
+# imported when the first cache or vectorizer is built, not when this module is
+SEMANTIC_CACHE_AVAILABLE = importlib.util.find_spec('numpy') is not None
+np = None
+
+
+def load_numpy():
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+
+# Filler words that phrase a request without changing what is asked
+STOP_WORDS = frozenset([
+    'a', 'an', 'the', 'is', 'are', 'what', 'explain', 'describe', 'define', 'tell', 'me', 'about',
+    'please', 'can', 'could', 'you', 'i', 'help', 'understand', 'to', 'of', 'do', 'does', 'know',
+])
+
+
+# Words that flip or pin down what is asked while barely moving the vector; they must match
+# exactly ("radius 5" vs "radius 6", "is" vs "is not")
+NUMBER_WORDS = frozenset([
+    'zero', 'one', 'two', 'three', 'four', 'five', 'six', 'seven', 'eight', 'nine', 'ten', 'eleven', 'twelve',
+    'twenty', 'thirty', 'forty', 'fifty', 'hundred', 'thousand', 'million', 'billion', 'half', 'quarter',
+    'double', 'twice', 'triple', 'first', 'second', 'third',
+])
+NEGATION_WORDS = frozenset(['not', 'no', 'never', 'none', 'nor', 'without', 'cannot', 'neither'])
+EXACT_TERM = re.compile(r"-?\d+(?:[.,]\d+)*|[a-z]+n't|[a-z]+")
+
+
+def exact_terms(text: str) -> str:
+    """Numbers and negations in the text, in order; only questions with the same ones may match"""
+    terms = []
+    for term in EXACT_TERM.findall(text.lower()):
+        if term[0].isdigit() or term[0] == '-' or term in NUMBER_WORDS:
+            terms.append(term)
+        elif term in NEGATION_WORDS or term.endswith("n't"):
+            terms.append('not')
+    return ' '.join(terms)
+
+
+class HashedNgramVectorizer:
+    """Embeds text as a signed, hashed bag of words, word bigrams and character trigrams
+
+    Needs no model download and is stable across processes (crc32, not hash()),
+    so persisted vectors stay valid after a restart.
+    """
+
+    def __init__(self, dim: int = 256):
+        load_numpy()
+        self.dim = dim
+
+    def features(self, text: str) -> List[str]:
+        words = [word for word in re.findall(r'[a-z0-9]+', text.lower()) if word not in STOP_WORDS]
+        features = list(words)
+        features.extend(f"{a} {b}" for a, b in zip(words, words[1:]))
+        for word in words:
+            padded = f" {word} "
+            features.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+        return features
+
+    def vectorize(self, text: str):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature in self.features(text):
+            digest = zlib.crc32(feature.encode('utf-8'))
+            sign = 1.0 if digest & 0x80000000 else -1.0
+            vector[digest % self.dim] += sign
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector
+
+
+class SemanticCache:
+    """Nearest-neighbour cache of structured responses for paraphrased questions
+
+    Vectors live in one preallocated float32 matrix, so a lookup is a single
+    matrix-vector product. When full, the least recently used slot is reused.
+    Entries are partitioned by namespace (model, schema, subject, context) and
+    only compared within their own namespace, and only with questions that
+    have the same numbers and negations (exact_terms). With a `path`, the index is
+    saved every `save_every` adds; flush() (run periodically by
+    start_periodic_save and at shutdown) saves whatever is left.
+    """
+
+    def __init__(self, threshold: float = 0.95, capacity: int = 10000, dim: int = 256,
+                 ttl_seconds: float = 6 * 3600, path: Optional[str] = None, save_every: int = 50):
+        if not SEMANTIC_CACHE_AVAILABLE:
+            raise RuntimeError("SemanticCache requires numpy")
+        load_numpy()
+        self.threshold = threshold
+        self.capacity = capacity
+        self.ttl_seconds = ttl_seconds
+        self.path = path
+        self.save_every = save_every
+        self.vectorizer = HashedNgramVectorizer(dim)
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.namespaces = np.zeros(capacity, dtype=np.int64)
+        self.created_at = np.zeros(capacity, dtype=np.float64)
+        self.last_used = np.zeros(capacity, dtype=np.float64)
+        self.payloads: List[Optional[str]] = [None] * capacity
+        self.size = 0
+        self._lock = threading.Lock()
+        # One save at a time: they share the temp files
+        self._save_lock = threading.Lock()
+        self._save_thread: Optional[threading.Thread] = None
+        self._unsaved = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if path:
+            self.load()
+
+    @staticmethod
+    def namespace_id(namespace: str, text: str = '') -> int:
+        return zlib.crc32(f"{namespace}|{exact_terms(text)}".encode('utf-8'))
+
+    def lookup(self, text: str, namespace: str) -> Optional[Tuple[Dict[str, Any], float]]:
+        """Best cached response above the similarity threshold, with its similarity"""
+        query = self.vectorizer.vectorize(text)
+        now = time.time()
+        with self._lock:
+            if self.size:
+                similarities = self.vectors[:self.size] @ query
+                # Only the few rows above the threshold need the namespace/TTL checks
+                candidates = np.flatnonzero(similarities >= self.threshold)
+                candidates = candidates[
+                    (self.namespaces[candidates] == self.namespace_id(namespace, text)) &
+                    (now - self.created_at[candidates] <= self.ttl_seconds)
+                ]
+                if len(candidates):
+                    best = int(candidates[np.argmax(similarities[candidates])])
+                    self.last_used[best] = now
+                    self.hits += 1
+                    return json.loads(self.payloads[best]), float(similarities[best])
+            self.misses += 1
+            return None
+
+    def add(self, text: str, namespace: str, payload: Dict[str, Any]):
+        vector = self.vectorizer.vectorize(text)
+        now = time.time()
+        with self._lock:
+            if self.size < self.capacity:
+                slot = self.size
+                self.size += 1
+            else:
+                slot = int(np.argmin(self.last_used))
+                self.evictions += 1
+            self.vectors[slot] = vector
+            self.namespaces[slot] = self.namespace_id(namespace, text)
+            self.created_at[slot] = now
+            self.last_used[slot] = now
+            self.payloads[slot] = json.dumps(payload, ensure_ascii=False)
+            self._unsaved += 1
+            should_save = self.path and self._unsaved >= self.save_every
+
+        if should_save:
+            self.save()
+
+    def save(self):
+        """Write the index to `path` (.npz arrays plus a .json payload list)"""
+        if not self.path:
+            return
+        with self._save_lock:
+            self._write_index()
+
+    def _write_index(self):
+        with self._lock:
+            size = self.size
+            arrays = {
+                'vectors': self.vectors[:size].copy(),
+                'namespaces': self.namespaces[:size].copy(),
+                'created_at': self.created_at[:size].copy(),
+                'last_used': self.last_used[:size].copy(),
+            }
+            payloads = self.payloads[:size]
+            self._unsaved = 0
+
+        # Write to temp files first so a crash never leaves a half-written index
+        np.savez(self.path + '.tmp.npz', **arrays)
+        with open(self.path + '.tmp.json', 'w', encoding='utf-8') as f:
+            json.dump(payloads, f, ensure_ascii=False)
+        os.replace(self.path + '.tmp.npz', self.path + '.npz')
+        os.replace(self.path + '.tmp.json', self.path + '.json')
+
+    def flush(self):
+        """Save if anything was added since the last save"""
+        if self.path and self._unsaved:
+            self.save()
+
+    def start_periodic_save(self, interval_seconds: float) -> Optional[threading.Thread]:
+        """flush() every `interval_seconds` from a daemon thread"""
+        if not self.path or interval_seconds <= 0 or self._save_thread is not None:
+            return self._save_thread
+
+        def run():
+            while True:
+                time.sleep(interval_seconds)
+                try:
+                    self.flush()
+                except OSError as e:
+                    print(f"Semantic cache save to {self.path} failed: {e}", file=sys.stderr)
+
+        self._save_thread = threading.Thread(target=run, name='semantic-cache-save', daemon=True)
+        self._save_thread.start()
+        return self._save_thread
+
+    def load(self):
+        if not (os.path.exists(self.path + '.npz') and os.path.exists(self.path + '.json')):
+            return
+        try:
+            arrays = np.load(self.path + '.npz')
+            with open(self.path + '.json', encoding='utf-8') as f:
+                payloads = json.load(f)
+            if arrays['vectors'].shape[1] != self.vectors.shape[1]:
+                print("Semantic cache on disk has a different dimension, starting empty", file=sys.stderr)
+                return
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Could not load semantic cache from {self.path}: {e}", file=sys.stderr)
+            return
+
+        # Keep the most recently used entries if the stored index is larger than capacity
+        order = np.argsort(arrays['last_used'])[::-1][:self.capacity]
+        size = len(order)
+        self.vectors[:size] = arrays['vectors'][order]
+        self.namespaces[:size] = arrays['namespaces'][order]
+        self.created_at[:size] = arrays['created_at'][order]
+        self.last_used[:size] = arrays['last_used'][order]
+        for slot, index in enumerate(order):
+            self.payloads[slot] = payloads[index]
+        self.size = size
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'entries': self.size,
+                'capacity': self.capacity,
+            }
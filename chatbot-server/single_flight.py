@@ -0,0 +1,78 @@
+import asyncio
+import concurrent.futures
+import copy
+import re
+import threading
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+from response_cache import normalize_text
+
+
+def coalesce_key(user_message: str, context: str, message_type: str, is_quiz_response: bool) -> Tuple[str, str, str, bool]:
+    """Requests with the same key would send Gemini the same prompt"""
+    return (normalize_text(user_message), re.sub(r'\s+', ' ', context or '').strip(),
+            (message_type or '').lower(), is_quiz_response)
+
+
+class SingleFlight:
+    """Runs one call per key at a time; concurrent callers with that key wait for it
+
+    The caller that starts a call (the leader) gets its result as is, every
+    caller that joined gets a deep copy, so no two requests share mutable
+    state. If the call raises, everyone waiting gets the exception. Sync
+    callers (threads) and async callers (one event loop) are tracked
+    separately; an async call keeps running for the others if the leader
+    is cancelled.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, concurrent.futures.Future] = {}
+        self._tasks: Dict[Hashable, asyncio.Task] = {}
+        self._lock = threading.Lock()
+        self.stats_counts = {'leaders': 0, 'coalesced': 0}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """(result, coalesced): fn() run here, or the result of the same call already in flight"""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = concurrent.futures.Future()
+                self.stats_counts['leaders'] += 1
+            else:
+                self.stats_counts['coalesced'] += 1
+
+        if not leader:
+            return copy.deepcopy(future.result()), True
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    async def do_async(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Async do(): the call runs as its own task, shared by every caller with this key"""
+        task = self._tasks.get(key)
+        leader = task is None
+        if leader:
+            task = self._tasks[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda _, key=key: self._tasks.pop(key, None))
+            self.stats_counts['leaders'] += 1
+        else:
+            self.stats_counts['coalesced'] += 1
+
+        result = await asyncio.shield(task)
+        return (result, False) if leader else (copy.deepcopy(result), True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.stats_counts['leaders'] + self.stats_counts['coalesced']
+            return dict(self.stats_counts, in_flight=len(self._calls) + len(self._tasks),
+                        coalesced_rate=round(self.stats_counts['coalesced'] / total, 4) if total else 0.0)
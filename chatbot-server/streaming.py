@@ -0,0 +1,132 @@
+import json
+import re
+
+
+class ResponseTextStreamExtractor:
+    """Pulls the decoded value of one top-level JSON string field out of a streamed JSON document
+
+    Feed it raw chunks as they arrive; each call returns the newly decoded part
+    of the field (possibly empty). Escapes split across chunks, including
+    surrogate pairs, are held back until complete.
+    """
+
+    def __init__(self, field: str = 'response_text'):
+        self.field = field
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.string_chars = []
+        self.last_string = None
+        self.after_field_colon = False
+        self.capturing = False
+        self.done = False
+        self.pending_raw = ''
+        self.text = ''
+
+    @property
+    def emitted(self) -> bool:
+        return bool(self.text)
+
+    def feed(self, chunk: str) -> str:
+        delta = []
+        for index, char in enumerate(chunk):
+            if self.done:
+                break
+            if self.capturing:
+                end = self._capture(chunk[index:])
+                delta.append(self._decode_pending(final=end is not None))
+                if end is None:
+                    break
+                # The field is complete; the rest of the document is not needed
+                self.capturing = False
+                self.done = True
+                break
+            self._scan(char)
+
+        text = ''.join(delta)
+        self.text += text
+        return text
+
+    def _scan(self, char: str):
+        if self.in_string:
+            if self.escape:
+                self.escape = False
+            elif char == '\\':
+                self.escape = True
+            elif char == '"':
+                self.in_string = False
+                self.last_string = ''.join(self.string_chars)
+            else:
+                self.string_chars.append(char)
+            return
+
+        if char == '"':
+            if self.after_field_colon:
+                self.after_field_colon = False
+                self.capturing = True
+                return
+            self.in_string = True
+            self.string_chars = []
+        elif char in '{[':
+            self.depth += 1
+            self.after_field_colon = False
+        elif char in '}]':
+            self.depth -= 1
+        elif char == ':':
+            self.after_field_colon = self.depth == 1 and self.last_string == self.field
+        elif not char.isspace():
+            # A non-string value for the field (e.g. null) - nothing to stream
+            self.after_field_colon = False
+
+    def _capture(self, rest: str):
+        """Append raw string content; return the index of the closing quote, if seen"""
+        trailing_backslashes = len(self.pending_raw) - len(self.pending_raw.rstrip('\\'))
+        escaped = trailing_backslashes % 2 == 1
+        for index, char in enumerate(rest):
+            if char == '"' and not escaped:
+                self.pending_raw += rest[:index]
+                return index
+            escaped = char == '\\' and not escaped
+        self.pending_raw += rest
+        return None
+
+    def _decode_pending(self, final: bool) -> str:
+        """Decode the complete prefix of pending raw string content"""
+        raw = self.pending_raw
+        cut = len(raw) if final else self._safe_cut(raw)
+        self.pending_raw = raw[cut:]
+        if not cut:
+            return ''
+        try:
+            return json.loads('"' + raw[:cut] + '"')
+        except ValueError:
+            return raw[:cut]
+
+    @staticmethod
+    def _safe_cut(raw: str) -> int:
+        """Length of the prefix that does not end inside an escape sequence or surrogate pair"""
+        index = 0
+        cut = 0
+        while index < len(raw):
+            if raw[index] != '\\':
+                index += 1
+                cut = index
+                continue
+            if index + 1 >= len(raw):
+                break
+            if raw[index + 1] != 'u':
+                index += 2
+                cut = index
+                continue
+            if index + 6 > len(raw):
+                break
+            code = int(raw[index + 2:index + 6], 16) if re.fullmatch(r'[0-9a-fA-F]{4}', raw[index + 2:index + 6]) else 0
+            if 0xD800 <= code <= 0xDBFF:
+                # High surrogate: wait for the low half
+                if index + 12 > len(raw):
+                    break
+                index += 12
+            else:
+                index += 6
+            cut = index
+        return cut
@@ -0,0 +1,52 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from semantic_cache import SEMANTIC_CACHE_AVAILABLE, SemanticCache, exact_terms
+
+pytestmark = pytest.mark.skipif(not SEMANTIC_CACHE_AVAILABLE, reason="semantic cache needs numpy")
+
+NAMESPACE = 'gemini-2.0-flash-exp|math|'
+
+# Near-duplicates that ask something different: a cached answer for one is wrong for the other
+MUST_MISS = [
+    ("calculate the area of a circle with radius 5 cm", "calculate the area of a circle with radius 6 cm"),
+    ("what is 12 times 7", "what is 12 times 8"),
+    ("what is the derivative of x^2", "what is the derivative of x^3"),
+    ("convert 5 km to miles", "convert 5 miles to km"),
+    ("is a tomato a fruit", "is a tomato not a fruit"),
+    ("why do plants need sunlight", "why don't plants need sunlight"),
+    ("explain the first law of thermodynamics", "explain the second law of thermodynamics"),
+    ("what causes a solar eclipse", "what causes a lunar eclipse"),
+]
+
+# Rewordings of the same question
+MUST_HIT = [
+    ("explain photosynthesis", "can you explain photosynthesis please"),
+    ("what is photosynthesis", "explain photosynthesis to me"),
+    ("how does photosynthesis work", "How does photosynthesis work?"),
+]
+
+
+@pytest.mark.parametrize('cached, asked', MUST_MISS)
+def test_near_duplicates_miss(cached, asked):
+    cache = SemanticCache(capacity=16)
+    cache.add(cached, NAMESPACE, {'response_text': cached})
+    assert cache.lookup(asked, NAMESPACE) is None
+
+
+@pytest.mark.parametrize('cached, asked', MUST_HIT)
+def test_paraphrases_hit(cached, asked):
+    cache = SemanticCache(capacity=16)
+    cache.add(cached, NAMESPACE, {'response_text': cached})
+    match = cache.lookup(asked, NAMESPACE)
+    assert match is not None and match[0] == {'response_text': cached}
+
+
+def test_exact_terms_keep_numbers_and_negations():
+    assert exact_terms("radius 5.5 cm, not 6") == '5.5 not 6'
+    assert exact_terms("why don't plants need two hours") == 'not two'
+    assert exact_terms("explain photosynthesis") == ''
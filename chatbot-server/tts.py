@@ -0,0 +1,247 @@
+import collections
+import concurrent.futures
+import importlib.util
+import re
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from circuit_breaker import KEY_ERRORS
+from wav_writer import WavWriter
+
+# The Gemini TTS backend is optional (create_tts_backend falls back to silence) and its SDK
+# is slow to import, so it is only located here and imported on the first synthesis
+try:
+    GEMINI_TTS_AVAILABLE = importlib.util.find_spec('google.genai') is not None
+except ImportError:
+    GEMINI_TTS_AVAILABLE = False
+google_genai = None
+genai_types = None
+
+
+def load_google_genai():
+    global google_genai, genai_types
+    if google_genai is None:
+        from google import genai
+        from google.genai import types
+        google_genai, genai_types = genai, types
+
+# Sentences longer than this are split at clause boundaries so no single TTS call dominates
+MAX_SENTENCE_CHARS = 300
+# Speaking rate used to size silent audio
+WORDS_PER_SECOND = 3
+
+
+def clean_for_speech(text: str) -> str:
+    """Drop markdown that would otherwise be read out loud"""
+    text = re.sub(r'[*_`#>]+', '', text)
+    text = re.sub(r'^\s*(?:[-•]|\d+[.)])\s+', '', text, flags=re.MULTILINE)
+    return text
+
+
+def split_sentences(text: str) -> List[str]:
+    """Sentences (and lines) of a reply, in order, for independent synthesis"""
+    sentences = []
+    # Not after an inline list number like "1." either
+    for part in re.split(r'(?<=[.!?])(?<!\s\d\.)\s+|\n+', clean_for_speech(text or '')):
+        part = part.strip()
+        while len(part) > MAX_SENTENCE_CHARS:
+            cut = max(part.rfind(', ', 0, MAX_SENTENCE_CHARS), part.rfind('; ', 0, MAX_SENTENCE_CHARS))
+            cut = cut + 1 if cut > 0 else MAX_SENTENCE_CHARS
+            sentences.append(part[:cut].strip())
+            part = part[cut:].strip()
+        if part:
+            sentences.append(part)
+    return sentences
+
+
+class TTSBackend:
+    """Turns one sentence into raw 16-bit mono PCM at `sample_rate`"""
+
+    name = 'base'
+    sample_rate = 24000
+    sample_width = 2
+
+    def synthesize(self, text: str, voice: str) -> bytes:
+        raise NotImplementedError
+
+    def silence_bytes(self, text: str) -> int:
+        """Length of silent PCM roughly as long as it takes to say `text`"""
+        seconds = max(1, len(text.split())) / WORDS_PER_SECOND
+        return int(seconds * self.sample_rate) * self.sample_width
+
+
+class SilentTTSBackend(TTSBackend):
+    """Local stand-in: silence sized to the text, no network (tests, development)"""
+
+    name = 'silent'
+
+    def __init__(self, delay_seconds: float = 0.0):
+        self.delay_seconds = delay_seconds
+
+    def synthesize(self, text: str, voice: str) -> bytes:
+        if self.delay_seconds:
+            time.sleep(self.delay_seconds)
+        return bytes(self.silence_bytes(text))
+
+
+class GeminiTTSBackend(TTSBackend):
+    """Gemini speech generation (google-genai SDK), scheduled on the shared API key pool"""
+
+    name = 'gemini'
+
+    def __init__(self, key_pool, model_name: str, max_retries: int = 3):
+        if not GEMINI_TTS_AVAILABLE:
+            raise RuntimeError("GeminiTTSBackend requires the google-genai package")
+        self.key_pool = key_pool
+        self.model_name = model_name
+        self.max_retries = max_retries
+
+    def get_client(self, client):
+        load_google_genai()
+        if 'genai' not in client.sdk_clients:
+            client.sdk_clients['genai'] = google_genai.Client(api_key=client.api_key)
+        return client.sdk_clients['genai']
+
+    def build_config(self, voice: str):
+        load_google_genai()
+        return genai_types.GenerateContentConfig(
+            response_modalities=['AUDIO'],
+            speech_config=genai_types.SpeechConfig(
+                voice_config=genai_types.VoiceConfig(
+                    prebuilt_voice_config=genai_types.PrebuiltVoiceConfig(voice_name=voice)
+                )
+            )
+        )
+
+    def synthesize(self, text: str, voice: str) -> bytes:
+        # Audio output tokens run about 32 per second of speech
+        estimated_tokens = len(text) // 4 + int(32 * max(1, len(text.split())) / WORDS_PER_SECOND)
+        for attempt in range(self.max_retries):
+            client = self.key_pool.acquire(estimated_tokens, model_name=self.model_name)
+            try:
+                response = self.get_client(client).models.generate_content(
+                    model=self.model_name, contents=text, config=self.build_config(voice)
+                )
+                usage = getattr(response, 'usage_metadata', None)
+                self.key_pool.release(client, estimated_tokens, getattr(usage, 'total_token_count', None), self.model_name)
+                return response.candidates[0].content.parts[0].inline_data.data
+            except Exception as e:
+                kind = self.key_pool.record_failure(client, estimated_tokens, self.model_name, e)
+                if kind in KEY_ERRORS and attempt < self.max_retries - 1:
+                    continue
+                raise
+        raise Exception("Max retries exceeded")
+
+
+def create_tts_backend(name: str, key_pool=None, model_name: Optional[str] = None) -> TTSBackend:
+    """'gemini', 'silent', or 'auto' (Gemini when google-genai is installed)"""
+    if name == 'auto':
+        name = 'gemini' if GEMINI_TTS_AVAILABLE else 'silent'
+    if name == 'gemini':
+        if GEMINI_TTS_AVAILABLE:
+            return GeminiTTSBackend(key_pool, model_name)
+        print("google-genai not installed, using silent TTS backend", file=sys.stderr)
+    elif name != 'silent':
+        raise ValueError(f"Unknown TTS backend: {name}")
+    return SilentTTSBackend()
+
+
+class AudioPipeline:
+    """Synthesizes a reply sentence by sentence and appends each to the WAV as soon as it is ready
+
+    Sentences are synthesized concurrently but written in order, and the WAV
+    header is patched after every write, so the file is playable from the
+    first sentence on while the rest is still being generated. Only
+    `max_concurrency` sentences are ahead of the writer at any time, so
+    memory per reply stays flat however long the reply is.
+    """
+
+    def __init__(self, backend: TTSBackend, max_concurrency: int = 4, cache=None, preallocate: bool = False):
+        self.backend = backend
+        self.max_concurrency = max_concurrency
+        # Optional AudioSegmentCache of per-sentence PCM
+        self.cache = cache
+        # Size the WAV from the text up front and fill it through mmap
+        self.preallocate = preallocate
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='tts')
+
+    def synthesize_sentence(self, sentence: str, voice: str) -> Dict[str, Any]:
+        """One sentence as {'pcm': bytes}, {'file': open cached segment} or {'silence': byte count}"""
+        if not sentence:
+            return {'silence': self.backend.silence_bytes(sentence), 'failed': False}
+        cache_key = None
+        if self.cache:
+            cache_key = self.cache.make_key(sentence, voice, self.backend.name,
+                                            self.backend.sample_rate, self.backend.sample_width)
+            segment = self.cache.open_segment(cache_key)
+            if segment is not None:
+                return {'file': segment, 'failed': False}
+        try:
+            pcm = self.backend.synthesize(sentence, voice)
+        except Exception as e:
+            # One failed sentence becomes a pause instead of failing the whole reply
+            print(f"TTS failed for sentence ({self.backend.name}): {e}", file=sys.stderr)
+            return {'silence': self.backend.silence_bytes(sentence), 'failed': True}
+        if cache_key:
+            try:
+                self.cache.set(cache_key, pcm)
+            except OSError as e:
+                print(f"Audio cache write failed: {e}", file=sys.stderr)
+        return {'pcm': pcm, 'failed': False}
+
+    def write_segment(self, writer: WavWriter, segment: Dict[str, Any]):
+        if 'file' in segment:
+            with segment['file'] as f:
+                writer.copy_from(f)
+        elif 'pcm' in segment:
+            writer.write(segment['pcm'])
+        else:
+            writer.write_silence(segment['silence'])
+
+    def synthesize_to_wav(self, text: str, voice: str, file_path: str,
+                          on_chunk: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+        sentences = split_sentences(text) or ['']
+        preallocate_bytes = sum(map(self.backend.silence_bytes, sentences)) if self.preallocate else None
+        pending = collections.deque()
+        submitted = 0
+        failures = 0
+        cached = 0
+
+        with WavWriter(file_path, sample_rate=self.backend.sample_rate, sample_width=self.backend.sample_width,
+                       preallocate_bytes=preallocate_bytes) as writer:
+            try:
+                for index in range(len(sentences)):
+                    # Keep a bounded window of sentences in flight ahead of the writer
+                    while submitted < len(sentences) and len(pending) < self.max_concurrency:
+                        pending.append(self.executor.submit(self.synthesize_sentence, sentences[submitted], voice))
+                        submitted += 1
+                    segment = pending.popleft().result()
+                    failures += segment['failed']
+                    cached += 'file' in segment
+                    self.write_segment(writer, segment)
+                    del segment
+                    # Readers see a valid, playable file after every sentence
+                    writer.commit()
+                    if on_chunk:
+                        on_chunk({
+                            'audio_file': file_path,
+                            'sentence': index + 1,
+                            'sentences': len(sentences),
+                            'seconds_ready': round(writer.duration_seconds, 2),
+                        })
+            finally:
+                for future in pending:
+                    # Close cached segments that were opened for sentences never written
+                    if future.cancel():
+                        continue
+                    segment = future.result()
+                    if 'file' in segment:
+                        segment['file'].close()
+
+        return {
+            'duration_seconds': round(writer.duration_seconds, 2),
+            'sentences': len(sentences),
+            'tts_failures': failures,
+            'cached_sentences': cached,
+        }
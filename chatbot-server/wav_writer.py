@@ -0,0 +1,140 @@
+import mmap
+import struct
+from typing import BinaryIO, Optional, Union
+
+WAV_HEADER_BYTES = 44
+# Largest single write or copy; also the size of the shared block of silence
+CHUNK_BYTES = 64 * 1024
+ZERO_CHUNK = bytes(CHUNK_BYTES)
+
+BytesLike = Union[bytes, bytearray, memoryview]
+
+
+def wav_header(data_bytes: int, channels: int, sample_rate: int, sample_width: int) -> bytes:
+    """Canonical 44-byte PCM WAV header for `data_bytes` of audio"""
+    block_align = channels * sample_width
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + data_bytes, b'WAVE',
+        b'fmt ', 16, 1, channels, sample_rate, sample_rate * block_align, block_align, sample_width * 8,
+        b'data', data_bytes
+    )
+
+
+class WavWriter:
+    """Appends PCM to a WAV file in fixed-size pieces, keeping the header valid after every append
+
+    Nothing is buffered beyond one CHUNK_BYTES block: bytes-like segments are
+    written from memoryview slices, silence comes from one shared zero block
+    and files are copied with readinto() into a reused buffer. With
+    `preallocate_bytes` the file is sized up front and filled through mmap
+    (growing if the estimate is short, truncated on close), which avoids
+    repeated file extension for long replies.
+    """
+
+    def __init__(self, path: str, channels: int = 1, sample_rate: int = 24000, sample_width: int = 2,
+                 preallocate_bytes: Optional[int] = None):
+        self.path = path
+        self.channels = channels
+        self.sample_rate = sample_rate
+        self.sample_width = sample_width
+        self.data_bytes = 0
+        self._copy_buffer = None
+        self._file = open(path, 'w+b' if preallocate_bytes else 'wb')
+        self._mmap = None
+        if preallocate_bytes:
+            self._file.truncate(WAV_HEADER_BYTES + max(preallocate_bytes, self.frame_bytes))
+            self._mmap = mmap.mmap(self._file.fileno(), 0)
+        self._write_header()
+
+    @property
+    def frame_bytes(self) -> int:
+        return self.channels * self.sample_width
+
+    @property
+    def frames(self) -> int:
+        return self.data_bytes // self.frame_bytes
+
+    @property
+    def duration_seconds(self) -> float:
+        return self.frames / self.sample_rate
+
+    def _write_header(self):
+        header = wav_header(self.data_bytes, self.channels, self.sample_rate, self.sample_width)
+        if self._mmap is not None:
+            self._mmap[:WAV_HEADER_BYTES] = header
+        else:
+            self._file.seek(0)
+            self._file.write(header)
+            self._file.seek(WAV_HEADER_BYTES + self.data_bytes)
+
+    def _append(self, view: memoryview):
+        if self._mmap is None:
+            self._file.write(view)
+        else:
+            start = WAV_HEADER_BYTES + self.data_bytes
+            end = start + len(view)
+            if end > len(self._mmap):
+                self._grow(end)
+            self._mmap[start:end] = view
+        self.data_bytes += len(view)
+
+    def _grow(self, needed: int):
+        size = max(needed, len(self._mmap) * 2)
+        self._mmap.close()
+        self._file.truncate(size)
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+
+    def write(self, pcm: BytesLike):
+        """Append PCM without copying it"""
+        view = memoryview(pcm).cast('B')
+        for start in range(0, len(view), CHUNK_BYTES):
+            self._append(view[start:start + CHUNK_BYTES])
+
+    def write_silence(self, nbytes: int):
+        nbytes -= nbytes % self.frame_bytes
+        zeros = memoryview(ZERO_CHUNK)
+        while nbytes > 0:
+            size = min(nbytes, CHUNK_BYTES)
+            self._append(zeros[:size])
+            nbytes -= size
+
+    def copy_from(self, source: BinaryIO):
+        """Append the rest of a raw PCM file, one CHUNK_BYTES block at a time"""
+        if self._copy_buffer is None:
+            self._copy_buffer = bytearray(CHUNK_BYTES)
+        view = memoryview(self._copy_buffer)
+        while True:
+            size = source.readinto(self._copy_buffer)
+            if not size:
+                break
+            self._append(view[:size])
+
+    def commit(self):
+        """Patch the header to the current length so readers see a complete, playable file"""
+        self._write_header()
+        if self._mmap is None:
+            self._file.flush()
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._write_header()
+        if self._mmap is not None:
+            self._mmap.flush()
+            self._mmap.close()
+            self._mmap = None
+            self._file.truncate(WAV_HEADER_BYTES + self.data_bytes)
+        self._file.close()
+
+    def __enter__(self) -> 'WavWriter':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def write_silent_wav(path: str, seconds: float, sample_rate: int = 24000, sample_width: int = 2):
+    """A silent mono WAV of the given length, written without materializing the samples"""
+    with WavWriter(path, sample_rate=sample_rate, sample_width=sample_width) as writer:
+        writer.write_silence(int(seconds * sample_rate) * sample_width)